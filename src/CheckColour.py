@@ -4,6 +4,9 @@ from ev3dev2.motor import MoveSteering, MoveTank, OUTPUT_B, OUTPUT_C
 from ev3dev2.sensor.lego import ColorSensor, TouchSensor
 from ev3dev2.sound import Sound
 
+from main import calibration
+from main.sampler import SensorHub
+
 
 class Robot:
     def __init__(self):
@@ -17,35 +20,48 @@ class Robot:
         self.col_switch = True  # True: black, False: white.
         self.tile_count = 0
         self.tile_length = 230
-        # Sets up offset for variable light
-        self.off_set = self.cl.reflected_light_intensity - 13
+        # Uses the thresholds checkColour() measured under this lighting, if any
+        self.ambient = self.cl.ambient_light_intensity
         self.black_range = range(0, 30)
         self.white_range = range(30, 100)
+        thresholds = calibration.load(calibration.lighting_key('default', self.ambient))
+        if thresholds is not None:
+            self.black_range = thresholds.black_range
+            self.white_range = thresholds.white_range
+        self.hub = SensorHub()
+        self.hub.add('color', lambda: self.cl.reflected_light_intensity, rate=100)
 
     def move_degrees(self, degrees):
         self.tank_pair.on_for_degrees(left_speed=10, right_speed=10, degrees=degrees)
 
+    # Drives until the colour no longer satisfies condition, without spinning on the sensor.
+    def drive_while(self, condition, left_speed=20, right_speed=20):
+        if condition(self.hub.next('color')):
+            self.tank_pair.on(left_speed=left_speed, right_speed=right_speed)
+            self.hub.wait_for('color', lambda value: not condition(value))
+        self.tank_pair.off()
 
     def run(self):
+        self.hub.start()
+        try:
+            self.run_course()
+        finally:
+            self.tank_pair.off()
+            self.hub.stop()
+            print(self.hub.report())
+
+    def run_course(self):
         # Moves the robot off starting pad and onto black-white tiles
         self.tank_pair.on_for_degrees(left_speed=50, right_speed=50, degrees=90)
-        while (self.cl.reflected_light_intensity in self.black_range):
-            self.tank_pair.on(left_speed=20, right_speed=20)
-        self.tank_pair.off()
-        while not (self.cl.reflected_light_intensity in self.black_range):
-            self.tank_pair.on(left_speed=20, right_speed=20)
-        self.tank_pair.off()
+        self.drive_while(lambda value: value in self.black_range)
+        self.drive_while(lambda value: value not in self.black_range)
         self.tank_pair.on_for_degrees(left_speed=50, right_speed=50, degrees=self.tile_length*0.75)
         self.tank_pair.on_for_degrees(left_speed=20, right_speed=-20, degrees=180)
-        while not (self.cl.reflected_light_intensity in self.white_range):
-            self.tank_pair.on(left_speed=-20, right_speed=-20)
-        self.tank_pair.off()
+        self.drive_while(lambda value: value not in self.white_range, -20, -20)
         self.tank_pair.on_for_degrees(left_speed=20, right_speed=20, degrees=self.tile_length*0.25)
         current_tile = self.getColour()
         self.center_robot(current_tile)
-        while not (self.cl.reflected_light_intensity in current_tile):
-            self.tank_pair.on(left_speed=20, right_speed=20)
-        self.tank_pair.off()
+        self.drive_while(lambda value: value not in current_tile)
         #self.tank_pair.on(left_speed=20, right_speed=20)
 
         while (self.tile_count < 15):
@@ -61,10 +77,7 @@ class Robot:
             self.tank_pair.off()
             if (black_found):
                 self.tile_count +=1
-                self.tank_pair.on(left_speed=20, right_speed=20)
-                while not (self.cl.reflected_light_intensity in self.white_range):
-                    pass
-                self.tank_pair.off()
+                self.drive_while(lambda value: value not in self.white_range)
                 if (moved_degrees > self.tile_length):
                     self.realign()
             else:
@@ -145,10 +158,20 @@ class Robot:
 
 
 
+    # Measures black and white from the start pad and caches them for run().
     def checkColour(self):
-        while not self.btn.any():
-            self.touch_sensor.wait_for_pressed()
-            self.s.speak(str(self.cl.reflected_light_intensity))
+        self.hub.start()
+        try:
+            thresholds = calibration.measure(self.tank_pair, self.hub)
+        finally:
+            self.hub.stop()
+        if thresholds is None:
+            self.s.speak("no white found")
+            return
+        calibration.save(calibration.lighting_key('default', self.ambient), thresholds)
+        self.black_range = thresholds.black_range
+        self.white_range = thresholds.white_range
+        self.s.speak("black {:.0f} white {:.0f}".format(thresholds.black, thresholds.white))
 
 
 if __name__ == "__main__":
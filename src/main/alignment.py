@@ -0,0 +1,335 @@
+"""Ways of squaring the robot up with the row of tiles, one tile at a time.
+
+Robot.count_tiles_probing calls its alignment once per tile, with the color
+sensor just past the leading edge of a black tile. The alignment may probe
+and turn as it likes, but must leave the robot pointing along the row with
+the sensor still on the same tile.
+
+Each strategy is one of the approaches tried in this repo:
+
+- FourProbe: two probes either side of the tile looked up in a table, as
+  Robot.get_angle_from_color.
+- EdgeProbe: pivot either way until the sensor leaves the tile and turn to
+  the middle, as the edge probes in test.py.
+- SteerTiming: steer off each side of the tile and compare how long it took,
+  as in "steer to adjust angle when counting.py".
+- CenterStepping: the same pivots as EdgeProbe in 10 degree steps with a
+  stop to read the sensor after each, as CheckColour.center_robot.
+- ElliotGeometry: measure the room to each side edge and head for the
+  middle of the next tile, as in "elliot method.py".
+- ProfileSweep: one sweep of the sensor across the leading edge, turning
+  square to it by a fitted angle rather than a table or fixed steps.
+"""
+import math
+import time
+
+from reflectance import Profile, interpolate
+
+
+class Alignment:
+    """Base class for alignment strategies.
+    """
+    name = None
+
+    def reset(self):
+        """Forget anything remembered from earlier tiles.
+        """
+
+    def align(self, robot):
+        """Square the robot up on the tile under its color sensor.
+
+        :param robot: Robot to drive.
+        """
+        raise NotImplementedError
+
+
+class FourProbe(Alignment):
+    """Probe twice on each side of the tile and look the pattern up.
+
+    :param inset: Wheel degrees to drive into the tile before probing.
+    :param reach: Wheel degrees between the inner and outer probe.
+    """
+    name = 'four-probe'
+
+    def __init__(self, inset=135, reach=40):
+        self.inset = inset
+        self.reach = reach
+        self.previous = 0
+
+    def reset(self):
+        self.previous = 0
+
+    def align(self, robot):
+        robot.move_degrees(self.inset, speed=50)
+        robot.turn(90, speed=40)
+        right_is_black_1 = robot.on_black()
+        robot.move_degrees(self.reach, speed=40)
+        right_is_black_2 = robot.on_black()
+        robot.move_degrees(-self.reach, speed=40)
+        robot.turn(-180, speed=40)
+        left_is_black_1 = robot.on_black()
+        robot.move_degrees(self.reach, speed=40)
+        left_is_black_2 = robot.on_black()
+        robot.move_degrees(-self.reach, speed=40)
+        robot.turn(90, speed=40)
+
+        turn_angle = robot.get_angle_from_color(left_is_black_2, left_is_black_1,
+                                                right_is_black_1, right_is_black_2)
+        # Halve a correction the same way as the last one, so it does not overshoot
+        if self.previous > 0 and turn_angle > 0:
+            turn_angle = 3.5
+        elif self.previous < 0 and turn_angle < 0:
+            turn_angle = -3.5
+        elif turn_angle == 0:
+            robot.turn(-self.previous, speed=8)
+        robot.turn(turn_angle, speed=8)
+        self.previous = turn_angle
+
+
+def pivot_until(robot, direction, colour_range, speed=15, limit=180):
+    """Turn on the spot until the color sensor reads a color.
+
+    :param robot: Robot to drive.
+    :param direction: 1 to turn clockwise, -1 anticlockwise.
+    :param colour_range: Readings to stop on.
+    :param speed: Power with which wheels turn.
+    :param limit: Most robot degrees to turn before giving up.
+    :return: Wheel difference where the color was found, or where it gave up.
+    """
+    start = robot.wheel_difference()
+    most = 2 * robot.turn_gains.gain(speed) * limit
+    robot.tank_pair.on(left_speed=direction * speed, right_speed=-direction * speed)
+    found = None
+    while found is None and abs(robot.wheel_difference() - start) < most:
+        found = robot.hub.wait_for('color', lambda value: value in colour_range, timeout=0.1)
+    robot.off()
+    return robot.wheel_difference()
+
+
+class EdgeProbe(Alignment):
+    """Pivot each way until the sensor leaves the tile, then face the middle.
+
+    :param inset: Wheel degrees to drive into the tile first.
+    :param speed: Power with which wheels turn while pivoting.
+    """
+    name = 'edge-probe'
+
+    def __init__(self, inset=50, speed=15):
+        self.inset = inset
+        self.speed = speed
+
+    def align(self, robot):
+        robot.move_degrees(self.inset, speed=30)
+        start = robot.wheel_difference()
+        right = pivot_until(robot, 1, robot.white_range, self.speed)
+        robot.turn((start - right) / (2 * robot.turn_gains.gain(self.speed)), speed=self.speed)
+        left = pivot_until(robot, -1, robot.white_range, self.speed)
+        middle = (right + left) / 2
+        robot.turn((middle - robot.wheel_difference()) / (2 * robot.turn_gains.gain(self.speed)),
+                   speed=self.speed)
+
+
+class SteerTiming(Alignment):
+    """Steer off each side of the tile and turn towards the side that took longer.
+
+    :param speed: Power of the outer wheel while steering.
+    :param correction: Robot degrees to turn by.
+    :param deadband: Share of the steering time the two sides may differ by
+        without turning.
+    """
+    name = 'steer-timing'
+
+    def __init__(self, speed=20, correction=5, deadband=0.1):
+        self.speed = speed
+        self.correction = correction
+        self.deadband = deadband
+
+    def steer_off(self, robot, direction):
+        """Steer with one wheel still until the sensor leaves the tile, then back.
+
+        :param robot: Robot to drive.
+        :param direction: -1 to steer left, 1 to steer right.
+        :return: Seconds it took to leave the tile.
+        """
+        if direction < 0:
+            left, right = 0, self.speed
+        else:
+            left, right = self.speed, 0
+        tank = robot.tank_pair
+        positions = tank.left_motor.position, tank.right_motor.position
+        start = time.monotonic()
+        tank.on(left_speed=left, right_speed=right)
+        sample = robot.hub.wait_for('color', lambda value: value not in robot.black_range, timeout=3)
+        robot.off()
+        taken = (sample[0] if sample is not None else time.monotonic()) - start
+        moved = max(abs(tank.left_motor.position - positions[0]),
+                    abs(tank.right_motor.position - positions[1]))
+        tank.on_for_degrees(left_speed=-left, right_speed=-right, degrees=moved)
+        return taken
+
+    def align(self, robot):
+        left = self.steer_off(robot, -1)
+        right = self.steer_off(robot, 1)
+        if abs(left - right) <= self.deadband * max(left, right):
+            return
+        # More black to the left means the robot is right of the middle.
+        robot.turn(-self.correction if left > right else self.correction, speed=10)
+
+
+class CenterStepping(Alignment):
+    """Pivot in small steps, reading the sensor after each, and face the middle.
+
+    :param inset: Wheel degrees to drive into the tile first.
+    :param step: Wheel degrees per step.
+    :param limit: Most steps each way.
+    """
+    name = 'center-step'
+
+    def __init__(self, inset=100, step=10, limit=40):
+        self.inset = inset
+        self.step = step
+        self.limit = limit
+
+    def steps_until_white(self, robot, direction):
+        """Pivot step by step until the sensor reads white.
+
+        :param robot: Robot to drive.
+        :param direction: 1 to turn clockwise, -1 anticlockwise.
+        :return: Number of steps taken.
+        """
+        steps = 0
+        while steps < self.limit and not robot.on_white():
+            robot.tank_pair.on_for_degrees(left_speed=10 * direction, right_speed=-10 * direction,
+                                           degrees=self.step)
+            steps += 1
+        return steps
+
+    def align(self, robot):
+        robot.move_degrees(self.inset, speed=30)
+        right = self.steps_until_white(robot, 1)
+        robot.tank_pair.on_for_degrees(left_speed=-10, right_speed=10, degrees=self.step * right)
+        left = self.steps_until_white(robot, -1)
+        robot.tank_pair.on_for_degrees(left_speed=10, right_speed=-10,
+                                       degrees=self.step * (right + left) / 2)
+
+
+class ElliotGeometry(Alignment):
+    """Measure the room to each side edge and head for the next tile's middle.
+
+    With the axle over the middle of the tile, the robot faces each side in
+    turn and steps towards the edge until the sensor leaves the tile. Half the
+    difference between the two distances is how far it is off the middle of
+    the row, and it turns to make that up over the next tile.
+
+    :param step: Wheel degrees per step.
+    :param limit: Most steps each way.
+    """
+    name = 'elliot'
+
+    def __init__(self, step=10, limit=20):
+        self.step = step
+        self.limit = limit
+
+    def room(self, robot):
+        """Step forward until the sensor leaves the tile, then step back.
+
+        :param robot: Robot to drive.
+        :return: Wheel degrees from the axle to the edge.
+        """
+        steps = 0
+        while steps < self.limit and robot.on_black():
+            robot.tank_pair.on_for_degrees(left_speed=20, right_speed=20, degrees=self.step)
+            steps += 1
+        robot.tank_pair.on_for_degrees(left_speed=-20, right_speed=-20, degrees=self.step * steps)
+        return robot.sensor_dist + self.step * steps
+
+    def align(self, robot):
+        robot.move_degrees(robot.tile_length / 2 + robot.sensor_dist, speed=30)
+        robot.turn(90, speed=30)
+        right = self.room(robot)
+        robot.turn(-180, speed=30)
+        left = self.room(robot)
+        robot.turn(90, speed=30)
+        # More room on the right means the robot is left of the middle.
+        offset = (right - left) / 2
+        robot.turn(math.degrees(math.atan2(offset, 2 * robot.tile_length)), speed=10)
+
+
+class ProfileSweep(Alignment):
+    """Sweep the sensor across the tile's leading edge and face square to it.
+
+    The robot turns through one continuous sweep while the sensor hub records
+    the reflectance, and the dark stretch of the profile is centred on the
+    direction square to the edge; see reflectance.py. If the sensor is still
+    on the tile at either end, that end is extended a step at a time.
+
+    :param reach: Robot degrees to sweep either side of the current heading.
+    :param inset: Wheel degrees to drive into the tile first, so the sensor's
+        arc dips into it.
+    :param speed: Power with which wheels turn while sweeping.
+    :param limit: Largest correction to believe, in degrees, and furthest
+        to extend the sweep at either end.
+    :param step: Degrees to extend the sweep by at a time.
+    """
+    name = 'profile-sweep'
+
+    def __init__(self, reach=50, inset=10, speed=15, limit=20, step=10):
+        self.reach = reach
+        self.inset = inset
+        self.speed = speed
+        self.limit = limit
+        self.step = step
+
+    def sweep(self, robot):
+        """Turn across the tile's edge clockwise, recording the profile.
+
+        The turns are ramped by the planner so the wheels do not slip, and
+        each color sample is placed by the odometry heading at the moment it
+        was taken.
+
+        :param robot: Robot to drive.
+        :return: (Profile, odometry heading where the sweep started, angle of
+            the starting heading in the sweep), with angles from where the
+            sweep started.
+        """
+        robot.turn(-self.reach, speed=30)
+        back = self.reach
+        while robot.hub.next('color') not in robot.white_range and back < self.reach + self.limit:
+            robot.turn(-self.step, speed=30)
+            back += self.step
+        colour_seq = robot.hub.seq('color')
+        heading_seq = robot.hub.seq('heading')
+        start = robot.hub.next('heading')
+        robot.turn(back + self.reach, speed=self.speed)
+        extended = 0
+        while robot.hub.next('color') not in robot.white_range and extended < self.limit:
+            robot.turn(self.step, speed=self.speed)
+            extended += self.step
+        # Wait for a heading taken after the turn, so the samples cover all of it.
+        robot.hub.next('heading')
+        headings = robot.hub.samples('heading', heading_seq)
+        samples = [(t, value) for t, value in robot.hub.samples('color', colour_seq)
+                   if headings and headings[0][0] <= t <= headings[-1][0]]
+        angles = interpolate([t for t, _ in headings], [h - start for _, h in headings],
+                             [t for t, _ in samples])
+        profile = Profile()
+        for angle, (_, value) in zip(angles, samples):
+            profile.add(angle, value)
+        return profile, start, back
+
+    def align(self, robot):
+        robot.move_degrees(self.inset, speed=20)
+        profile, start, square = self.sweep(robot)
+        span = profile.dark_span()
+        if span is not None and abs((span[0] + span[1]) / 2 - square) <= self.limit:
+            square = (span[0] + span[1]) / 2
+        # Turn back by the odometry, which the sweep was measured with, so no gain error creeps in.
+        remaining = (start + square - robot.hub.next('heading')) * robot.odometry.turn_factor
+        if remaining >= 0:
+            robot.planner.drive(1, -1, remaining, speed=self.speed)
+        else:
+            robot.planner.drive(-1, 1, -remaining, speed=self.speed)
+
+
+STRATEGIES = {strategy.name: strategy for strategy in
+              (FourProbe, EdgeProbe, SteerTiming, CenterStepping, ElliotGeometry, ProfileSweep)}
@@ -0,0 +1,132 @@
+"""Driving onto the tower in one motion, steered by the ultrasonic sensor.
+
+The ultrasonic sensor reads the distance to the tower wherever it is in its
+cone, about 15 degrees either side, and nothing outside it, so a reading on
+its own says the tower is ahead but not where in the cone. What does give
+the bearing is where the tower drops out of the cone, on either side.
+
+TowerServo weaves while driving: it steers one way until the tower is lost
+off the edge of the cone, then back the other way until it is lost off the
+other edge. The bearing of the tower is halfway between the headings the two
+edges were found at, as for a sweep on the spot, and the weave is centred
+on it because it only ever turns back once the tower is lost. Until both
+edges have been found, it is half the cone back from the one that has. The robot
+slows smoothly from slow_distance down, and the approach ends stop_distance
+from the tower, pointing at it.
+
+Single bogus readings are taken out with a median of the last few, and a
+reading much further than the last one is the tower lost rather than the
+tower, so nothing further away can pull the robot off it.
+
+If the tower is knocked aside or never picked up again, weaving would go on
+for ever, so the servo gives up once the robot has driven further than the
+tower was plus travel_margin, or has not seen the tower for lost_limit
+readings in a row, and the robot falls back to looking for it on the spot.
+"""
+from collections import deque
+
+
+class TowerServo:
+    """Decides the steering and speed on the way to the tower.
+
+    Headings are odometry headings in degrees; steering is positive to the
+    right, as for MoveSteering, and speeds are percentages.
+
+    :param stop_distance: Distance in cm to stop at.
+    :param slow_distance: Distance in cm to start slowing down from.
+    :param max_speed: Speed further away than slow_distance.
+    :param min_speed: Speed at stop_distance.
+    :param weave: Steering while weaving across the tower.
+    :param beam: Half-angle of the sensor's cone in degrees.
+    :param margin: How much further than the last reading, in cm, still counts as the tower.
+    :param window: Number of readings the median is taken over.
+    :param overshoot: Most degrees to turn past where the tower was last
+        lost on a side, without seeing it again, before turning back anyway.
+    :param travel_margin: How much further than the starting distance, in
+        cm, the robot may drive before giving up.
+    :param lost_limit: Readings in a row without the tower before giving up.
+    """
+    def __init__(self, stop_distance=20, slow_distance=60, max_speed=60, min_speed=15, weave=12,
+                 beam=15, margin=15, window=3, overshoot=20, travel_margin=20, lost_limit=50):
+        self.stop_distance = stop_distance
+        self.slow_distance = slow_distance
+        self.max_speed = max_speed
+        self.min_speed = min_speed
+        self.weave = weave
+        self.beam = beam
+        self.margin = margin
+        self.window = window
+        self.overshoot = overshoot
+        self.travel_margin = travel_margin
+        self.lost_limit = lost_limit
+        self.start(0.0, 255.0)
+
+    def start(self, heading, distance):
+        """Start an approach with the tower straight ahead.
+
+        :param heading: Odometry heading pointing at the tower.
+        :param distance: Distance to the tower in cm.
+        """
+        self.bearing = heading
+        self.distance = distance
+        self.direction = 1
+        self.seen = True
+        # Heading where the tower was last lost off each side
+        self.edges = {1: None, -1: None}
+        self.recent = deque(maxlen=self.window)
+        self.done = distance <= self.stop_distance
+        self.budget = distance + self.travel_margin
+        self.lost = 0
+        # Set once the approach is given up on; see update()
+        self.failed = False
+
+    def speed(self):
+        """Return the speed for the last distance to the tower.
+
+        :return: Percentage, from min_speed at stop_distance to max_speed at slow_distance.
+        """
+        share = (self.distance - self.stop_distance) / (self.slow_distance - self.stop_distance)
+        return self.min_speed + (self.max_speed - self.min_speed) * max(0.0, min(1.0, share))
+
+    def update(self, distance, heading, travelled=0.0):
+        """Take a reading and return how to drive.
+
+        :param distance: Ultrasonic distance in cm.
+        :param heading: Odometry heading when it was read.
+        :param travelled: Distance in cm driven since start().
+        :return: (steering, speed); done is set once the tower is close
+            enough, and failed once it is given up on.
+        """
+        self.recent.append(distance)
+        filtered = sorted(self.recent)[len(self.recent) // 2]
+        seen = filtered <= self.distance + self.margin
+        self.lost = 0 if seen else self.lost + 1
+        if travelled > self.budget or self.lost >= self.lost_limit:
+            self.failed = True
+        if seen:
+            self.distance = filtered
+            if self.distance <= self.stop_distance:
+                self.done = True
+        elif self.seen:
+            # Lost off the side being turned towards; the tower is back the other way.
+            self.edges[self.direction] = heading
+            self._turn_back()
+        self.seen = seen
+        if not seen:
+            # Turning towards a side whose edge is long past means the tower is not there.
+            edge = self.edges[self.direction]
+            if edge is None:
+                edge = self.bearing
+            if self.direction * (heading - edge) > self.overshoot:
+                self._turn_back()
+        return self.direction * self.weave, self.speed()
+
+    def _turn_back(self):
+        self.direction = -self.direction
+        right, left = self.edges[1], self.edges[-1]
+        if right is not None and left is not None:
+            self.bearing = (right + left) / 2
+        elif right is not None:
+            self.bearing = right - self.beam
+        elif left is not None:
+            self.bearing = left + self.beam
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Asyncio front end to the Robot.
+
+Motions are coroutines that start the motors without blocking and poll the
+encoders, so they can run as tasks and be cancelled the moment a sensor
+event fires. Sensor events are read from the SensorHub's ring buffers, and
+sound plays in the background while the robot keeps driving. Everything
+runs on one event loop, so no state is shared between threads.
+"""
+import asyncio
+
+from runRobot import Robot
+from sweep import Sweep
+
+
+class AsyncRobot(Robot):
+    """Robot whose motions and sensor events are awaitable.
+
+    :param poll: Seconds between checks of the encoders and sensor buffers.
+    """
+    def __init__(self, poll=0.01):
+        super().__init__()
+        self.poll = poll
+
+    def colour_range(self, colour):
+        """Return the intensity range for a color name.
+
+        :param colour: 'black' or 'white'.
+        :return: The matching range.
+        """
+        if colour == 'black':
+            return self.black_range
+        if colour == 'white':
+            return self.white_range
+        raise ValueError("unknown colour {!r}".format(colour))
+
+    async def next_edge(self, colour, timeout=None):
+        """Wait until the color sensor crosses onto a color.
+
+        :param colour: 'black' or 'white'.
+        :param timeout: Seconds to wait, or None for no limit.
+        :return: Hub time of the first sample on the new color.
+        """
+        target = self.colour_range(colour)
+        latest = self.hub.latest('color')
+        was_on = latest is not None and latest[1] in target
+        seq = self.hub.seq('color')
+        loop = asyncio.get_event_loop()
+        end = None if timeout is None else loop.time() + timeout
+        while True:
+            samples, seq = self.hub.fetch('color', seq)
+            for t, value in samples:
+                on = value in target
+                if on and not was_on:
+                    return t
+                was_on = on
+            if end is not None and loop.time() >= end:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(self.poll)
+
+    async def _until_stopped(self):
+        try:
+            while self.tank_pair.is_running:
+                await asyncio.sleep(self.poll)
+        except asyncio.CancelledError:
+            self.off()
+            raise
+
+    async def move_async(self, degrees, speed=20):
+        """Turn the wheels a set number of degrees; cancelling stops the motors.
+
+        :param degrees: Degrees to turn the wheels.
+        :param speed: Power with which wheels turn.
+        """
+        if degrees < 0:
+            degrees, speed = -degrees, -speed
+        self.tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=degrees,
+                                      block=False)
+        await self._until_stopped()
+
+    async def turn_async(self, degrees, speed=20):
+        """Turn the robot in place; cancelling stops the motors.
+
+        :param degrees: Degrees to rotate the robot.
+        :param speed: Power with which wheels turn.
+        """
+        if degrees < 0:
+            degrees, speed = -degrees, -speed
+        self.tank_pair.on_for_degrees(left_speed=speed, right_speed=-speed,
+                                      degrees=degrees * self.turn_gains.gain(speed), block=False)
+        await self._until_stopped()
+
+    async def drive(self, speed=20):
+        """Drive until cancelled.
+
+        :param speed: Power with which wheels turn.
+        """
+        self.on(speed=speed)
+        try:
+            while True:
+                await asyncio.sleep(self.poll)
+        finally:
+            self.off()
+
+    async def until(self, event, motion):
+        """Run a motion until an event fires or the motion ends, whichever is first.
+
+        If the motion fails before the event fires, its exception is raised.
+
+        :param event: Awaitable sensor event.
+        :param motion: Awaitable motion, cancelled if the event fires first.
+        :return: The event's result, or None if the motion finished first.
+        """
+        event = asyncio.ensure_future(event)
+        motion = asyncio.ensure_future(motion)
+        try:
+            await asyncio.wait([event, motion], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (event, motion):
+                task.cancel()
+            await asyncio.gather(event, motion, return_exceptions=True)
+        if event.done() and not event.cancelled() and event.exception() is None:
+            return event.result()
+        if not motion.cancelled() and motion.exception() is not None:
+            raise motion.exception()
+        return None
+
+    async def skip(self, colour, speed=20):
+        """Drive until the sensor leaves a color.
+
+        :param colour: Color to drive across, 'black' or 'white'.
+        :param speed: Power with which wheels turn.
+        """
+        other = 'white' if colour == 'black' else 'black'
+        if await self.sample() in self.colour_range(colour):
+            await self.until(self.next_edge(other), self.drive(speed))
+
+    async def sample(self):
+        """Return the next color sample.
+
+        :return: Reflected light intensity.
+        """
+        seq = self.hub.seq('color')
+        while True:
+            samples, _ = self.hub.fetch('color', seq)
+            if samples:
+                return samples[0][1]
+            await asyncio.sleep(self.poll)
+
+    async def play_tone(self, frequency, duration):
+        """Play a tone without holding up the motors.
+
+        Completes once the tone would have finished, so tones do not overlap.
+
+        :param frequency: Tone frequency in Hz.
+        :param duration: Tone length in seconds.
+        """
+        self.audio.tone(frequency, duration)
+        await asyncio.sleep(duration)
+
+    def run(self):
+        """Run robot through course on a fresh event loop.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.odometry.reset()
+        ambient = self.color_sensor.ambient_light_intensity
+        self.trace.sensor('ambient', ambient)
+        self.hub.start()
+        self.audio.start()
+        try:
+            self.calibrate_colours(ambient)
+            self.load_gains()
+            loop.run_until_complete(self.run_course())
+        finally:
+            self.off()
+            self.hub.stop()
+            self.audio.stop()
+            loop.close()
+            self.save_trace()
+            print(self.hub.report())
+            self.report_profile()
+
+    async def run_course(self):
+        """Run robot through course.
+        """
+        with self.profile.phase('initialize_start'):
+            await self.initialize_start_async()
+        with self.profile.phase('count_tiles'):
+            await self.count_tiles_async()
+        with self.profile.phase('bump_tower'):
+            await self.bump_tower_async()
+
+    async def initialize_start_async(self):
+        """Move robot from start to first black tile.
+        """
+        await self.move_async(80)
+        await self.skip('black')
+        await self.skip('white')
+        await self.move_async(self.tile_length / 2 + self.sensor_dist)
+        await self.turn_async(90)
+        await self.skip('white', speed=-20)
+        await self.skip('black', speed=-20)
+        await self.skip('white')
+        self.odometry.reset(x=-self.sensor_dist / self.odometry.degrees_per_cm)
+
+    async def probe(self):
+        """Return whether the sensor is on black.
+
+        :return: Whether the color sensor senses black.
+        """
+        return await self.sample() in self.black_range
+
+    async def count_tiles_async(self):
+        """Move across 15 black tiles while counting, beeping as it goes.
+        """
+        prev_turn_angle = 0
+        tone = None
+        for tile_count in range(1, 15):
+            self.tile_reached(tile_count)
+            tone = asyncio.ensure_future(self.play_tone(100 + (50 * tile_count), 0.5))
+            await self.move_async(135)
+
+            await self.turn_async(90)
+            right_is_black_1 = await self.probe()
+            await self.move_async(40)
+            right_is_black_2 = await self.probe()
+            await self.move_async(-40)
+            await self.turn_async(-180)
+            left_is_black_1 = await self.probe()
+            await self.move_async(40)
+            left_is_black_2 = await self.probe()
+            await self.move_async(-40)
+            await self.turn_async(90)
+
+            turn_angle = self.get_angle_from_color(left_is_black_2, left_is_black_1,
+                                                   right_is_black_1, right_is_black_2)
+            if prev_turn_angle > 0 and turn_angle > 0:
+                turn_angle = 3.5
+            elif prev_turn_angle < 0 and turn_angle < 0:
+                turn_angle = -3.5
+            elif turn_angle == 0:
+                await self.turn_async(-prev_turn_angle, speed=8)
+            await self.turn_async(turn_angle, speed=8)
+            prev_turn_angle = turn_angle
+
+            await self.skip('black')
+            await self.skip('white')
+            await tone
+
+        tone = asyncio.ensure_future(self.play_tone(100 + (50 * 15), 0.5))
+        await self.move_async(self.tile_length)
+        await tone
+
+    async def sweep_async(self, degrees, speed=20):
+        """Turn on the spot while recording ultrasonic distances.
+
+        :param degrees: Degrees to rotate the robot.
+        :param speed: Power with which wheels turn.
+        :return: The Sweep, with angles relative to the starting heading.
+        """
+        sweep = Sweep()
+        start = self.robot_angle()
+        self.hub.resume('distance')
+        seq = self.hub.seq('distance')
+        motion = asyncio.ensure_future(self.turn_async(degrees, speed))
+        try:
+            while not motion.done():
+                await asyncio.sleep(self.poll)
+                samples, seq = self.hub.fetch('distance', seq)
+                angle = self.robot_angle() - start
+                for _, distance in samples:
+                    sweep.add(angle, distance)
+        finally:
+            self.hub.pause('distance')
+            await motion
+        return sweep
+
+    async def search_for_tower_async(self, window=370, expected=None):
+        """Point robot at tower, sweeping a window around the current heading.
+
+        :param window: Degrees to sweep; 360 or more sweeps all the way round.
+        :param expected: Distance the tower should be at, if known.
+        :return: Distance to tower.
+        """
+        start = self.robot_angle()
+        while True:
+            if window >= 360:
+                origin = self.robot_angle()
+                target = (await self.sweep_async(370)).nearest()
+                break
+            origin = start - window / 2
+            await self.turn_async(origin - self.robot_angle())
+            target = (await self.sweep_async(window)).nearest(complete=True)
+            if target is not None and (expected is None or target[1] <= 1.5 * expected + 10):
+                break
+            window *= 2
+        if target is None:
+            return 255
+        angle, distance = target
+        await self.turn_async((origin + angle - self.robot_angle() + 180) % 360 - 180)
+        return distance
+
+    async def bump_tower_async(self):
+        """Find tower and knock it off its base.
+        """
+        await self.turn_async(90)
+        await self.move_async(self.tile_length * 18)
+
+        distance = await self.search_for_tower_async()
+        while True:
+            if distance / 2 <= 20:
+                await self.move_async(self.cm_to_degrees(distance - 20))
+                await self.search_for_tower_async(window=self.rescan_window, expected=20)
+                break
+            await self.move_async(self.cm_to_degrees(distance / 2))
+            distance = await self.search_for_tower_async(window=self.rescan_window,
+                                                         expected=distance / 2)
+
+        await self.move_async(self.cm_to_degrees(10))
+        for i in range(40, 101, 10):
+            await self.move_async(self.tile_length * 2, speed=i)
+            await self.move_async(-self.tile_length, speed=50)
+        for i in range(5):
+            await self.move_async(self.tile_length * 2, speed=100)
+            await self.move_async(-self.tile_length, speed=50)
+        await self.until(asyncio.sleep(5), self.drive(speed=100))
+        await self.play_tone(400, 1)
+
+
+if __name__ == "__main__":
+    AsyncRobot().run()
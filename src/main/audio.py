@@ -0,0 +1,204 @@
+"""Sounds played from a background thread so they never hold up the motors.
+
+Robot code queues a tone or a phrase and carries on driving; one worker
+thread plays the queue in order. Tones and phrases known in advance are
+rendered to WAV files in the repo's sounds/ folder, once, so playing them is
+just a file copy to the speaker instead of generating a tone or waiting for
+espeak to synthesize speech. Anything that was not rendered is played
+live by the worker instead.
+"""
+import math
+import os
+import subprocess
+import time
+import wave
+from array import array
+from collections import deque
+from threading import Condition, Thread
+
+# The repo's own sounds folder, alongside yababy.wav
+SOUND_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         os.pardir, os.pardir, 'sounds'))
+
+# Samples per second of rendered tones; plenty for the brick's speaker
+RATE = 11025
+
+
+def tone_file(frequency, duration):
+    """Return the file name a tone is rendered to.
+
+    :param frequency: Tone frequency in Hz.
+    :param duration: Tone length in seconds.
+    :return: File name.
+    """
+    return 'tone-{:g}Hz-{:g}s.wav'.format(frequency, duration)
+
+
+def tone_frequency(name):
+    """Return the frequency of a rendered tone from its file name.
+
+    :param name: File name, as from tone_file().
+    :return: Frequency in Hz, or None if it is not a tone.
+    """
+    if not (name.startswith('tone-') and name.endswith('.wav')):
+        return None
+    return float(name.split('-')[1][:-2])
+
+
+def phrase_file(text):
+    """Return the file name a phrase is rendered to.
+
+    :param text: Words to speak.
+    :return: File name.
+    """
+    return 'say-{}.wav'.format(''.join(c if c.isalnum() else '_' for c in text.lower()))
+
+
+def render_tone(path, frequency, duration, volume=0.8, rate=RATE):
+    """Write a sine tone to a WAV file.
+
+    :param path: File to write.
+    :param frequency: Tone frequency in Hz.
+    :param duration: Tone length in seconds.
+    :param volume: Amplitude from 0 to 1.
+    :param rate: Samples per second.
+    """
+    count = int(duration * rate)
+    # Fade in and out over 5 ms so the tone does not click
+    fade = min(int(0.005 * rate), count // 2) or 1
+    step = 2 * math.pi * frequency / rate
+    peak = volume * 32767
+    samples = array('h', [0]) * count
+    for i in range(count):
+        envelope = min(1.0, i / fade, (count - 1 - i) / fade)
+        samples[i] = int(peak * envelope * math.sin(step * i))
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(samples.tobytes())
+
+
+def render_phrase(path, text, espeak_opts=('-a', '200', '-s', '130')):
+    """Have espeak speak a phrase into a WAV file.
+
+    :param path: File to write.
+    :param text: Words to speak.
+    :param espeak_opts: Options passed to espeak, as Sound.speak uses.
+    :raise OSError: If espeak is not installed.
+    :raise subprocess.CalledProcessError: If espeak fails.
+    """
+    subprocess.run(['espeak'] + list(espeak_opts) + ['-w', path, text], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class AudioWorker:
+    """Plays queued sounds on one background thread.
+
+    :param sound: ev3dev2.sound.Sound to play through.
+    :param directory: Folder rendered sounds are cached in, or None to
+        render nothing and play everything live.
+    :param size: Most sounds waiting; the oldest is dropped beyond that.
+    :param profiler: Profiler that the wait before each sound starts is added to, if any.
+    """
+    def __init__(self, sound, directory=SOUND_DIR, size=8, profiler=None):
+        self.sound = sound
+        self.directory = directory
+        self.profiler = profiler
+        self.files = {}
+        self._pending = deque(maxlen=size)
+        self._cond = Condition()
+        self._thread = None
+        self._running = False
+
+    def prepare(self, tones=(), phrases=()):
+        """Render sounds that are not in the cache yet.
+
+        Sounds that cannot be rendered, e.g. because espeak is missing or the
+        folder is read-only, are left to be played live.
+
+        :param tones: (frequency, duration) pairs.
+        :param phrases: Phrases to speak.
+        :return: Number of files rendered.
+        """
+        if self.directory is None:
+            return 0
+        wanted = [(('tone', tone), tone_file(*tone), render_tone, tone) for tone in tones]
+        wanted += [(('say', text), phrase_file(text), render_phrase, (text,)) for text in phrases]
+        rendered = 0
+        for key, name, render, args in wanted:
+            path = os.path.join(self.directory, name)
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    render(path, *args)
+                except (OSError, subprocess.CalledProcessError):
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                rendered += 1
+            self.files[key] = path
+        return rendered
+
+    def start(self):
+        """Start the playing thread.
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = Thread(target=self._run, name="AudioWorker", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain=True):
+        """Stop the playing thread.
+
+        :param drain: Whether to play what is still queued first.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._running = False
+            if not drain:
+                self._pending.clear()
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def tone(self, frequency, duration):
+        """Queue a tone.
+
+        :param frequency: Tone frequency in Hz.
+        :param duration: Tone length in seconds.
+        """
+        self._queue(('tone', (frequency, duration)))
+
+    def say(self, text):
+        """Queue a phrase to speak.
+
+        :param text: Words to speak.
+        """
+        self._queue(('say', text))
+
+    def _queue(self, key):
+        with self._cond:
+            self._pending.append((key, time.monotonic()))
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                key, queued = self._pending.popleft()
+            if self.profiler is not None:
+                self.profiler.observe('sound wait', time.monotonic() - queued)
+            path = self.files.get(key)
+            kind, arg = key
+            if path is not None:
+                self.sound.play_file(path)
+            elif kind == 'tone':
+                self.sound.play_tone(*arg)
+            else:
+                self.sound.speak(arg)
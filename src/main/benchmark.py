@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Compare the Robot variants in this repo on the same randomized courses.
+
+Each variant's run() drives a lap on every course in the simulator, and the
+laps are summarized per variant: how many finished, the mean lap time, how
+often the robot crossed every tile and announced the right count, how far
+from the tower it ended up, how often the tower was knocked off and the CPU
+load.
+
+With --alignments, runRobot is driven with each tile-alignment strategy
+from alignment.py instead, and the table shows the time per tile and how
+far the heading was off the row when each tile was reached.
+
+Usage::
+
+    python3 benchmark.py --laps 10
+    python3 benchmark.py --variant main/runRobot.py:Robot --json bench.json
+    python3 benchmark.py --alignments
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+# By name, so the simulator does not swap it for the virtual clock
+from time import perf_counter
+
+import audio
+import simulator
+
+# (label, script relative to src/, class name)
+VARIANTS = [
+    ("runRobot", "main/runRobot.py", "Robot"),
+    ("asyncRobot", "main/asyncRobot.py", "AsyncRobot"),
+    ("test", "test.py", "Robot"),
+    ("CheckColour", "CheckColour.py", "Robot"),
+    ("steering", "steer to adjust angle when counting.py", "Robot"),
+    ("elliot", "elliot method.py", "Robot"),
+]
+
+
+def announced_count(sound_log, tiles=15):
+    """Return the highest tile number the robot announced.
+
+    Tiles are announced with a tone of 100 + 50 * n Hz, played live or from
+    a file rendered by audio.py, or by speaking n.
+
+    :param sound_log: World.sound_log.
+    :param tiles: Number of tiles on the course.
+    :return: Tile number, or 0 if none was announced.
+    """
+    count = 0
+    for _, kind, arg in sound_log:
+        n = None
+        if kind == 'file':
+            kind, arg = 'tone', audio.tone_frequency(arg)
+        if kind == 'tone' and arg is not None and (arg - 100) % 50 == 0:
+            n = int(arg - 100) // 50
+        elif kind == 'speak' and str(arg).isdigit():
+            n = int(arg)
+        if n is not None and 1 <= n <= tiles:
+            count = max(count, n)
+    return count
+
+
+class Result:
+    """Laps driven by one variant.
+
+    :param label: Variant name.
+    :param laps: List of simulator.Lap.
+    :param error: Why the variant could not be loaded, if it could not.
+    """
+    def __init__(self, label, laps, error=None):
+        self.label = label
+        self.laps = laps
+        self.error = error
+
+    def summary(self):
+        """Return the per-variant figures.
+
+        :return: Dict of laps, finished, lap_time, count_accuracy, count_error,
+            tower_distance, knocked, cpu_load and errors.
+        """
+        laps = self.laps
+        finished = [lap for lap in laps if lap.error is None]
+        counts = [(announced_count(lap.world.sound_log, len(lap.world.course.tiles)),
+                   lap.tiles_visited, len(lap.world.course.tiles)) for lap in laps]
+
+        def mean(values):
+            values = list(values)
+            return sum(values) / len(values) if values else None
+
+        errors = {}
+        for lap in laps:
+            if lap.error is not None:
+                name = type(lap.error).__name__
+                errors[name] = errors.get(name, 0) + 1
+        return {
+            'laps': len(laps),
+            'finished': len(finished),
+            'lap_time': mean(lap.lap_time for lap in finished),
+            'count_accuracy': mean(announced == visited == tiles for announced, visited, tiles in counts),
+            'count_error': mean(abs(announced - visited) for announced, visited, _ in counts),
+            'tower_distance': mean(lap.tower_distance for lap in laps),
+            'knocked': mean(lap.tower_knocked for lap in laps),
+            'cpu_load': mean(lap.cpu_load for lap in laps),
+            'errors': errors,
+            'load_error': None if self.error is None else repr(self.error),
+        }
+
+
+def run_variant(label, path, class_name, seeds, surface='mat', max_time=300.0):
+    """Drive one variant round a course for each seed.
+
+    :param label: Variant name.
+    :param path: Path to the script.
+    :param class_name: Name of the Robot class in it.
+    :param seeds: Seeds for simulator.Course.random().
+    :param surface: Kind of board, a key of simulator.SURFACE_GRIP.
+    :param max_time: Virtual seconds before a lap is abandoned.
+    :return: A Result.
+    """
+    try:
+        robot_class = getattr(simulator.load_variant(path), class_name)
+    except Exception as e:
+        return Result(label, [], e)
+
+    laps = []
+    for seed in seeds:
+        # A fresh course each time, so every variant sees the same sensor noise.
+        course = simulator.Course.random(seed, surface)
+        with tempfile.TemporaryDirectory() as scratch:
+
+            def configure(robot):
+                # Benchmarks should not fill the trace folder, nor map random
+                # courses as if they were one board. Each lap calibrates from
+                # scratch, so none depends on the laps before it or on the
+                # robot's own cache.
+                if hasattr(robot, 'trace_dir'):
+                    robot.trace_dir = None
+                if hasattr(robot, 'map_file'):
+                    robot.map_file = None
+                if hasattr(robot, 'calibration_file'):
+                    robot.calibration_file = os.path.join(scratch, 'calibration.json')
+
+            # Laps that time out leave threads complaining on stderr, too.
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                laps.append(simulator.run_lap(robot_class, course, max_time, configure=configure))
+    return Result(label, laps)
+
+
+class AlignmentResult:
+    """Laps driven by runRobot with one alignment strategy.
+
+    :param name: Strategy name, a key of alignment.STRATEGIES.
+    :param laps: List of simulator.Lap.
+    :param tile_times: Seconds from each tile to the next, over all laps.
+    :param heading_errors: For each lap, the heading error in degrees each
+        time the strategy was called.
+    """
+    def __init__(self, name, laps, tile_times, heading_errors):
+        self.name = name
+        self.laps = laps
+        self.tile_times = tile_times
+        self.heading_errors = heading_errors
+
+    def summary(self):
+        """Return the per-strategy figures.
+
+        :return: Dict of laps, finished, counted, lap_time, tile_time,
+            heading_error (summed over a lap's tiles, averaged over laps)
+            and max_heading_error.
+        """
+        finished = [lap for lap in self.laps if lap.error is None]
+        errors = [[abs(e) for e in lap] for lap in self.heading_errors if lap]
+        return {
+            'laps': len(self.laps),
+            'finished': len(finished),
+            'counted': sum(lap.tiles_visited == len(lap.world.course.tiles) for lap in self.laps),
+            'lap_time': sum(lap.lap_time for lap in finished) / len(finished) if finished else None,
+            'tile_time': sum(self.tile_times) / len(self.tile_times) if self.tile_times else None,
+            'heading_error': sum(map(sum, errors)) / len(errors) if errors else None,
+            'max_heading_error': max(map(max, errors)) if errors else None,
+        }
+
+
+def run_alignment(name, seeds, surface='mat', max_time=300.0):
+    """Drive runRobot round a course for each seed, aligning with one strategy.
+
+    :param name: Strategy name, a key of alignment.STRATEGIES.
+    :param seeds: Seeds for simulator.Course.random().
+    :param surface: Kind of board, a key of simulator.SURFACE_GRIP.
+    :param max_time: Virtual seconds before a lap is abandoned.
+    :return: An AlignmentResult.
+    """
+    module = simulator.load_variant(os.path.join(simulator.SRC_DIR, "main", "runRobot.py"))
+    strategies = sys.modules['alignment'].STRATEGIES
+    laps = []
+    tile_times = []
+    heading_errors = []
+    for seed in seeds:
+        course = simulator.Course.random(seed, surface)
+        world = simulator.World(course, max_time)
+        errors = []
+        robots = []
+        with tempfile.TemporaryDirectory() as scratch:
+
+            def configure(robot):
+                robot.trace_dir = None
+                robot.map_file = None
+                # Each lap calibrates from scratch, as in run_variant()
+                robot.calibration_file = os.path.join(scratch, 'calibration.json')
+                robot.alignment = strategies[name]()
+                align = robot.alignment.align
+
+                def measured(robot):
+                    # Heading relative to the row, positive anticlockwise as in the world.
+                    errors.append((world.heading_degrees - course.row_angle + 180) % 360 - 180)
+                    align(robot)
+                robot.alignment.align = measured
+                robots.append(robot)
+
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                laps.append(simulator.run_lap(module.Robot, world=world, configure=configure))
+        heading_errors.append(errors)
+        if robots:
+            tile_times.extend(robots[0].profile.phases.get('tile', ()))
+    return AlignmentResult(name, laps, tile_times, heading_errors)
+
+
+def alignment_table(results):
+    """Format alignment results as a table.
+
+    :param results: List of AlignmentResult.
+    :return: Multi-line string.
+    """
+    lines = ["{:<13} {:>7} {:>7} {:>9} {:>8} {:>11} {:>9}".format(
+        "alignment", "laps", "counted", "lap s", "s/tile", "sum err deg", "max err")]
+    for result in results:
+        s = result.summary()
+        lines.append("{:<13} {:>7} {:>7} {:>9} {:>8} {:>11} {:>9}".format(
+            result.name, "{}/{}".format(s['finished'], s['laps']), s['counted'],
+            _cell(s['lap_time'], "{:.1f}"), _cell(s['tile_time'], "{:.2f}"),
+            _cell(s['heading_error'], "{:.1f}"), _cell(s['max_heading_error'], "{:.1f}")))
+    return "\n".join(lines)
+
+
+def _cell(value, form):
+    return "-" if value is None else form.format(value)
+
+
+def table(results):
+    """Format results as a table.
+
+    :param results: List of Result.
+    :return: Multi-line string.
+    """
+    lines = ["{:<12} {:>7} {:>9} {:>7} {:>9} {:>8} {:>5}  {}".format(
+        "variant", "laps", "lap s", "count", "tower cm", "knocked", "cpu", "errors")]
+    for result in results:
+        if result.error is not None:
+            lines.append("{:<12} could not load: {!r}".format(result.label, result.error))
+            continue
+        s = result.summary()
+        lines.append("{:<12} {:>7} {:>9} {:>7} {:>9} {:>8} {:>5}  {}".format(
+            result.label, "{}/{}".format(s['finished'], s['laps']),
+            _cell(s['lap_time'], "{:.1f}"), _cell(s['count_accuracy'], "{:.0%}"),
+            _cell(s['tower_distance'], "{:.1f}"), _cell(s['knocked'], "{:.0%}"),
+            _cell(s['cpu_load'], "{:.0%}"),
+            ", ".join("{} {}".format(name, n) for name, n in sorted(s['errors'].items()))))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Robot variants on random courses.")
+    parser.add_argument("--laps", type=int, default=5, help="number of courses")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first course")
+    parser.add_argument("--surface", choices=sorted(simulator.SURFACE_GRIP), default="mat",
+                        help="kind of board the courses are laid on")
+    parser.add_argument("--max-time", type=float, default=300.0,
+                        help="virtual seconds before a lap is abandoned")
+    parser.add_argument("--variant", action="append",
+                        help="SCRIPT:CLASS to run instead of the built-in list; repeatable")
+    parser.add_argument("--alignments", action="store_true",
+                        help="compare runRobot's tile-alignment strategies instead")
+    parser.add_argument("--json", help="also write the summaries to this file")
+    args = parser.parse_args()
+
+    simulator.install(simulator.World())
+    seeds = range(args.seed, args.seed + args.laps)
+    start = perf_counter()
+    if args.alignments:
+        simulator.load_variant(os.path.join(simulator.SRC_DIR, "main", "runRobot.py"))
+        results = [run_alignment(name, seeds, args.surface, args.max_time)
+                   for name in sys.modules['alignment'].STRATEGIES]
+        print(alignment_table(results))
+        print("{} strategies x {} courses in {:.1f} s".format(
+            len(results), args.laps, perf_counter() - start))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({result.name: result.summary() for result in results}, f, indent=2)
+        return
+
+    if args.variant:
+        variants = []
+        for spec in args.variant:
+            path, _, class_name = spec.partition(":")
+            variants.append((os.path.splitext(os.path.basename(path))[0], path, class_name or "Robot"))
+    else:
+        variants = [(label, os.path.join(simulator.SRC_DIR, path), class_name)
+                    for label, path, class_name in VARIANTS]
+
+    results = []
+    for label, path, class_name in variants:
+        results.append(run_variant(label, path, class_name, seeds, args.surface, args.max_time))
+    print(table(results))
+    print("{} variants x {} courses in {:.1f} s".format(len(variants), args.laps, perf_counter() - start))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({result.label: result.summary() for result in results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
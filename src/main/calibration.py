@@ -0,0 +1,234 @@
+"""Reflectance thresholds measured on the board instead of hard-coded.
+
+The robot samples a patch of black and a patch of white, and splits the
+difference between them with a hysteresis band: a reading only counts as
+black below the band and as white above it. Readings inside the band are
+neither, so a sensor hovering over an edge no longer flickers between the
+two and double counts a tile.
+
+Thresholds are cached in a JSON file keyed by board and ambient light, so
+the measurement only has to be made once per setup.
+
+The same file holds lookup tables of motion gains: how many wheel degrees
+it really takes to turn the robot one degree, or move it one cm, at each
+speed. Wheels slip more and brake later the faster they go, so a single
+constant is only right at one speed. It also keeps the edge-following PID
+gains picked by tune.py.
+"""
+import json
+import os
+
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+
+
+class Thresholds:
+    """Black and white ranges derived from measured reflectance.
+
+    :param black: Typical reading on black.
+    :param white: Typical reading on white.
+    :param band: Share of the difference between them that is neither color.
+    """
+    def __init__(self, black, white, band=0.3):
+        self.black = black
+        self.white = white
+        self.band = band
+        self.threshold = (black + white) / 2
+        half = band * (white - black) / 2
+        self.black_range = range(0, int(self.threshold - half) + 1)
+        self.white_range = range(int(self.threshold + half) + 1, 101)
+
+    def to_dict(self):
+        """Return the measurements the thresholds were derived from, for caching.
+
+        :return: Dict of black, white and band.
+        """
+        return {'black': self.black, 'white': self.white, 'band': self.band}
+
+    def __repr__(self):
+        return "Thresholds(black={}, white={}, band={})".format(self.black, self.white, self.band)
+
+
+class GainTable:
+    """Gains measured at a few speeds, interpolated in between.
+
+    :param points: Dict of speed to gain.
+    :param default: Gain to use if nothing has been measured.
+    """
+    def __init__(self, points=None, default=1.0):
+        self.points = dict(points or {})
+        self.default = default
+
+    def gain(self, speed):
+        """Return the gain at a speed, held constant beyond the measured ones.
+
+        :param speed: Speed in percent; the sign is ignored.
+        :return: Gain.
+        """
+        speed = abs(speed)
+        known = sorted(self.points.items())
+        if not known:
+            return self.default
+        if speed <= known[0][0]:
+            return known[0][1]
+        for (low, low_gain), (high, high_gain) in zip(known, known[1:]):
+            if speed <= high:
+                return low_gain + (high_gain - low_gain) * (speed - low) / (high - low)
+        return known[-1][1]
+
+    def to_dict(self):
+        """Return the measured points, for caching.
+
+        :return: Dict of speed (as a string, for JSON) to gain.
+        """
+        return {str(speed): gain for speed, gain in self.points.items()}
+
+
+def lighting_key(board, ambient, step=5):
+    """Return the cache key for a board under some lighting.
+
+    :param board: Name of the board.
+    :param ambient: Ambient light intensity.
+    :param step: Ambient readings within the same step share a key.
+    :return: Key string.
+    """
+    return "{}/{}".format(board, int(ambient) // step * step)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write(path, key, entry):
+    cache = _read(path)
+    cache[key] = entry
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def load(key, path=CACHE):
+    """Return cached thresholds.
+
+    :param key: Cache key from lighting_key().
+    :param path: Cache file.
+    :return: Thresholds, or None if there are none for the key.
+    """
+    entry = _read(path).get(key)
+    if entry is None:
+        return None
+    return Thresholds(entry['black'], entry['white'], entry.get('band', 0.3))
+
+
+def save(key, thresholds, path=CACHE):
+    """Cache thresholds, keeping the entries for other keys.
+
+    :param key: Cache key from lighting_key().
+    :param thresholds: Thresholds to store.
+    :param path: Cache file.
+    """
+    _write(path, key, thresholds.to_dict())
+
+
+def load_gains(key, default, path=CACHE):
+    """Return a cached gain table.
+
+    :param key: Cache key, e.g. 'turn/<board>'.
+    :param default: Gain to use at speeds nothing was measured for.
+    :param path: Cache file.
+    :return: GainTable, empty if nothing is cached.
+    """
+    points = _read(path).get(key, {})
+    return GainTable({float(speed): gain for speed, gain in points.items()}, default)
+
+
+def save_gains(key, table, path=CACHE):
+    """Cache a gain table, keeping the entries for other keys.
+
+    :param key: Cache key, e.g. 'turn/<board>'.
+    :param table: GainTable to store.
+    :param path: Cache file.
+    """
+    _write(path, key, table.to_dict())
+
+
+def load_pid(key, default, path=CACHE):
+    """Return cached PID gains.
+
+    :param key: Cache key, e.g. 'follow/<board>'.
+    :param default: Gains to use if none are cached.
+    :param path: Cache file.
+    :return: (kp, ki, kd).
+    """
+    entry = _read(path).get(key)
+    if entry is None:
+        return default
+    return entry['kp'], entry['ki'], entry['kd']
+
+
+def save_pid(key, gains, path=CACHE):
+    """Cache PID gains, keeping the entries for other keys.
+
+    :param key: Cache key, e.g. 'follow/<board>'.
+    :param gains: (kp, ki, kd).
+    :param path: Cache file.
+    """
+    kp, ki, kd = gains
+    _write(path, key, {'kp': kp, 'ki': ki, 'kd': kd})
+
+
+def median(values):
+    """Return the median of some readings.
+
+    :param values: Readings.
+    :return: Middle value.
+    """
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def _read_median(hub, channel, samples):
+    # Readings come back None once the hub has stopped; half of them is still enough.
+    readings = [value for value in (hub.next(channel) for _ in range(samples)) if value is not None]
+    if len(readings) < max(1, samples // 2):
+        return None
+    return median(readings)
+
+
+def measure(tank_pair, hub, channel='color', samples=20, contrast=20, speed=10, limit=400):
+    """Measure black and white by driving off a black patch and back.
+
+    The robot must start with the color sensor on black, e.g. on the start
+    pad. It drives forward until the reading clearly rises, reads the white
+    it has reached and reverses to where it started.
+
+    :param tank_pair: MoveTank driving the wheels.
+    :param hub: Running SensorHub sampling the color sensor.
+    :param channel: Name of the color channel on the hub.
+    :param samples: Readings to take on each color.
+    :param contrast: Rise in reading that means the sensor has left black.
+    :param speed: Power with which wheels turn.
+    :param limit: Most wheel degrees to drive looking for white.
+    :return: Thresholds, or None if no white was found or too few readings
+        came from the hub.
+    """
+    black = _read_median(hub, channel, samples)
+    if black is None:
+        return None
+    start = tank_pair.left_motor.position
+    tank_pair.on(left_speed=speed, right_speed=speed)
+    found = None
+    while found is None and tank_pair.left_motor.position - start < limit:
+        found = hub.wait_for(channel, lambda value: value >= black + contrast, timeout=0.1)
+    if found is not None:
+        # Go a little further so the whole light spot is on white.
+        tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=20)
+    tank_pair.off()
+    white = _read_median(hub, channel, samples) if found is not None else None
+    tank_pair.on_for_degrees(left_speed=-speed, right_speed=-speed,
+                             degrees=tank_pair.left_motor.position - start)
+    if white is None:
+        return None
+    return Thresholds(black, white)
@@ -0,0 +1,207 @@
+"""A map of the course, built up over runs and used to drive it directly.
+
+Every run the robot records what it sees against its odometry: the color
+under the sensor in a grid of small cells, where the sensor reached each
+tile's leading edge, and where the tower was once the robot ended up
+pointing at it. The pose is measured from the first tile's leading edge,
+with heading 0 along the row once the robot has squared up on that tile, so
+every run's observations line up with the last ones however the robot
+happened to leave the start pad.
+
+After a run that got as far as the tower, what it saw is merged into the
+map cached in coursemap.json for the board. Positions are averaged over the
+runs that saw them, except that one found further than moved cm from where
+it was mapped means the board was set up again, and replaces the old one.
+Once the map has every tile and the tower, the next run steers from tile to
+tile instead of stopping to probe on each, and drives straight to where the
+tower was instead of along the row and round in a circle.
+"""
+import json
+import math
+import os
+
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'coursemap.json')
+
+
+class CourseMap:
+    """Tile colors, tile edges and the tower position in the row's frame.
+
+    Positions are in cm: x along the row from the first tile's leading edge
+    and y to the right of it, as odometry poses are once squared up.
+
+    :param cell: Side of a color cell in cm.
+    :param moved: Distance in cm past which an observation replaces the
+        mapped position instead of being averaged into it.
+    :param memory: Most runs a position is averaged over, so a board that
+        creeps between runs is followed.
+    """
+    def __init__(self, cell=2.0, moved=15.0, memory=10):
+        self.cell = cell
+        self.moved = moved
+        self.memory = memory
+        self.runs = 0
+        # (column, row) -> [black readings, readings]
+        self.cells = {}
+        # Tile number -> [x, y, observations]
+        self.tiles = {}
+        # [x, y, observations], or None until the tower has been seen
+        self._tower = None
+
+    def _key(self, x, y):
+        return int(math.floor(x / self.cell)), int(math.floor(y / self.cell))
+
+    def observe_color(self, x, y, black):
+        """Record a color reading.
+
+        :param x: Sensor x in cm.
+        :param y: Sensor y in cm.
+        :param black: Whether the reading was black.
+        """
+        counts = self.cells.setdefault(self._key(x, y), [0, 0])
+        counts[0] += 1 if black else 0
+        counts[1] += 1
+
+    def color_at(self, x, y):
+        """Return how often a point read black.
+
+        :param x: Point x in cm.
+        :param y: Point y in cm.
+        :return: Share of the readings in its cell that were black, or None if never read.
+        """
+        counts = self.cells.get(self._key(x, y))
+        if counts is None:
+            return None
+        return counts[0] / counts[1]
+
+    def _average(self, entry, x, y, n=1):
+        # Average a position in, or start afresh from one that has moved.
+        if entry is None or math.hypot(x - entry[0], y - entry[1]) > self.moved:
+            return [x, y, n]
+        total = min(entry[2] + n, self.memory)
+        share = n / total
+        return [entry[0] + share * (x - entry[0]), entry[1] + share * (y - entry[1]), total]
+
+    def observe_tile(self, number, x, y):
+        """Record where the color sensor reached a tile's leading edge.
+
+        :param number: Tile number, counting from 1.
+        :param x: Sensor x at the edge in cm.
+        :param y: Sensor y at the edge in cm.
+        """
+        self.tiles[number] = self._average(self.tiles.get(number), x, y)
+
+    def tile(self, number):
+        """Return where a tile's leading edge is.
+
+        :param number: Tile number, counting from 1.
+        :return: (x, y) in cm, or None if it is not mapped.
+        """
+        entry = self.tiles.get(number)
+        return None if entry is None else (entry[0], entry[1])
+
+    def observe_tower(self, x, y):
+        """Record where the tower was.
+
+        :param x: Tower x in cm.
+        :param y: Tower y in cm.
+        """
+        self._tower = self._average(self._tower, x, y)
+
+    @property
+    def tower(self):
+        """Where the tower is, as (x, y) in cm, or None if it is not mapped.
+        """
+        return None if self._tower is None else (self._tower[0], self._tower[1])
+
+    def complete(self, tiles=15):
+        """Return whether every tile and the tower are mapped.
+
+        :param tiles: Number of tiles in the row.
+        :return: Whether the map is enough to drive the course from.
+        """
+        return self._tower is not None and all(n in self.tiles for n in range(1, tiles + 1))
+
+    def merge(self, other):
+        """Add another map's observations to this one, as one more run.
+
+        :param other: CourseMap of a single run, with the same cell size.
+        """
+        for key, (black, seen) in other.cells.items():
+            counts = self.cells.setdefault(key, [0, 0])
+            counts[0] += black
+            counts[1] += seen
+        for number, (x, y, n) in other.tiles.items():
+            self.tiles[number] = self._average(self.tiles.get(number), x, y, n)
+        if other._tower is not None:
+            x, y, n = other._tower
+            self._tower = self._average(self._tower, x, y, n)
+        self.runs += 1
+
+    def to_dict(self):
+        """Return the map, for caching.
+
+        :return: Dict of cell, runs, cells, tiles and tower.
+        """
+        return {
+            'cell': self.cell,
+            'runs': self.runs,
+            'cells': {"{},{}".format(*key): counts for key, counts in self.cells.items()},
+            'tiles': {str(number): entry for number, entry in self.tiles.items()},
+            'tower': self._tower,
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Rebuild a map cached with to_dict().
+
+        :param entry: Dict from to_dict().
+        :return: CourseMap.
+        """
+        course_map = cls(cell=entry['cell'])
+        course_map.runs = entry.get('runs', 0)
+        for key, counts in entry.get('cells', {}).items():
+            column, row = key.split(',')
+            course_map.cells[int(column), int(row)] = list(counts)
+        course_map.tiles = {int(number): list(value) for number, value in entry.get('tiles', {}).items()}
+        course_map._tower = entry.get('tower')
+        return course_map
+
+    def __repr__(self):
+        tower = self.tower
+        return "CourseMap({} tiles, tower {}, {} runs)".format(
+            len(self.tiles), "unknown" if tower is None else "at ({:.0f}, {:.0f})".format(*tower),
+            self.runs)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load(board, path=CACHE):
+    """Return the cached map of a board.
+
+    :param board: Name of the board.
+    :param path: Cache file.
+    :return: CourseMap, or None if the board has not been mapped.
+    """
+    entry = _read(path).get(board)
+    if entry is None:
+        return None
+    return CourseMap.from_dict(entry)
+
+
+def save(board, course_map, path=CACHE):
+    """Cache a board's map, keeping the maps of other boards.
+
+    :param board: Name of the board.
+    :param course_map: CourseMap to store.
+    :param path: Cache file.
+    """
+    cache = _read(path)
+    cache[board] = course_map.to_dict()
+    with open(path, 'w') as f:
+        json.dump(cache, f, sort_keys=True)
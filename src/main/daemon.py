@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Resident robot process that keeps the drivers loaded between attempts.
+
+Importing ev3dev2 and opening the motors and sensors takes seconds on the
+brick. The daemon does that once and then waits on a Unix socket for
+commands, one per connection:
+
+    run        run the course
+    calibrate  measure and cache the motion gains, as `runRobot.py calibrate`
+    stop       stop the current attempt and the motors
+
+Each attempt runs in a child forked from the warm process, so it starts
+with the drivers already open but with a fresh Robot, and stopping it is
+just a signal. Whatever the attempt prints is sent back to the client.
+
+Usage::
+
+    python3 daemon.py serve &
+    python3 daemon.py run
+    python3 daemon.py stop
+"""
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from recorder import COMMAND
+
+SOCKET = '/tmp/ev3-robot.sock'
+
+# Commands that start an attempt, and the Robot method each one calls
+ATTEMPTS = {
+    'run': 'run',
+    'calibrate': 'calibrate_motion',
+}
+
+
+def load_robot_class():
+    """Import the Robot class, and ev3dev2 with it.
+
+    :return: runRobot.Robot.
+    """
+    from runRobot import Robot
+    return Robot
+
+
+def _terminate(signum, frame):
+    # Unwind so the attempt's finally blocks stop the motors and save the trace.
+    raise SystemExit(1)
+
+
+class Daemon:
+    """Serves attempts from a Robot constructed once.
+
+    :param load: Callable returning the Robot class to construct.
+    :param path: Unix socket to listen on.
+    """
+    def __init__(self, load=load_robot_class, path=SOCKET):
+        self.load = load
+        self.path = path
+        self.robot = None
+        self.child = None
+        self.server = None
+        self.timings = {}
+
+    def warm(self):
+        """Import the drivers and construct the Robot, timing both.
+
+        :return: Dict of seconds spent importing and constructing.
+        """
+        start = time.monotonic()
+        robot_class = self.load()
+        loaded = time.monotonic()
+        self.robot = robot_class()
+        self.timings = {'import': loaded - start, 'construct': time.monotonic() - loaded}
+        return self.timings
+
+    def serve_forever(self):
+        """Accept commands until interrupted.
+        """
+        if self.robot is None:
+            self.warm()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(2)
+        print("drivers ready in {:.2f} s (import {:.2f} s, construct {:.2f} s); listening on {}"
+              .format(sum(self.timings.values()), self.timings['import'], self.timings['construct'],
+                      self.path))
+        try:
+            while True:
+                conn, _ = self.server.accept()
+                with conn:
+                    received = time.monotonic()
+                    command = conn.makefile().readline().strip()
+                    self.reap()
+                    self.handle(command, conn, received)
+        finally:
+            self.stop()
+            self.server.close()
+            os.remove(self.path)
+
+    def handle(self, command, conn, received):
+        """Carry out one command.
+
+        :param command: Command name.
+        :param conn: Client connection to reply on.
+        :param received: time.monotonic() when the command arrived.
+        """
+        if command == 'stop':
+            stopped = self.stop()
+            conn.sendall(b"stopped\n" if stopped else b"nothing running; motors off\n")
+        elif command in ATTEMPTS:
+            if self.child is not None:
+                conn.sendall("busy with attempt {}\n".format(self.child).encode())
+                return
+            pid = os.fork()
+            if pid == 0:
+                self._attempt(ATTEMPTS[command], conn, received)
+            self.child = pid
+        else:
+            conn.sendall("unknown command {!r}; try {}\n".format(
+                command, ", ".join(sorted(ATTEMPTS) + ['stop'])).encode())
+
+    def _attempt(self, method, conn, received):
+        # Runs in the child and never returns.
+        status = 0
+        try:
+            self.server.close()
+            os.dup2(conn.fileno(), 1)
+            os.dup2(conn.fileno(), 2)
+            sys.stdout = sys.stderr = open(1, 'w', buffering=1, closefd=False)
+            signal.signal(signal.SIGTERM, _terminate)
+            print("{} started {:.3f} s after the request".format(method, time.monotonic() - received))
+            try:
+                getattr(self.robot, method)()
+            finally:
+                moved = [t for t, kind, *_ in self.robot.trace.events() if kind == COMMAND]
+                if moved:
+                    print("first motor command {:.3f} s after the request".format(min(moved) - received))
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+
+    def reap(self):
+        """Forget the attempt if it has finished.
+        """
+        if self.child is not None and os.waitpid(self.child, os.WNOHANG)[0]:
+            self.child = None
+
+    def stop(self, grace=3.0):
+        """Stop the current attempt, if any, and the motors.
+
+        :param grace: Seconds to let the attempt clean up before killing it.
+        :return: Whether an attempt was running.
+        """
+        running = self.child is not None
+        if running:
+            try:
+                os.kill(self.child, signal.SIGTERM)
+                end = time.monotonic() + grace
+                while not os.waitpid(self.child, os.WNOHANG)[0]:
+                    if time.monotonic() > end:
+                        os.kill(self.child, signal.SIGKILL)
+                        os.waitpid(self.child, 0)
+                        break
+                    time.sleep(0.05)
+            except ChildProcessError:
+                pass
+            self.child = None
+        if self.robot is not None:
+            self.robot.off()
+        return running
+
+
+def send(command, path=SOCKET):
+    """Send a command to the daemon and print the reply until it hangs up.
+
+    :param command: Command name.
+    :param path: Unix socket the daemon listens on.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall((command + '\n').encode())
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            sys.stdout.write(data.decode(errors='replace'))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Keep the robot's drivers loaded between attempts.")
+    parser.add_argument('command', choices=['serve', 'stop'] + sorted(ATTEMPTS))
+    parser.add_argument('--socket', default=SOCKET, help="Unix socket to use")
+    args = parser.parse_args()
+    if args.command == 'serve':
+        try:
+            Daemon(path=args.socket).serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        send(args.command, args.socket)
@@ -0,0 +1,111 @@
+"""Heading drift estimation from the encoder distance across tiles.
+
+Driving straight along the row, the encoder distance from a tile's leading
+edge to its trailing edge is exactly tile_length. Driving at an angle e
+stretches it to tile_length / cos(e). That alone cannot tell left from
+right and barely changes for small angles, so the estimator weaves: it
+holds the heading a known angle d to one side across one tile and to the
+other side across the next, steering in the gaps. The two crossings then
+differ by about 2 * tile_length * e * d, which gives the sign and size of e
+directly. The error is corrected a fraction at a time after every pair of
+tiles.
+
+The spacing between tiles is not used: it depends on how carefully the
+tiles were laid, while the tiles themselves are all the same size.
+"""
+import math
+
+
+def edge_time(samples, threshold):
+    """Interpolate when a run of samples last crossed a threshold.
+
+    The sensor's light spot blurs an edge over several samples, so the
+    crossing can be placed between them.
+
+    :param samples: (time, value) pairs, oldest first.
+    :param threshold: Reading that separates the two colors.
+    :return: Time of the crossing, or of the last sample if none is found.
+    """
+    for i in range(len(samples) - 1, 0, -1):
+        t0, v0 = samples[i - 1]
+        t1, v1 = samples[i]
+        if (v0 - threshold) * (v1 - threshold) <= 0 and v0 != v1:
+            return t0 + (threshold - v0) / (v1 - v0) * (t1 - t0)
+    return samples[-1][0] if samples else None
+
+
+class DriftEstimator:
+    """Estimates heading error from the encoder distance across each tile.
+
+    Angles are in robot degrees, positive clockwise as in Robot.turn().
+
+    :param tile_length: Length of a tile in wheel degrees.
+    :param dither: Angle to weave either side of the current heading.
+    :param gain: Fraction of the estimated error corrected per pair of tiles.
+    :param limit: Largest correction made at once, in degrees.
+    """
+    def __init__(self, tile_length, dither=5.0, gain=0.5, limit=6.0):
+        self.tile_length = tile_length
+        self.dither = dither
+        self.gain = gain
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        """Forget all edges, e.g. after the robot has been realigned.
+        """
+        self.black_at = None
+        self.phase = 0
+        self.pending = None
+        self.heading_error = 0.0
+        self.history = []
+
+    def start(self, position):
+        """Start weaving from the leading edge of a tile.
+
+        :param position: Mean wheel position at the edge, in degrees.
+        """
+        self.reset()
+        self.black_at = position
+
+    def black_edge(self, position):
+        """Record the sensor reaching a tile.
+
+        :param position: Mean wheel position at the edge, in degrees.
+        """
+        self.black_at = position
+
+    def white_edge(self, position):
+        """Record the sensor leaving a tile.
+
+        :param position: Mean wheel position at the edge, in degrees.
+        :return: Degrees to turn while crossing the gap to the next tile.
+        """
+        if self.black_at is None:
+            return 0.0
+        crossing, self.black_at = position - self.black_at, None
+        if not self.phase:
+            # Start weaving with +dither across the next tile.
+            self.phase = 1
+            return self.dither
+        if abs(crossing - self.tile_length) > self.tile_length / 10:
+            # Clipped a corner of the tile; the measurement is meaningless.
+            self.pending = None
+        elif self.phase > 0:
+            self.pending = crossing
+        elif self.pending is not None:
+            # stretch(e + d) - stretch(e - d) ~= 2 * e * d for small angles.
+            difference = (self.pending - crossing) / ((self.pending + crossing) / 2)
+            error = math.degrees(difference / (2 * math.radians(self.dither)))
+            self.heading_error = error
+            self.history.append((position, error))
+            self.pending = None
+            correction = max(-self.limit, min(self.limit, -self.gain * error))
+            # Swing back to +dither and fold in the correction.
+            self.phase = 1
+            return 2 * self.dither + correction
+        if self.phase > 0:
+            self.phase = -1
+            return -2 * self.dither
+        self.phase = 1
+        return 2 * self.dither
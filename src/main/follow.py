@@ -0,0 +1,199 @@
+"""Following the side edge of the tile row at speed, counting tiles on the way.
+
+Instead of stopping on each tile to square up, the robot drives along one
+side of the row with the color sensor held over the tiles' edge, where it
+only just reads black. A PID controller on the reflected light sets how far
+to point away from the row: darker means too far onto the tile, lighter too
+far off it. A second, proportional loop steers onto that heading from the
+odometry, so however far off the edge the sensor starts the robot never
+swings round by more than max_offset degrees. The steering is a
+MoveSteering value, so the robot never stops turning one wheel.
+
+In the gaps between tiles there is no edge to follow, so the robot holds
+the heading of the row turned gap_offset degrees in towards the tiles until
+the sensor meets the next one. Tiles are never laid quite in line, and one
+set a little further in than the last would otherwise pass beside the
+sensor. The heading of the row is the one the robot was squared up on at
+the first tile, which can be a few degrees out; the PID's integral builds
+up to make the difference along the tiles and is held through the gaps.
+
+As in count_tiles_continuous, the encoders gate each change between tile
+and gap, so a flicker at an edge is not a tile, and a tile the sensor
+slipped past the side of is still counted; two in a row and the row is lost.
+
+EdgeFollower only makes decisions from readings, positions and headings,
+and drives nothing itself; tune.py runs it against simulated courses built
+from recorded traces to pick the gains.
+"""
+from collections import namedtuple
+
+# Degrees off the row per unit of reflected light error, per unit-second of
+# it, and per unit per second
+Gains = namedtuple("Gains", "kp ki kd")
+
+DEFAULT_GAINS = Gains(0.8, 0.0, 0.02)
+
+
+class PID:
+    """Proportional-integral-derivative controller.
+
+    :param gains: Gains.
+    :param limit: Largest output either way; the integral stops growing
+        while the output is held at it.
+    :param band: Largest error the integral grows with, or None for any;
+        a large error is a transient the integral would only overshoot for.
+    """
+    def __init__(self, gains, limit=100.0, band=None):
+        self.gains = gains
+        self.limit = limit
+        self.band = band
+        self.reset()
+
+    def reset(self):
+        """Forget the integral and the last error.
+        """
+        self.integral = 0.0
+        self.last_error = None
+        self.last_t = None
+
+    @property
+    def bias(self):
+        """Output of the integral term alone.
+        """
+        return max(-self.limit, min(self.limit, self.gains.ki * self.integral))
+
+    def update(self, error, t, integrate=True):
+        """Return the output for a new error.
+
+        :param error: Setpoint minus measurement.
+        :param t: Time of the measurement in seconds.
+        :param integrate: Whether the error adds to the integral.
+        :return: Output, within the limit.
+        """
+        kp, ki, kd = self.gains
+        dt = 0.0 if self.last_t is None else t - self.last_t
+        derivative = 0.0
+        if self.last_error is not None and dt > 0:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+        self.last_t = t
+        output = kp * error + ki * (self.integral + error * dt) + kd * derivative
+        if integrate and abs(output) < self.limit and (self.band is None or abs(error) < self.band):
+            self.integral += error * dt
+        return max(-self.limit, min(self.limit, output))
+
+
+class EdgeFollower:
+    """Steers along the side edge of the tiles and counts them.
+
+    Positions are mean wheel positions and headings odometry headings, both
+    in degrees; steering is positive to the right, as for MoveSteering.
+
+    :param tile_length: Length of a tile in wheel degrees; the gaps are as long.
+    :param gains: Gains of the steering PID.
+    :param side: 1 to follow the tiles' right-hand edge, -1 the left-hand one.
+    :param limit: Largest steering.
+    :param heading_gain: Steering per degree between the heading wanted and the odometry's.
+    :param max_offset: Most degrees the PID may point the robot away from the row.
+    :param gap_offset: Degrees the robot points in towards the tiles in the gaps.
+    """
+    def __init__(self, tile_length, gains=DEFAULT_GAINS, side=1, limit=40, heading_gain=3.0,
+                 max_offset=20, gap_offset=6):
+        self.tile_length = tile_length
+        self.side = side
+        self.limit = limit
+        self.heading_gain = heading_gain
+        self.gap_offset = gap_offset
+        self.pid = PID(gains, max_offset)
+        self.start(35, 50, 0.0, 0.0)
+
+    @property
+    def gains(self):
+        """Gains of the steering PID.
+        """
+        return self.pid.gains
+
+    @gains.setter
+    def gains(self, gains):
+        self.pid.gains = Gains(*gains)
+
+    def start(self, target, light, position, heading, count=1):
+        """Start following from the leading edge of a tile.
+
+        :param target: Reading to hold the sensor at, on the edge.
+        :param light: Readings from here up are off the tiles.
+        :param position: Mean wheel position at the edge.
+        :param heading: Odometry heading along the row, as far as is known.
+        :param count: Number of the tile, counting from 1.
+        """
+        self.target = target
+        self.light = light
+        self.count = count
+        self.tile_start = position
+        self.on_tile = True
+        self.missed = 0
+        self.heading = heading
+        self.error_sum = 0.0
+        self.error_count = 0
+        # Only integrate with the sensor on the edge, not while steering onto it
+        self.pid.band = light - target
+        self.pid.reset()
+
+    @property
+    def row_heading(self):
+        """Odometry heading of the row: the one started with, corrected by the PID's integral.
+        """
+        return self.heading + self.side * self.pid.bias
+
+    @property
+    def lost(self):
+        """Whether the sensor has passed beside more than one tile in a row.
+        """
+        return self.missed > 1
+
+    @property
+    def tracking_error(self):
+        """Mean absolute difference from the target while on the tiles.
+        """
+        return self.error_sum / self.error_count if self.error_count else 0.0
+
+    def update(self, t, value, position, heading):
+        """Take a reading and return the steering and any tiles reached.
+
+        :param t: Time of the reading in seconds.
+        :param value: Reflected light intensity.
+        :param position: Mean wheel position when it was read.
+        :param heading: Odometry heading when it was read.
+        :return: (steering, tiles reached since the last reading).
+        """
+        travelled = position - self.tile_start
+        pitch = 2 * self.tile_length
+        reached = 0
+        if self.on_tile:
+            if value >= self.light and travelled >= 0.75 * self.tile_length:
+                self.on_tile = False
+            else:
+                error = self.target - value
+                self.error_sum += abs(error)
+                self.error_count += 1
+                # The sensor comes off each gap a little in, which is not the row's doing
+                offset = self.pid.update(error, t, travelled >= self.tile_length / 2)
+                return self._steer(self.heading + self.side * offset, heading), 0
+        if value < self.light and travelled >= 0.75 * pitch:
+            # Count any tile the sensor slipped past the side of, too
+            reached = max(1, int(round(travelled / pitch)))
+            self.count += reached
+            self.tile_start = position
+            self.on_tile = True
+            self.missed = 0
+            self.pid.last_error = None
+        elif travelled >= 1.25 * pitch:
+            reached = 1
+            self.count += 1
+            self.missed += 1
+            self.tile_start += pitch
+        return self._steer(self.row_heading - self.side * self.gap_offset, heading), reached
+
+    def _steer(self, wanted, heading):
+        steering = self.heading_gain * (wanted - heading)
+        return max(-self.limit, min(self.limit, steering))
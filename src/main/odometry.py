@@ -0,0 +1,122 @@
+"""Dead reckoning from the drive motor encoders.
+
+The pose is integrated from the change in each wheel's position since the
+last update, so it is only as good as the wheel size and turn factor it is
+given. Whenever the robot knows where it is for certain, e.g. the color
+sensor has just reached the edge of a known tile, the estimate can be pulled
+back towards the truth with observe().
+
+Coordinates are in cm and robot degrees. Heading is positive clockwise, as
+in Robot.turn(), and y is positive to the right of heading 0.
+"""
+import math
+import time
+from collections import namedtuple
+from threading import Lock
+
+Pose = namedtuple("Pose", "x y heading")
+
+# Mean wheel position in degrees, and how fast it and the wheel difference
+# were changing at the last update, in degrees per second
+Motion = namedtuple("Motion", "position forward spin")
+
+
+class Odometry:
+    """Integrates wheel encoder positions into a pose.
+
+    update() is meant to be called at a steady rate, e.g. as a SensorHub
+    channel; the pose can be read from any thread.
+
+    :param left_motor: Left drive motor.
+    :param right_motor: Right drive motor.
+    :param degrees_per_cm: Wheel degrees per cm travelled.
+    :param turn_factor: Wheel degrees per robot degree when turning on the spot.
+    """
+    def __init__(self, left_motor, right_motor, degrees_per_cm, turn_factor=1.987):
+        self.left_motor = left_motor
+        self.right_motor = right_motor
+        self.degrees_per_cm = degrees_per_cm
+        self.turn_factor = turn_factor
+        self._lock = Lock()
+        self._pose = Pose(0.0, 0.0, 0.0)
+        self._left = None
+        self._right = None
+        self._updated = None
+        self._motion = None
+
+    @property
+    def pose(self):
+        """The current pose estimate.
+        """
+        return self._pose
+
+    @property
+    def motion(self):
+        """How the wheels were moving at the last update, as a Motion.
+
+        None until there have been two updates.
+        """
+        return self._motion
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        """Set the pose, measuring from the encoders' current positions.
+
+        :param x: x in cm.
+        :param y: y in cm.
+        :param heading: Heading in degrees.
+        """
+        left, right = self.left_motor.position, self.right_motor.position
+        with self._lock:
+            self._left, self._right = left, right
+            self._pose = Pose(x, y, heading)
+
+    def update(self):
+        """Read the encoders and advance the pose.
+
+        :return: The new heading, so it can be recorded as a sample.
+        """
+        left, right = self.left_motor.position, self.right_motor.position
+        now = time.monotonic()
+        with self._lock:
+            if self._left is None:
+                self._left, self._right = left, right
+            d_left, d_right = left - self._left, right - self._right
+            self._left, self._right = left, right
+            if self._updated is not None and now > self._updated:
+                dt = now - self._updated
+                self._motion = Motion((left + right) / 2, (d_left + d_right) / 2 / dt,
+                                      (d_left - d_right) / dt)
+            self._updated = now
+            x, y, heading = self._pose
+            distance = (d_left + d_right) / 2 / self.degrees_per_cm
+            turned = (d_left - d_right) / (2 * self.turn_factor)
+            # Drive along the mean heading over the step.
+            middle = math.radians(heading + turned / 2)
+            self._pose = Pose(x + distance * math.cos(middle), y + distance * math.sin(middle),
+                              heading + turned)
+            return self._pose.heading
+
+    def observe(self, x=None, y=None, heading=None, weight=1.0):
+        """Pull the pose towards an observation of some of its components.
+
+        :param x: Observed x in cm, or None if unknown.
+        :param y: Observed y in cm, or None if unknown.
+        :param heading: Observed heading in degrees, or None if unknown.
+        :param weight: How far to trust the observation, from 0 to 1.
+        """
+        with self._lock:
+            pose = self._pose
+            self._pose = Pose(pose.x if x is None else pose.x + weight * (x - pose.x),
+                              pose.y if y is None else pose.y + weight * (y - pose.y),
+                              pose.heading if heading is None
+                              else pose.heading + weight * (heading - pose.heading))
+
+    def ahead(self, distance):
+        """Return the point some distance in front of the axle, e.g. a sensor.
+
+        :param distance: Distance ahead in cm.
+        :return: (x, y) in cm.
+        """
+        x, y, heading = self._pose
+        return (x + distance * math.cos(math.radians(heading)),
+                y + distance * math.sin(math.radians(heading)))
@@ -0,0 +1,291 @@
+"""Acceleration-limited moves for the drive motors.
+
+Starting or stopping the wheels harder than the board allows makes them
+spin or skid, so the encoders no longer say where the robot is. Instead of
+keeping every move slow, the planner follows a trapezoidal speed profile:
+speed up at the surface's acceleration limit, cruise, and slow down at the
+same rate so the wheels are nearly stopped when they reach the target. The
+last few degrees are left to the motor's own position control so the move
+still ends exactly on target.
+"""
+import math
+import time
+
+from ev3dev2.motor import SpeedDPS
+
+# Hardest the wheels can speed up or slow down without slipping, in wheel
+# degrees per second squared.
+ACCELERATION = {
+    'mat': 5000,
+    'wood': 3000,
+    'paper': 1800,
+}
+
+
+class Profile:
+    """Trapezoidal speed profile over a fixed distance.
+
+    :param distance: Wheel degrees to travel.
+    :param cruise: Top speed in degrees per second.
+    :param accel: Acceleration limit in degrees per second squared.
+    :param end: Speed to be down to at the end, in degrees per second.
+    """
+    def __init__(self, distance, cruise, accel, end=0.0):
+        self.distance = distance
+        self.cruise = cruise
+        self.accel = accel
+        self.end = end
+
+    def speed_at(self, travelled):
+        """Return the speed to run at after travelling some distance.
+
+        :param travelled: Wheel degrees travelled so far.
+        :return: Degrees per second.
+        """
+        up = math.sqrt(2 * self.accel * max(travelled, 0))
+        down = math.sqrt(self.end ** 2 + 2 * self.accel * max(self.distance - travelled, 0))
+        return min(self.cruise, up, down)
+
+
+class MotionPlanner:
+    """Runs profiled moves on a MoveTank.
+
+    :param tank_pair: MoveTank driving the wheels.
+    :param surface: Kind of board, a key of ACCELERATION.
+    :param period: Seconds between speed updates.
+    :param min_speed: Slowest speed to command, in degrees per second, unless
+        the move itself is slower.
+    :param settle: Wheel degrees left to the motors' position control.
+    :param profiler: Profiler that moves are timed and loop iterations counted in, if any.
+    """
+    def __init__(self, tank_pair, surface='mat', period=0.02, min_speed=120, settle=10,
+                 profiler=None):
+        self.tank_pair = tank_pair
+        self.surface = surface
+        self.period = period
+        self.min_speed = min_speed
+        self.settle = settle
+        self.profiler = profiler
+
+    def travelled(self, start):
+        """Return how far the faster wheel has gone since a starting point.
+
+        :param start: Motor positions (left, right) at the start.
+        :return: Wheel degrees.
+        """
+        return max(abs(self.tank_pair.left_motor.position - start[0]),
+                   abs(self.tank_pair.right_motor.position - start[1]))
+
+    def drive(self, left, right, degrees, speed=20):
+        """Turn the wheels with a speed profile, blocking until done.
+
+        :param left: Left wheel direction and share of the speed, -1 to 1.
+        :param right: Right wheel direction and share of the speed, -1 to 1.
+        :param degrees: Degrees for the faster wheel to turn.
+        :param speed: Top speed in percent of the motors' maximum.
+        """
+        degrees = abs(degrees)
+        if not degrees:
+            return
+        profiler = self.profiler
+        if profiler is not None:
+            started = time.monotonic()
+        max_speed = self.tank_pair.left_motor.max_speed
+        cruise = abs(speed) / 100 * max_speed
+        # Moves asked to run slower than min_speed run at their own speed throughout.
+        floor = min(self.min_speed, cruise)
+        profile = Profile(degrees - self.settle, cruise, ACCELERATION[self.surface], end=floor)
+        start = (self.tank_pair.left_motor.position, self.tank_pair.right_motor.position)
+        travelled = 0
+        while degrees - travelled > self.settle:
+            rate = max(floor, profile.speed_at(travelled))
+            self.tank_pair.on(SpeedDPS(left * rate), SpeedDPS(right * rate))
+            time.sleep(self.period)
+            travelled = self.travelled(start)
+            if profiler is not None:
+                profiler.tick('drive')
+        remaining = degrees - travelled
+        if remaining > 0:
+            # Creep the rest of the way so stopping does not skid.
+            self.tank_pair.on_for_degrees(SpeedDPS(left * floor), SpeedDPS(right * floor), remaining)
+        else:
+            self.tank_pair.off()
+        if profiler is not None:
+            profiler.record('drive', time.monotonic() - started)
+
+
+class Segment:
+    """One step of a queued motion.
+
+    :param left: Left wheel direction and share of the speed, -1 to 1.
+    :param right: Right wheel direction and share of the speed, -1 to 1.
+    :param speed: Top speed in percent of the motors' maximum.
+    :param degrees: Degrees for the faster wheel to turn, or None to drive
+        until a sensor condition holds.
+    :param until: Callable taking a sensor reading, for open-ended segments.
+    :param channel: SensorHub channel the condition is checked on.
+    """
+    def __init__(self, left, right, speed, degrees=None, until=None, channel='color'):
+        self.left = left
+        self.right = right
+        self.speed = speed
+        self.degrees = degrees
+        self.until = until
+        self.channel = channel
+
+    def follows_on(self, other):
+        """Return whether this segment can start without stopping after another.
+
+        :param other: The segment before this one.
+        :return: Whether both turn the wheels the same way.
+        """
+        return (self.left > 0) == (other.left > 0) and (self.right > 0) == (other.right > 0)
+
+
+class MotionQueue:
+    """Queue of moves run back to back, without stopping between them.
+
+    Segments that turn the wheels the same way are blended: the next one
+    takes over at the current speed, and the robot only slows down at the
+    end of the run of segments or where the direction changes.
+
+    Moves and spins take the same units as the Robot's blocking calls, and
+    are converted to wheel degrees with the callables given, so queued and
+    blocking moves go as far at any speed.
+
+    :param planner: MotionPlanner whose tank pair, surface and speeds are used.
+    :param hub: SensorHub for segments that end on a sensor condition.
+    :param move_degrees: Callable taking (degrees, speed) for a move and
+        returning wheel degrees, e.g. Robot.move_wheel_degrees; moves are in
+        wheel degrees if None.
+    :param turn_degrees: Callable taking (degrees, speed) for a spin and
+        returning wheel degrees, e.g. Robot.turn_wheel_degrees; spins are in
+        wheel degrees if None.
+    """
+    def __init__(self, planner, hub, move_degrees=None, turn_degrees=None):
+        self.planner = planner
+        self.hub = hub
+        self.move_degrees = move_degrees
+        self.turn_degrees = turn_degrees
+        self.segments = []
+        self.blends = 0
+        self.saved = 0.0
+
+    def move(self, degrees, speed=20):
+        """Queue a straight move.
+
+        :param degrees: Degrees to turn the wheels, as for Robot.move_degrees;
+            negative for backwards.
+        :param speed: Top speed in percent.
+        """
+        if self.move_degrees is not None:
+            degrees = self.move_degrees(degrees, speed)
+        direction = 1 if degrees >= 0 else -1
+        self.segments.append(Segment(direction, direction, speed, degrees=abs(degrees)))
+
+    def spin(self, degrees, speed=20):
+        """Queue a turn on the spot.
+
+        :param degrees: Degrees to rotate the robot, as for Robot.turn;
+            positive clockwise.
+        :param speed: Top speed in percent.
+        """
+        if self.turn_degrees is not None:
+            degrees = self.turn_degrees(degrees, speed)
+        direction = 1 if degrees >= 0 else -1
+        self.segments.append(Segment(direction, -direction, speed, degrees=abs(degrees)))
+
+    def until(self, condition, speed=20, channel='color'):
+        """Queue driving straight until a sensor condition holds.
+
+        :param condition: Callable taking a reading and returning a bool.
+        :param speed: Speed in percent, negative for backwards.
+        :param channel: SensorHub channel to check.
+        """
+        direction = 1 if speed >= 0 else -1
+        self.segments.append(Segment(direction, direction, abs(speed), until=condition,
+                                     channel=channel))
+
+    def run(self):
+        """Run and empty the queue, blocking until the last segment ends.
+        """
+        segments, self.segments = self.segments, []
+        profiler = self.planner.profiler
+        if profiler is not None:
+            started = time.monotonic()
+        chain = []
+        for segment in segments:
+            if chain and not segment.follows_on(chain[-1]):
+                self._run_chain(chain)
+                chain = []
+            chain.append(segment)
+        if chain:
+            self._run_chain(chain)
+        if profiler is not None:
+            profiler.record('queue', time.monotonic() - started)
+
+    def _run_chain(self, chain):
+        planner = self.planner
+        tank = planner.tank_pair
+        accel = ACCELERATION[planner.surface]
+        max_speed = tank.left_motor.max_speed
+        start = (tank.left_motor.position, tank.right_motor.position)
+        rate = planner.min_speed
+        begun = 0
+        previous = None
+        for index, segment in enumerate(chain):
+            last = index == len(chain) - 1
+            cruise = segment.speed / 100 * max_speed
+            # Segments asked to run slower than min_speed run at their own speed, as in drive().
+            floor = min(planner.min_speed, cruise)
+            if segment.until is not None:
+                if previous is None or previous.until is None or previous.channel != segment.channel:
+                    # Only readings taken during the segment count, as in skip_white.
+                    seq = self.hub.seq(segment.channel)
+                    pending = []
+            while True:
+                travelled = planner.travelled(start) - begun
+                if segment.until is not None:
+                    samples, seq = self.hub.fetch(segment.channel, seq)
+                    pending += samples
+                    hit = next((i for i, (_, value) in enumerate(pending) if segment.until(value)),
+                               None)
+                    if hit is not None:
+                        # Later readings are left for the next segment to look at.
+                        pending = pending[hit + 1:]
+                        break
+                    pending = []
+                elif travelled >= segment.degrees - (planner.settle if last else 0):
+                    break
+                rate = min(cruise, rate + accel * planner.period)
+                if segment.until is None and last:
+                    # Brake in time to creep the last few degrees, as MotionPlanner.drive does.
+                    left_to_go = max(segment.degrees - planner.settle - travelled, 0)
+                    rate = min(rate, math.sqrt(floor ** 2 + 2 * accel * left_to_go))
+                rate = max(floor, rate)
+                tank.on(SpeedDPS(segment.left * rate), SpeedDPS(segment.right * rate))
+                time.sleep(planner.period)
+                if planner.profiler is not None:
+                    planner.profiler.tick('queue')
+            if not last:
+                # A stop here would have cost braking and getting back up to speed.
+                self.blends += 1
+                self.saved += rate / accel
+                if segment.until is None:
+                    self.saved += planner.settle / floor
+                    begun += segment.degrees
+                else:
+                    begun += travelled
+            previous = segment
+        if chain[-1].until is None and chain[-1].degrees > travelled:
+            tank.on_for_degrees(SpeedDPS(chain[-1].left * floor), SpeedDPS(chain[-1].right * floor),
+                                chain[-1].degrees - travelled)
+        else:
+            tank.off()
+
+    def report(self):
+        """Summarize the stops saved by blending.
+
+        :return: One-line report.
+        """
+        return "motion queue: {} stops blended, about {:.1f} s saved".format(self.blends, self.saved)
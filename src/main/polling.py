@@ -0,0 +1,81 @@
+"""Color sensor polling paced by where the next tile edge can be.
+
+Driving along the row, the color sensor crosses an edge every tile_length
+wheel degrees: onto a tile, off it into the gap, onto the next one. In
+between nothing can change, so reading the sensor a hundred times a second
+there only burns CPU. Once the robot knows where a tile started, EdgeSchedule
+reads slowly until the encoders say the next edge is near, then as fast as
+the sensor allows until it is past.
+
+Whenever the encoders cannot predict the next edge it reads at the normal
+rate: before the first tile, while the robot turns or stands still, when it
+reverses, and once it is further from the last tile than the next one
+should be.
+"""
+
+
+class EdgeSchedule:
+    """Decides when the color sensor is next read; pass it to SensorHub.add as schedule.
+
+    :param odometry: Odometry whose motion gives the wheel positions and speeds.
+    :param spacing: Wheel degrees between edges along the row.
+    :param window: Wheel degrees either side of an expected edge to read fast in.
+    :param fast: Seconds between reads near an expected edge.
+    :param normal: Seconds between reads when no edge can be predicted.
+    :param slow: Most seconds between reads away from the edges.
+    :param min_speed: Wheel degrees per second below which the robot is standing still.
+    :param max_spin: Change in wheel difference per second above which the
+        robot is turning rather than driving along the row.
+    :param profiler: Profiler that counts the reads at each pace, if any.
+    """
+    def __init__(self, odometry, spacing, window=50, fast=0.005, normal=0.01, slow=0.05,
+                 min_speed=30, max_spin=60, profiler=None):
+        self.odometry = odometry
+        self.spacing = spacing
+        self.window = window
+        self.fast = fast
+        self.normal = normal
+        self.slow = slow
+        self.min_speed = min_speed
+        self.max_spin = max_spin
+        self.profiler = profiler
+        self.reset()
+
+    def reset(self):
+        """Forget the last edge, reading at the normal rate until the next one.
+        """
+        self.edge_at = None
+
+    def edge(self, position):
+        """Record the sensor reaching a tile along the row.
+
+        :param position: Mean wheel position at the edge, in degrees.
+        """
+        self.edge_at = position
+
+    def __call__(self, value):
+        """Return how long to wait before the next read.
+
+        :param value: The reading just taken.
+        :return: Seconds.
+        """
+        motion = self.odometry.motion
+        if (self.edge_at is None or motion is None or motion.forward < self.min_speed
+                or abs(motion.spin) > self.max_spin):
+            return self._pace('normal', self.normal)
+        travelled = motion.position - self.edge_at
+        if travelled < 0:
+            return self._pace('normal', self.normal)
+        # The white edge comes one spacing after the tile's, the next tile one after that.
+        for expected in (self.spacing, 2 * self.spacing):
+            if travelled < expected + self.window:
+                ahead = expected - self.window - travelled
+                if ahead <= 0:
+                    return self._pace('fast', self.fast)
+                return self._pace('slow', min(self.slow, max(self.fast, ahead / motion.forward)))
+        return self._pace('normal', self.normal)
+
+    def _pace(self, name, seconds):
+        if self.profiler is not None:
+            self.profiler.tick('poll ' + name)
+        return seconds
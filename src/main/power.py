@@ -0,0 +1,188 @@
+"""Battery voltage and current, and laps that drive the same as the battery runs down.
+
+The drive motors run under speed regulation, so any speed the battery can
+deliver is held whatever the voltage. What changes as it runs down is the
+fastest they can go, roughly in proportion to the voltage at the brick,
+which sags further under load. Asked for more than that, the wheels turn
+slower than the planner and the gain tables expect: moves take longer,
+ramps end late, and distances and turns calibrated at one speed are driven
+at another, so a lap on a part-drained battery is not the lap on a fresh one.
+The motors' torque falls with the voltage too, so they speed up and slow
+down less hard, and the wheels slip less wherever nothing else limits the
+acceleration.
+
+PowerMonitor is sampled on the sensor hub and caps every speed sent to the
+wheels at what they can reach off reference volts, or off the measured
+voltage once it is lower still, and the acceleration likewise, through the
+motors' own ramp times. With the caps the robot drives the wheels the same
+off 8.2 V as off 7.0 V, so it drives the same lap on both, and the gain
+tables are looked up at the speed the wheels really turn at.
+CompensatedTank applies the caps to a MoveTank.
+"""
+import math
+
+from ev3dev2.motor import SpeedDPS
+
+from recorder import native_speed
+
+# Voltage a charged battery measures, off which the motors reach their max_speed
+FULL_VOLTS = 8.2
+
+# A 7.0 V battery as the brick measures it with both motors at full speed
+REFERENCE_VOLTS = 6.8
+
+# Hardest a Large Motor speeds up off FULL_VOLTS, in degrees per second squared
+ACCELERATION = 6000
+
+
+class PowerMonitor:
+    """Tracks the battery and works out the fastest speed to ask for.
+
+    :param supply: ev3dev2.power.PowerSupply of the brick.
+    :param reference: Lowest voltage laps should drive the same down to, or
+        None to pass speeds through unchanged.
+    :param full: Voltage off which the motors reach their max_speed.
+    :param acceleration: Hardest the motors speed up off full volts, in
+        degrees per second squared.
+    :param smoothing: Weight of each new voltage reading in the running average.
+    """
+    def __init__(self, supply, reference=REFERENCE_VOLTS, full=FULL_VOLTS,
+                 acceleration=ACCELERATION, smoothing=0.3):
+        self.supply = supply
+        self.reference = reference
+        self.full = full
+        self.acceleration = acceleration
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        """Forget the readings so far.
+        """
+        self.volts = None
+        self.amps = None
+        self.first_volts = None
+        self.min_volts = None
+        self.amp_sum = 0.0
+        self.amp_count = 0
+
+    def read_volts(self):
+        """Read the battery voltage; pass it to SensorHub.add as read.
+
+        :return: Volts at the brick.
+        """
+        volts = self.supply.measured_volts
+        if self.volts is None:
+            self.volts = self.first_volts = self.min_volts = volts
+        else:
+            self.volts += self.smoothing * (volts - self.volts)
+            self.min_volts = min(self.min_volts, volts)
+        return volts
+
+    def read_amps(self):
+        """Read the battery current; pass it to SensorHub.add as read.
+
+        :return: Amps drawn from the battery.
+        """
+        self.amps = self.supply.measured_amps
+        self.amp_sum += self.amps
+        self.amp_count += 1
+        return self.amps
+
+    @property
+    def share(self):
+        """Share of the motors' max_speed and acceleration to ask for at most.
+        """
+        if self.reference is None:
+            return 1.0
+        volts = self.reference if self.volts is None else min(self.volts, self.reference)
+        return min(1.0, volts / self.full)
+
+    def effective(self, speed):
+        """Return the speed the wheels turn at when asked for one.
+
+        :param speed: Percentage of max_speed.
+        :return: Percentage, no faster than share allows.
+        """
+        return math.copysign(min(abs(speed), 100 * self.share), speed)
+
+    def ramp(self, motor):
+        """Return the ramp time that holds a motor to the acceleration cap.
+
+        :param motor: Motor to set ramp_up_sp and ramp_down_sp of.
+        :return: Milliseconds from standstill to max_speed, 0 for no ramp.
+        """
+        if self.reference is None:
+            return 0
+        return int(round(1000 * motor.max_speed / (self.share * self.acceleration)))
+
+    def limit(self, left_speed, right_speed, motor):
+        """Scale a pair of wheel speeds down to the cap together, keeping their ratio.
+
+        :param left_speed: Percentage or SpeedValue for the left wheel.
+        :param right_speed: Percentage or SpeedValue for the right wheel.
+        :param motor: Motor whose max_speed the cap is a share of.
+        :return: (left, right) as SpeedDPS.
+        """
+        left = native_speed(left_speed, motor)
+        right = native_speed(right_speed, motor)
+        fastest = max(abs(left), abs(right))
+        cap = self.share * motor.max_speed
+        if fastest > cap:
+            left *= cap / fastest
+            right *= cap / fastest
+        return SpeedDPS(left), SpeedDPS(right)
+
+    def report(self):
+        """Summarize the battery over the readings so far.
+
+        :return: Printable text.
+        """
+        if self.volts is None:
+            return "battery: not read"
+        text = "battery: {:.2f} V at the start, {:.2f} V now, {:.2f} V lowest".format(
+            self.first_volts, self.volts, self.min_volts)
+        if self.amp_count:
+            text += ", {:.2f} A on average".format(self.amp_sum / self.amp_count)
+        return text
+
+
+class CompensatedTank:
+    """MoveTank that never asks the wheels for more than the battery can deliver.
+
+    on() and on_for_degrees() speeds are capped by the monitor, and the
+    motors' ramp times are set to its acceleration cap whenever that
+    changes; everything else is passed straight through to the wrapped tank.
+
+    :param tank: MoveTank to drive.
+    :param monitor: PowerMonitor giving the cap.
+    """
+    def __init__(self, tank, monitor):
+        self._tank = tank
+        self._power = monitor
+        self.left_motor = tank.left_motor
+        self.right_motor = tank.right_motor
+        self._ramp = None
+
+    def __getattr__(self, name):
+        return getattr(self._tank, name)
+
+    def on(self, left_speed, right_speed):
+        left, right = self._limit(left_speed, right_speed)
+        self._tank.on(left, right)
+
+    def on_for_degrees(self, left_speed, right_speed, degrees, brake=True, block=True):
+        left, right = self._limit(left_speed, right_speed)
+        self._tank.on_for_degrees(left, right, degrees, brake=brake, block=block)
+
+    def off(self, motors=None, brake=True):
+        self._tank.off(motors=motors, brake=brake)
+
+    def _limit(self, left_speed, right_speed):
+        ramp = self._power.ramp(self.left_motor)
+        if ramp != self._ramp:
+            # Only written on a change, as each write goes through sysfs
+            for motor in (self.left_motor, self.right_motor):
+                motor.ramp_up_sp = ramp
+                motor.ramp_down_sp = ramp
+            self._ramp = ramp
+        return self._power.limit(left_speed, right_speed, self.left_motor)
@@ -0,0 +1,215 @@
+"""Timings of run phases, repeated calls, sensor reads and control loops.
+
+A Profiler collects three kinds of measurement:
+
+- durations of phases such as initialize_start, or of each call of
+  something repeated such as a tower sweep, either with the phase() context
+  manager, the timed decorator, or split() for intervals like one tile;
+- latency histograms, e.g. how long each color sensor read took;
+- loop iterations, counted with tick() and turned into a rate using the
+  time spent in the phase of the same name.
+
+summary() formats everything as a table for the end of a run, and save()
+writes it as JSON.
+"""
+import functools
+import json
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+class Histogram:
+    """Counts of durations in fixed buckets, plus their total and maximum.
+
+    :param bounds: Upper bound of each bucket in seconds; longer durations
+        go in an extra overflow bucket.
+    """
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = array('L', [0]) * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Count a duration.
+
+        :param seconds: Duration.
+        """
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding a quantile.
+
+        :param q: Quantile from 0 to 1.
+        :return: Seconds; the maximum if the quantile is in the overflow bucket.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        """Return the histogram for JSON.
+
+        :return: Dict of count, mean, max and bucket counts keyed by upper bound.
+        """
+        buckets = {"{:g}".format(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max, 'buckets': buckets}
+
+
+class Profiler:
+    """Collects timings during a run.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.histograms = {}
+        self.ticks = {}
+        self._marks = {}
+        self._start = time.monotonic()
+
+    def record(self, name, seconds):
+        """Record one duration of a phase.
+
+        :param name: Phase name.
+        :param seconds: Duration.
+        """
+        durations = self.phases.get(name)
+        if durations is None:
+            durations = self.phases[name] = array('d')
+        durations.append(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as one call of a phase.
+
+        :param name: Phase name.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def mark(self, name):
+        """Start the interval that the next split() of a name ends.
+
+        :param name: Phase name.
+        """
+        self._marks[name] = time.monotonic()
+
+    def split(self, name):
+        """Record the time since the last mark() or split() of a name, and start again.
+
+        :param name: Phase name.
+        """
+        now = time.monotonic()
+        start = self._marks.get(name)
+        if start is not None:
+            self.record(name, now - start)
+        self._marks[name] = now
+
+    def observe(self, name, seconds):
+        """Add a duration to a latency histogram.
+
+        :param name: Histogram name, e.g. 'color read'.
+        :param seconds: Duration.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def tick(self, name):
+        """Count one iteration of a loop.
+
+        :param name: Loop name; time it as a phase of the same name to get a rate.
+        """
+        self.ticks[name] = self.ticks.get(name, 0) + 1
+
+    def rate(self, name):
+        """Return the iterations per second of a loop.
+
+        :param name: Loop name.
+        :return: Rate over the time spent in the phase of the same name, or
+            over the whole run if there is no such phase.
+        """
+        durations = self.phases.get(name)
+        seconds = sum(durations) if durations else time.monotonic() - self._start
+        return self.ticks.get(name, 0) / seconds if seconds else 0.0
+
+    def to_dict(self):
+        """Return everything measured, for JSON.
+
+        :return: Dict of wall time, phases, latency histograms and loops.
+        """
+        return {
+            'wall': time.monotonic() - self._start,
+            'phases': {name: {'calls': len(durations), 'total': sum(durations),
+                              'max': max(durations), 'durations': list(durations)}
+                       for name, durations in self.phases.items()},
+            'latency': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            'loops': {name: {'iterations': count, 'rate': self.rate(name)}
+                      for name, count in self.ticks.items()},
+        }
+
+    def save(self, path):
+        """Write everything measured to a JSON file.
+
+        :param path: File to write.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def summary(self):
+        """Format everything measured as tables.
+
+        :return: Multi-line report.
+        """
+        lines = ["profile: {:.1f} s".format(time.monotonic() - self._start)]
+        if self.phases:
+            lines.append("  {:<20} {:>6} {:>9} {:>9} {:>9}".format(
+                "phase", "calls", "total s", "mean s", "max s"))
+            for name, durations in self.phases.items():
+                total = sum(durations)
+                lines.append("  {:<20} {:6d} {:9.2f} {:9.3f} {:9.3f}".format(
+                    name, len(durations), total, total / len(durations), max(durations)))
+        if self.histograms:
+            lines.append("  {:<20} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+                "latency", "count", "mean ms", "p50 ms", "p99 ms", "max ms"))
+            for name, histogram in self.histograms.items():
+                lines.append("  {:<20} {:6d} {:9.2f} {:9.2f} {:9.2f} {:9.2f}".format(
+                    name, histogram.count, 1000 * histogram.total / histogram.count,
+                    1000 * histogram.quantile(0.5), 1000 * histogram.quantile(0.99),
+                    1000 * histogram.max))
+        if self.ticks:
+            lines.append("  {:<20} {:>6} {:>9}".format("loop", "iters", "per s"))
+            for name, count in self.ticks.items():
+                lines.append("  {:<20} {:6d} {:9.1f}".format(name, count, self.rate(name)))
+        return "\n".join(lines)
+
+
+def timed(method):
+    """Decorate a Robot method so each call is timed as a phase of its name.
+
+    The object must have a Profiler in its ``profile`` attribute.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.profile.phase(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
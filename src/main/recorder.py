@@ -0,0 +1,264 @@
+"""Compact binary traces of sensor readings and motor commands.
+
+Every event is stored in preallocated arrays used as a ring buffer, so
+recording costs a few array stores and memory stays bounded however long
+the robot runs: once full, the oldest events are overwritten. The buffer is
+written out in one go when the run ends.
+
+A trace file is a header followed by the event columns:
+
+    magic     8 bytes, b'EV3TRACE'
+    header    version, byte order (0 little, 1 big), number of names,
+              number of events, number of events overwritten ('<BBHII')
+    names     for each name, its length in one byte and its UTF-8 bytes
+    times     float64 per event, time.monotonic() seconds
+    kinds     uint8 per event, SENSOR, COMMAND or SETTING
+    codes     uint8 per event, index into the names
+    values    three float32 per event
+
+A sensor event's first value is the reading. A command event's values are
+its arguments, with speeds converted to degrees per second. A setting
+event holds a value the run used that did not come from a sensor, such as
+cached calibration, so a replay can use it too.
+"""
+import os
+import struct
+import sys
+import time
+from array import array
+from threading import Lock
+
+MAGIC = b'EV3TRACE'
+VERSION = 1
+HEADER = struct.Struct('<BBHII')
+
+SENSOR = 0
+COMMAND = 1
+SETTING = 2
+
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+
+
+class TraceRecorder:
+    """Ring buffer of timestamped events.
+
+    Events can be recorded from any thread.
+
+    :param size: Number of events to keep.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.kinds = array('B', [0]) * size
+        self.codes = array('B', [0]) * size
+        self.values = array('f', [0.0]) * (3 * size)
+        self.names = []
+        self._codes = {}
+        self.count = 0
+        # Events overwritten before the ones loaded from a file
+        self.dropped = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def code(self, name):
+        """Return the number events with a name are stored under.
+
+        :param name: Channel or command name.
+        :return: Code from 0 to 255.
+        """
+        code = self._codes.get(name)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(name)
+                if code is None:
+                    if len(self.names) > 255:
+                        raise ValueError("too many names in trace")
+                    code = self._codes[name] = len(self.names)
+                    self.names.append(name)
+        return code
+
+    def record(self, t, kind, name, a=0.0, b=0.0, c=0.0):
+        """Add an event, overwriting the oldest once full.
+
+        :param t: Time of the event.
+        :param kind: SENSOR, COMMAND or SETTING.
+        :param name: Channel or command name.
+        :param a: First value.
+        :param b: Second value.
+        :param c: Third value.
+        """
+        code = self.code(name)
+        with self._lock:
+            i = self.count % self.size
+            self.count += 1
+            self.times[i] = t
+            self.kinds[i] = kind
+            self.codes[i] = code
+            i *= 3
+            self.values[i] = a
+            self.values[i + 1] = b
+            self.values[i + 2] = c
+
+    def sensor(self, name, value, t=None):
+        """Record a sensor reading.
+
+        :param name: Channel name.
+        :param value: Reading.
+        :param t: Time of the reading; now if not given.
+        """
+        self.record(time.monotonic() if t is None else t, SENSOR, name, value)
+
+    def command(self, name, a=0.0, b=0.0, c=0.0):
+        """Record a motor command as it is issued.
+
+        :param name: Command name, e.g. 'on'.
+        :param a: First argument.
+        :param b: Second argument.
+        :param c: Third argument.
+        """
+        self.record(time.monotonic(), COMMAND, name, a, b, c)
+
+    def setting(self, name, a=0.0, b=0.0, c=0.0):
+        """Record a value the run used that a replay cannot read off the sensors.
+
+        :param name: What the values are, e.g. 'thresholds:default/40'.
+        :param a: First value.
+        :param b: Second value.
+        :param c: Third value.
+        """
+        self.record(time.monotonic(), SETTING, name, a, b, c)
+
+    def events(self):
+        """Yield the kept events, oldest first.
+
+        :return: Iterator of (time, kind, name, a, b, c).
+        """
+        for i in range(self.count - len(self), self.count):
+            j = i % self.size
+            yield (self.times[j], self.kinds[j], self.names[self.codes[j]],
+                   self.values[3 * j], self.values[3 * j + 1], self.values[3 * j + 2])
+
+    def flush(self, path):
+        """Write the kept events to a file.
+
+        :param path: File to write.
+        :return: The path.
+        """
+        with self._lock:
+            count = len(self)
+            first = (self.count - count) % self.size
+
+            def ordered(column, width=1):
+                # Unroll the ring so the file is oldest first.
+                start, end = first * width, (first + count) * width
+                if first + count <= self.size:
+                    return column[start:end]
+                return column[start:] + column[:end - self.size * width]
+
+            columns = [ordered(self.times), ordered(self.kinds), ordered(self.codes),
+                       ordered(self.values, 3)]
+            names = list(self.names)
+            dropped = self.dropped + self.count - count
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(VERSION, sys.byteorder == 'big', len(names), count, dropped))
+            for name in names:
+                encoded = name.encode('utf-8')
+                f.write(bytes([len(encoded)]) + encoded)
+            for column in columns:
+                column.tofile(f)
+        return path
+
+
+def load(path):
+    """Read a trace file.
+
+    :param path: File written by TraceRecorder.flush().
+    :return: TraceRecorder holding exactly the events in the file.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a trace file".format(path))
+        version, big, name_count, count, dropped = HEADER.unpack(f.read(HEADER.size))
+        if version != VERSION:
+            raise ValueError("unsupported trace version {}".format(version))
+        recorder = TraceRecorder(max(count, 1))
+        for _ in range(name_count):
+            recorder.code(f.read(f.read(1)[0]).decode('utf-8'))
+        columns = [array('d'), array('B'), array('B'), array('f')]
+        for column, length in zip(columns, (count, count, count, 3 * count)):
+            column.fromfile(f, length)
+            if big != (sys.byteorder == 'big'):
+                column.byteswap()
+    if count:
+        recorder.times, recorder.kinds, recorder.codes, recorder.values = columns
+    recorder.count = count
+    recorder.dropped = dropped
+    return recorder
+
+
+def new_path(directory=TRACE_DIR, keep=20):
+    """Return a fresh file name for a trace, deleting all but the newest old ones.
+
+    :param directory: Folder traces are kept in; created if missing.
+    :param keep: Number of old traces to keep.
+    :return: Path named after the current date and time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    old = sorted(name for name in os.listdir(directory) if name.endswith('.trace'))
+    for name in old[:max(len(old) - keep, 0)]:
+        os.remove(os.path.join(directory, name))
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(directory, stamp + '.trace')
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(directory, '{}-{}.trace'.format(stamp, n))
+    return path
+
+
+def native_speed(speed, motor):
+    """Convert a speed as MoveTank takes it to degrees per second.
+
+    :param speed: Percentage, or a SpeedValue such as SpeedDPS.
+    :param motor: Motor the speed is for.
+    :return: Degrees per second.
+    """
+    if hasattr(speed, 'to_native_units'):
+        return speed.to_native_units(motor)
+    return speed / 100 * motor.max_speed
+
+
+class TracedTank:
+    """MoveTank that records the commands it is given.
+
+    on(), on_for_degrees() and off() are recorded; everything else is passed
+    straight through to the wrapped tank.
+
+    :param tank: MoveTank to drive.
+    :param recorder: TraceRecorder to record into.
+    """
+    def __init__(self, tank, recorder):
+        self._tank = tank
+        self._trace = recorder
+        self.left_motor = tank.left_motor
+        self.right_motor = tank.right_motor
+
+    def __getattr__(self, name):
+        return getattr(self._tank, name)
+
+    def on(self, left_speed, right_speed):
+        self._trace.command('on', native_speed(left_speed, self.left_motor),
+                            native_speed(right_speed, self.right_motor))
+        self._tank.on(left_speed, right_speed)
+
+    def on_for_degrees(self, left_speed, right_speed, degrees, brake=True, block=True):
+        self._trace.command('on_for_degrees', native_speed(left_speed, self.left_motor),
+                            native_speed(right_speed, self.right_motor), degrees)
+        self._tank.on_for_degrees(left_speed, right_speed, degrees, brake=brake, block=block)
+
+    def off(self, motors=None, brake=True):
+        self._trace.command('off')
+        self._tank.off(motors=motors, brake=brake)
@@ -0,0 +1,174 @@
+"""Reflectance profiles recorded as the color sensor sweeps across an edge.
+
+The color sensor sits sensor_dist ahead of the axle, so turning on the spot
+swings it along an arc. With the sensor just past the leading edge of a
+tile, the arc dips into the tile around the robot's heading and leaves it
+again on either side. The two crossings are symmetric about the direction
+square to the edge, so the middle of the dark stretch is how far the robot
+is turned away from the row, to a fraction of a degree and whatever the
+sensor's exact distance past the edge.
+
+Edges are placed where the profile crosses halfway between its own dark and
+light levels. A straight line is fitted through the samples on each edge's
+slope, as the light spot blurs it over several samples, and the crossing is
+taken from the line rather than from the nearest two samples, unless noise
+leaves the line flat or sloping the wrong way. NumPy does the fitting if it
+is installed; otherwise it falls back to plain Python.
+"""
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def interpolate(times, values, at):
+    """Interpolate a series at some times, holding the ends.
+
+    :param times: Increasing times of the series.
+    :param values: Values of the series.
+    :param at: Times to interpolate at, increasing.
+    :return: List of interpolated values.
+    """
+    if numpy is not None:
+        return numpy.interp(at, times, values).tolist()
+    result = []
+    i = 0
+    for t in at:
+        while i + 1 < len(times) and times[i + 1] < t:
+            i += 1
+        if t <= times[0] or i + 1 == len(times):
+            result.append(values[0] if t <= times[0] else values[-1])
+        else:
+            t0, t1 = times[i], times[i + 1]
+            share = (t - t0) / (t1 - t0) if t1 > t0 else 0.0
+            result.append(values[i] + share * (values[i + 1] - values[i]))
+    return result
+
+
+def _levels(values, share=0.1):
+    ordered = sorted(values)
+    k = max(1, int(len(ordered) * share))
+    return sum(ordered[:k]) / k, sum(ordered[-k:]) / k
+
+
+def _fit_crossing(angles, values, threshold, direction):
+    # Least-squares line through the samples, solved for where it meets the
+    # threshold; None if the line is flat or slopes the wrong way, as noise
+    # on a short slope can make it.
+    n = len(angles)
+    if numpy is not None:
+        a = numpy.asarray(angles, dtype=float)
+        v = numpy.asarray(values, dtype=float)
+        mean_a, mean_v = float(a.mean()), float(v.mean())
+        covariance = float(((a - mean_a) * (v - mean_v)).sum())
+        variance = float(((a - mean_a) ** 2).sum())
+    else:
+        mean_a = sum(angles) / n
+        mean_v = sum(values) / n
+        covariance = sum((a - mean_a) * (v - mean_v) for a, v in zip(angles, values))
+        variance = sum((a - mean_a) ** 2 for a in angles)
+    if variance == 0 or covariance * direction <= 0:
+        return None
+    return mean_a + (threshold - mean_v) * variance / covariance
+
+
+def _slope(values, i, low, high, step):
+    # Extend from sample i along the slope for as long as readings stay between the levels.
+    j = i
+    while 0 <= j + step < len(values) and low < values[j + step] < high:
+        j += step
+    return j
+
+
+class Profile:
+    """Color readings taken during one turn, against the robot angle.
+
+    Angles are in robot degrees from where the sweep started, positive
+    clockwise as in Robot.turn().
+    """
+    def __init__(self):
+        self.angles = array("f")
+        self.values = array("f")
+
+    def __len__(self):
+        return len(self.angles)
+
+    def add(self, angle, value):
+        """Record a reading.
+
+        :param angle: Robot angle when the reading was taken.
+        :param value: Reflected light intensity.
+        """
+        self.angles.append(angle)
+        self.values.append(value)
+
+    def levels(self):
+        """Return the dark and light levels of the profile.
+
+        :return: (dark, light), the means of the darkest and lightest tenth of the readings.
+        """
+        return _levels(self.values)
+
+    def crossings(self, threshold=None, contrast=15):
+        """Find where the profile crosses between dark and light.
+
+        :param threshold: Reading between the two colors; halfway between the
+            profile's own levels if None.
+        :param contrast: Least difference between the levels for there to be
+            any edge at all.
+        :return: List of (angle, direction) in the order they were swept,
+            where direction is -1 going onto dark and 1 going onto light.
+        """
+        if len(self) < 2:
+            return []
+        dark, light = self.levels()
+        if light - dark < contrast:
+            return []
+        if threshold is None:
+            threshold = (dark + light) / 2
+        angles, values = self.angles, self.values
+        if numpy is not None:
+            above = numpy.asarray(values) > threshold
+            changes = numpy.flatnonzero(above[1:] != above[:-1]).tolist()
+        else:
+            changes = [i for i in range(len(values) - 1)
+                       if (values[i] > threshold) != (values[i + 1] > threshold)]
+        # Only fit the readings well clear of both levels, which are on the slope.
+        low = dark + 0.2 * (light - dark)
+        high = light - 0.2 * (light - dark)
+        result = []
+        for i in changes:
+            first = _slope(values, i, low, high, -1)
+            last = _slope(values, i + 1, low, high, 1)
+            direction = 1 if values[i + 1] > threshold else -1
+            angle = None
+            if last - first >= 2:
+                # Readings rise with the angle going onto light if the sweep turns clockwise.
+                turning = 1 if angles[last] > angles[first] else -1
+                angle = _fit_crossing(angles[first:last + 1], values[first:last + 1], threshold,
+                                      direction * turning)
+            if angle is not None:
+                # A fit thrown off by noise must still land between its samples.
+                angle = min(max(angle, min(angles[first], angles[last])),
+                            max(angles[first], angles[last]))
+            else:
+                v0, v1 = values[i], values[i + 1]
+                angle = angles[i] + (threshold - v0) / (v1 - v0) * (angles[i + 1] - angles[i])
+            result.append((angle, direction))
+        return result
+
+    def dark_span(self, threshold=None, contrast=15):
+        """Return where the longest dark stretch with light on both sides starts and ends.
+
+        :param threshold: Reading between the two colors; see crossings().
+        :param contrast: Least difference between the levels; see crossings().
+        :return: (start angle, end angle), or None if there is no such stretch.
+        """
+        crossings = self.crossings(threshold, contrast)
+        best = None
+        for (start, into), (end, out) in zip(crossings, crossings[1:]):
+            if into < 0 < out and (best is None or abs(end - start) > abs(best[1] - best[0])):
+                best = start, end
+        return best
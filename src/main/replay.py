@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""Replay recorded traces through the Robot code and diff the motor commands.
+
+The Robot runs in the simulator, but its color and ultrasonic sensors read
+back the samples from a trace recorded by recorder.py instead of the
+simulated course. The motor commands it gives are compared with the ones in
+the trace, so a change to the counting or alignment logic can be checked
+against a library of laps in a few seconds each.
+
+Motors and encoders are still simulated. Calibration and the course map
+the lap loaded from their caches are recorded in the trace and handed back
+to the Robot in cache files of the replay's own, so what is cached here by
+now makes no difference, and a lap that steered from mapped tile to tile
+does so again. The trace also says which way the lap counted the tiles,
+and a replay that counts another way does not match. A trace replayed
+under the code that recorded it in the simulator gives exactly the same
+commands; a trace from the brick is best compared by its decisions: which
+command was given and which way it turned each wheel, with repeats
+collapsed.
+
+Usage::
+
+    python3 replay.py traces/*.trace
+    python3 replay.py --variant asyncRobot.py --robot AsyncRobot traces/lap.trace
+"""
+import argparse
+import bisect
+import contextlib
+import io
+import os
+import tempfile
+from array import array
+# By name, so the simulator does not swap it for the virtual clock
+from time import perf_counter
+
+import calibration
+import coursemap
+import recorder
+import simulator
+
+
+class ReplayWorld(simulator.World):
+    """World whose sensors read back a trace instead of the course.
+
+    Time is measured from the run's ambient light reading, in the trace and
+    in the replay, and each read returns the recorded sample nearest in time.
+
+    :param trace: TraceRecorder holding the recorded lap, e.g. from recorder.load().
+    :param max_time: Virtual seconds before the replay is abandoned.
+    """
+    def __init__(self, trace, max_time=600.0):
+        super().__init__(max_time=max_time)
+        self.readings = {}
+        for t, kind, name, value, _, _ in trace.events():
+            if kind == recorder.SENSOR:
+                times, values = self.readings.setdefault(name, (array('d'), array('f')))
+                times.append(t)
+                values.append(value)
+        if 'ambient' in self.readings:
+            self.recorded_start = self.readings['ambient'][0][0]
+        else:
+            self.recorded_start = next(trace.events())[0]
+        self.replay_start = None
+
+    def reading(self, name):
+        """Return the recorded sample on a channel nearest to now.
+
+        :param name: Channel name in the trace.
+        :return: Recorded value.
+        """
+        if self.replay_start is None:
+            self.replay_start = self.clock.now
+        if name not in self.readings:
+            raise ValueError("trace has no {!r} readings".format(name))
+        times, values = self.readings[name]
+        t = self.recorded_start + self.clock.now - self.replay_start
+        i = bisect.bisect_left(times, t)
+        if i == len(times) or (i > 0 and t - times[i - 1] < times[i] - t):
+            i -= 1
+        return values[i]
+
+    def reflected_light(self):
+        return int(self.reading('color'))
+
+    def ambient_light(self):
+        return int(self.reading('ambient'))
+
+    def ultrasonic_distance(self, beam=15.0):
+        return round(self.reading('distance'), 1)
+
+    def battery_volts(self):
+        # Traces recorded before the battery was sampled replay on a simulated one.
+        if 'battery' not in self.readings:
+            return super().battery_volts()
+        return round(self.reading('battery'), 3)
+
+    def battery_amps(self):
+        if 'current' not in self.readings:
+            return super().battery_amps()
+        return round(self.reading('current'), 3)
+
+
+def save_calibration(trace, path):
+    """Write the calibration a trace's lap loaded from its cache to a cache file.
+
+    :param trace: TraceRecorder.
+    :param path: Cache file to write; thresholds the lap measured are left
+        out, so the replay measures them from the recorded readings again.
+    """
+    gains = {}
+    for _, kind, name, a, b, c in trace.events():
+        if kind != recorder.SETTING:
+            continue
+        what, _, key = name.partition(':')
+        if what == 'thresholds':
+            # Values are stored as float32; the band is a short decimal.
+            calibration.save(key, calibration.Thresholds(a, b, round(c, 6)), path)
+        elif what == 'gains':
+            gains.setdefault(key, {})[a] = b
+        elif what == 'pid':
+            calibration.save_pid(key, (a, b, c), path)
+    for key, points in gains.items():
+        calibration.save_gains(key, calibration.GainTable(points), path)
+
+
+def save_map(trace, path):
+    """Write the course map a trace's lap loaded from its cache to a cache file.
+
+    :param trace: TraceRecorder.
+    :param path: Cache file to write; left alone if the lap had no map.
+    """
+    maps = {}
+    for _, kind, name, a, b, c in trace.events():
+        if kind != recorder.SETTING:
+            continue
+        what, _, board = name.partition(':')
+        if what == 'map':
+            maps[board] = coursemap.CourseMap(cell=a)
+            maps[board].runs = int(b)
+        elif what == 'map-tile':
+            maps[board].tiles[int(a)] = [b, c, 1]
+        elif what == 'map-tower':
+            maps[board].observe_tower(a, b)
+    for board, course_map in maps.items():
+        coursemap.save(board, course_map, path)
+
+
+def count_path(trace):
+    """Return which way a lap counted the tiles.
+
+    :param trace: TraceRecorder.
+    :return: 'probing', 'mapped', 'continuous' or 'follow', or None if the
+        trace does not say.
+    """
+    for _, kind, name, _, _, _ in trace.events():
+        if kind == recorder.SETTING and name.startswith('count:'):
+            return name.partition(':')[2]
+    return None
+
+
+def commands(trace, start):
+    """Return the motor commands in a trace.
+
+    :param trace: TraceRecorder.
+    :param start: Time to measure from.
+    :return: List of (time, name, a, b, c).
+    """
+    return [(t - start, name, a, b, c) for t, kind, name, a, b, c in trace.events()
+            if kind == recorder.COMMAND]
+
+
+def _sign(value):
+    return (value > 0) - (value < 0)
+
+
+def decisions(stream):
+    """Reduce commands to the choices behind them.
+
+    Each command becomes its name and the direction of each wheel, and runs
+    of the same decision, like the speed updates of one profiled move, are
+    collapsed into the first.
+
+    :param stream: List of (time, name, a, b, c) from commands().
+    :return: List of (time, name, left direction, right direction).
+    """
+    result = []
+    for t, name, a, b, _ in stream:
+        decision = (t, name, _sign(a), _sign(b))
+        if not result or result[-1][1:] != decision[1:]:
+            result.append(decision)
+    return result
+
+
+def first_difference(recorded, replayed, tolerance=5.0, time_tolerance=0.05):
+    """Return where two command streams stop matching.
+
+    :param recorded: Commands or decisions from the trace.
+    :param replayed: Commands or decisions from the replay.
+    :param tolerance: Largest difference in a speed or distance that still matches.
+    :param time_tolerance: Largest difference in seconds that still matches.
+    :return: Index of the first mismatch, or None if they match.
+    """
+    for i, (old, new) in enumerate(zip(recorded, replayed)):
+        if (abs(old[0] - new[0]) > time_tolerance or old[1] != new[1]
+                or any(abs(x - y) > tolerance for x, y in zip(old[2:], new[2:]))):
+            return i
+    if len(recorded) != len(replayed):
+        return min(len(recorded), len(replayed))
+    return None
+
+
+def _describe(entry):
+    if entry is None:
+        return "nothing"
+    return "{}({}) at {:.2f} s".format(entry[1], ", ".join("{:g}".format(x) for x in entry[2:]),
+                                       entry[0])
+
+
+class Replay:
+    """Outcome of replaying one trace.
+
+    :param path: Trace file.
+    :param recorded: Commands in the trace.
+    :param replayed: Commands the Robot gave in the replay.
+    :param lap: simulator.Lap of the replay.
+    :param tolerance: Largest difference in a speed or distance that still matches.
+    :param time_tolerance: Largest difference in seconds that still matches.
+    :param recorded_count: Way the recorded lap counted the tiles, from
+        count_path(); None for traces that do not say, which match either way.
+    :param replayed_count: Way the replay counted them.
+    """
+    def __init__(self, path, recorded, replayed, lap, tolerance=5.0, time_tolerance=0.05,
+                 recorded_count=None, replayed_count=None):
+        self.path = path
+        self.recorded = recorded
+        self.replayed = replayed
+        self.lap = lap
+        self.recorded_count = recorded_count
+        self.replayed_count = replayed_count
+        self.exact = first_difference(recorded, replayed, tolerance, time_tolerance)
+        self.recorded_decisions = decisions(recorded)
+        self.replayed_decisions = decisions(replayed)
+        # Decisions can come a little earlier or later without changing anything.
+        self.decision = first_difference(self.recorded_decisions, self.replayed_decisions,
+                                         tolerance, time_tolerance=1.0)
+
+    @property
+    def matches(self):
+        """Whether the replay made the same decisions as the recording.
+        """
+        return (self.decision is None and self.lap.error is None
+                and self.recorded_count in (None, self.replayed_count))
+
+    def __str__(self):
+        lines = ["{}: {} commands recorded, {} replayed in {:.2f} s{}".format(
+            os.path.basename(self.path), len(self.recorded), len(self.replayed),
+            self.lap.real_time,
+            "  ({})".format(type(self.lap.error).__name__) if self.lap.error else "")]
+        if self.recorded_count not in (None, self.replayed_count):
+            lines.append("  {:<9} recorded {}, replayed {}".format(
+                "counting", self.recorded_count, self.replayed_count))
+        for label, index, old, new in (
+                ("commands", self.exact, self.recorded, self.replayed),
+                ("decisions", self.decision, self.recorded_decisions, self.replayed_decisions)):
+            if index is None:
+                lines.append("  {:<9} identical".format(label))
+            else:
+                lines.append("  {:<9} differ at #{}: recorded {}, replayed {}".format(
+                    label, index, _describe(old[index] if index < len(old) else None),
+                    _describe(new[index] if index < len(new) else None)))
+        return "\n".join(lines)
+
+
+def replay(path, robot_class, method='run', tolerance=5.0, time_tolerance=0.05, margin=30.0):
+    """Run a Robot against a recorded trace.
+
+    :param path: Trace file.
+    :param robot_class: Robot class to construct.
+    :param method: Name of the method that recorded the trace.
+    :param tolerance: Largest difference in a speed or distance that still matches.
+    :param time_tolerance: Largest difference in seconds that still matches.
+    :param margin: Virtual seconds the replay may run past the end of the trace.
+    :return: A Replay.
+    """
+    trace = recorder.load(path)
+    world = ReplayWorld(trace)
+    end = trace.times[len(trace) - 1] if len(trace) else world.recorded_start
+    world.clock.max_time = end - world.recorded_start + margin
+    robots = []
+
+    with tempfile.TemporaryDirectory() as scratch:
+        calibration_file = os.path.join(scratch, 'calibration.json')
+        map_file = os.path.join(scratch, 'coursemap.json')
+        save_calibration(trace, calibration_file)
+        save_map(trace, map_file)
+
+        def configure(robot):
+            # The replay's own trace is only needed in memory.
+            robot.trace_dir = None
+            robot.calibration_file = calibration_file
+            robot.map_file = map_file
+            robots.append(robot)
+
+        lap = simulator.run_lap(robot_class, method=method, world=world, configure=configure)
+    replayed = []
+    replayed_count = None
+    if robots and world.replay_start is not None:
+        replayed = commands(robots[0].trace, world.replay_start)
+        replayed_count = count_path(robots[0].trace)
+    return Replay(path, commands(trace, world.recorded_start), replayed, lap,
+                  tolerance, time_tolerance, count_path(trace), replayed_count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traces and diff the motor commands.")
+    parser.add_argument("traces", nargs="+", help="trace files written by recorder.py")
+    parser.add_argument("--variant", default=os.path.join(os.path.dirname(__file__), "runRobot.py"),
+                        help="robot script to run")
+    parser.add_argument("--robot", default="Robot", help="name of the robot class in the script")
+    parser.add_argument("--method", default="run", help="method that recorded the traces")
+    parser.add_argument("--tolerance", type=float, default=5.0,
+                        help="largest difference in deg/s or degrees that still matches")
+    parser.add_argument("--verbose", action="store_true", help="show what the robot prints")
+    args = parser.parse_args()
+
+    simulator.install(simulator.World())
+    robot_class = getattr(simulator.load_variant(args.variant), args.robot)
+    start = perf_counter()
+    differing = 0
+    for path in args.traces:
+        if args.verbose:
+            result = replay(path, robot_class, args.method, args.tolerance)
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = replay(path, robot_class, args.method, args.tolerance)
+        differing += not result.matches
+        print(result)
+    print("{} traces replayed in {:.1f} s, {} with different decisions".format(
+        len(args.traces), perf_counter() - start, differing))
+    return 1 if differing else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
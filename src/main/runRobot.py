@@ -1,12 +1,32 @@
 #!/usr/bin/env python3
 import math
+import sys
 import time
-from threading import Thread
 
-from ev3dev2.motor import MoveTank, OUTPUT_B, OUTPUT_C
+from ev3dev2.motor import MoveSteering, MoveTank, OUTPUT_B, OUTPUT_C, SpeedDPS
+from ev3dev2.power import PowerSupply
 from ev3dev2.sensor.lego import ColorSensor, UltrasonicSensor
 from ev3dev2.sound import Sound
 
+import alignment
+from approach import TowerServo
+from audio import AudioWorker
+import calibration
+import coursemap
+from drift import DriftEstimator, edge_time
+from follow import EdgeFollower
+from odometry import Odometry
+from planner import MotionPlanner, MotionQueue
+from polling import EdgeSchedule
+from power import CompensatedTank, PowerMonitor
+from profiler import Profiler, timed
+import recorder
+from sampler import SensorHub
+from sweep import Sweep
+
+# Speed that distances in wheel degrees, like tile_length, were measured at
+REFERENCE_SPEED = 20
+
 
 class Robot:
     """Robot class structure for running a course.
@@ -15,26 +35,133 @@ class Robot:
     def __init__(self):
         """Initialize robot's sensors and define distances and color ranges.
         """
-        self.tank_pair = MoveTank(OUTPUT_B, OUTPUT_C)
+        # Sensor readings and motor commands are recorded here; see recorder.py
+        self.trace = recorder.TraceRecorder()
+        self.trace_dir = recorder.TRACE_DIR
+        # Speeds are capped so laps drive the same as the battery runs down; see power.py
+        self.power = PowerMonitor(PowerSupply())
+        self.tank_pair = CompensatedTank(recorder.TracedTank(MoveTank(OUTPUT_B, OUTPUT_C), self.trace),
+                                         self.power)
+        # Only used to work out wheel speeds for a steering value; see steer_on()
+        self.steer_pair = MoveSteering(OUTPUT_B, OUTPUT_C)
+        # Phase timings and sensor latencies, printed after a run and saved
+        # to profile_file if set; see profiler.py
+        self.profile = Profiler()
+        self.profile_file = None
+        # Ramps the wheels up and down; set planner.surface to match the board
+        self.planner = MotionPlanner(self.tank_pair, profiler=self.profile)
         self.color_sensor = ColorSensor()
         self.ultrasonic = UltrasonicSensor()
         self.sound = Sound()
+        # Tones are queued and played on a background thread from files
+        # rendered once; see audio.py
+        self.audio = AudioWorker(self.sound, profiler=self.profile)
+        self.audio.prepare(tones=[(100 + 50 * n, 0.5) for n in range(1, 16)] + [(400, 1)])
         self.tile_length = 200
         self.sensor_dist = 86
-        # Ranges for color intensities
+        # Side of a tile in cm, used to calibrate distances
+        self.tile_size = 10
+        # Ranges for color intensities, replaced by calibrate_colours()
         self.black_range = range(0, 30)
         self.white_range = range(30, 100)
+        # Thresholds are cached per board and lighting in this file
+        self.board = 'default'
+        self.calibration_file = calibration.CACHE
+        # Wheel degrees per robot degree and per cm at each speed; see calibrate_motion()
+        self.turn_gains = calibration.GainTable(default=1.987)
+        self.distance_gains = calibration.GainTable(default=360 / (6 * math.pi))
+        # 'probe' stops on each tile to check alignment, or steers from tile
+        # to tile once the board is mapped, 'continuous' never stops, 'follow'
+        # follows the side edge of the tiles at follow_speed
+        self.count_mode = 'probe'
+        self.follow_speed = 50
+        # Gains are replaced by any tuned with tune.py; see load_gains()
+        self.follower = EdgeFollower(self.tile_length)
+        # How count_tiles_probing squares up on each tile; see alignment.py
+        self.alignment = alignment.ProfileSweep()
+        self.drift = DriftEstimator(self.tile_length)
+        # Degrees swept when looking for the tower again after approaching it
+        self.rescan_window = 60
+        # 'servo' steers onto the tower without stopping, see approach.py;
+        # 'scan' stops to sweep for it again on the way
+        self.approach_mode = 'servo'
+        self.servo = TowerServo()
+        # What this run sees of the course, merged after it into the map
+        # cached for the board from earlier runs; see coursemap.py
+        self.map = coursemap.CourseMap()
+        self.map_file = coursemap.CACHE
+        self.known = None
+        # Whether the pose is measured from the row yet, so the map lines up
+        self.squared_up = False
+        # Speed to steer from tile to tile at with a complete map, how many
+        # tiles to go between squaring up again, and the most degrees
+        # squaring up on the first tile may turn by before it is done again
+        self.route_speed = 50
+        self.route_square = 5
+        self.route_tolerance = 2
+        # How far short of the mapped tower to stop and look for it, in cm
+        self.tower_standoff = 50
+        # Dead reckoning, updated alongside the sensors; see odometry.py
+        self.odometry = Odometry(self.tank_pair.left_motor, self.tank_pair.right_motor,
+                                 self.cm_to_degrees(1))
+        # The color sensor is read slowly mid-tile and fast near the next edge; see polling.py
+        self.polling = EdgeSchedule(self.odometry, self.tile_length, profiler=self.profile)
+        # Sensors are read on a background thread; see sampler.py
+        self.hub = SensorHub(trace=self.trace, profiler=self.profile)
+        self.hub.add('color', lambda: self.color_sensor.reflected_light_intensity, rate=100, size=512,
+                     schedule=self.polling)
+        self.hub.add('distance', lambda: self.ultrasonic.distance_centimeters, rate=50,
+                     size=512, active=False)
+        self.hub.add('heading', self.odometry.update, rate=50)
+        self.hub.add('map', self.map_color, rate=20, active=False)
+        self.hub.add('battery', self.power.read_volts, rate=2)
+        self.hub.add('current', self.power.read_amps, rate=2)
+        # Sequences of moves queued here run without stopping in between
+        self.queue = MotionQueue(self.planner, self.hub, self.move_wheel_degrees,
+                                 self.turn_wheel_degrees)
+
+    @property
+    def pose(self):
+        """Where the robot is, as (x, y, heading) in cm and degrees.
+
+        After initialize_start, x runs along the row of tiles from the
+        leading edge of the first one.
+        """
+        return self.odometry.pose
+
+    def move_wheel_degrees(self, degrees, speed=20):
+        """Return the wheel degrees that go as far at a speed as some do at REFERENCE_SPEED.
+
+        :param degrees: Wheel degrees at REFERENCE_SPEED.
+        :param speed: Power with which wheels turn.
+        :return: Wheel degrees, scaled by the calibrated distance gains.
+        """
+        gain = self.distance_gains.gain(self.power.effective(speed))
+        return degrees * gain / self.distance_gains.gain(REFERENCE_SPEED)
+
+    def turn_wheel_degrees(self, degrees, speed=20):
+        """Return the wheel degrees that turn the robot some degrees at a speed.
+
+        :param degrees: Degrees to rotate the robot.
+        :param speed: Power with which wheels turn.
+        :return: Wheel degrees, from the calibrated turn gains.
+        """
+        return degrees * self.turn_gains.gain(self.power.effective(speed))
 
     def move_degrees(self, degrees, speed=20):
         """ Turn wheels a set number of degrees.
 
+        The degrees are scaled by the calibrated distance gains, so the robot
+        goes as far as it would at REFERENCE_SPEED.
+
         :param degrees: Degrees to turn the wheels.
         :param speed: Power with which wheels turn.
         """
+        degrees = self.move_wheel_degrees(degrees, speed)
         if degrees >= 0:
-            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=degrees)
+            self.planner.drive(1, 1, degrees, speed=speed)
         else:
-            self.tank_pair.on_for_degrees(left_speed=-speed, right_speed=-speed, degrees=-degrees)
+            self.planner.drive(-1, -1, -degrees, speed=speed)
 
     def on(self, speed=20):
         """ Turn the motors on.
@@ -43,6 +170,15 @@ class Robot:
         """
         self.tank_pair.on(left_speed=speed, right_speed=speed)
 
+    def steer_on(self, steering, speed=20):
+        """Turn the motors on to drive along a curve, as MoveSteering.on.
+
+        :param steering: -100 to 100; negative turns left, positive right.
+        :param speed: Power with which the outer wheel turns.
+        """
+        left, right = self.steer_pair.get_speed_steering(steering, speed)
+        self.tank_pair.on(left_speed=SpeedDPS(left), right_speed=SpeedDPS(right))
+
     def off(self):
         """Turn the motors off.
         """
@@ -53,14 +189,14 @@ class Robot:
 
         :return: Whether the color sensor senses white.
         """
-        return self.color_sensor.reflected_light_intensity in self.white_range
+        return self.hub.next('color') in self.white_range
 
     def on_black(self):
         """Return whether the color sensor senses black.
 
         :return: Whether the color sensor senses black.
         """
-        return self.color_sensor.reflected_light_intensity in self.black_range
+        return self.hub.next('color') in self.black_range
 
     def skip_white(self, speed=20):
         """Drive while robot senses white.
@@ -68,8 +204,7 @@ class Robot:
         :param speed: Power with which wheels turn
         """
         self.on(speed=speed)
-        while self.on_white():
-            pass
+        self.hub.wait_for('color', lambda value: value in self.black_range)
         self.off()
 
     def skip_black(self, speed=20):
@@ -78,8 +213,7 @@ class Robot:
         :param speed: Power with which wheels turn.
         """
         self.on(speed=speed)
-        while self.on_black():
-            pass
+        self.hub.wait_for('color', lambda value: value in self.white_range)
         self.off()
 
     def turn(self, degrees, speed=20):
@@ -88,70 +222,547 @@ class Robot:
         :param degrees: Degrees to rotate the robot.
         :param speed: Power with which wheels turn.
         """
+        wheel_degrees = self.turn_wheel_degrees(degrees, speed)
         if degrees >= 0:
-            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=-speed, degrees=degrees * 1.987)
+            self.planner.drive(1, -1, wheel_degrees, speed=speed)
         else:
-            self.tank_pair.on_for_degrees(left_speed=-speed, right_speed=speed, degrees=-degrees * 1.987)
+            self.planner.drive(-1, 1, -wheel_degrees, speed=speed)
 
     def run(self):
         """Run robot through course.
         """
-        self.initialize_start()
-        self.count_tiles()
-        self.bump_tower()
+        self.odometry.reset()
+        ambient = self.color_sensor.ambient_light_intensity
+        self.trace.sensor('ambient', ambient)
+        self.hub.start()
+        # bump_tower() pauses it for the rest of a run
+        self.hub.resume('color')
+        self.audio.start()
+        try:
+            self.calibrate_colours(ambient)
+            self.load_gains()
+            self.load_map()
+            self.initialize_start()
+            self.count_tiles()
+            self.bump_tower()
+            self.save_map()
+        finally:
+            self.off()
+            self.hub.stop()
+            self.audio.stop()
+            self.save_trace()
+            print(self.hub.report())
+            print(self.queue.report())
+            print(self.power.report())
+            self.report_profile()
+
+    def report_profile(self):
+        """Print the profile and save it to profile_file, if set.
+        """
+        print(self.profile.summary())
+        if self.profile_file is not None:
+            self.profile.save(self.profile_file)
+
+    def save_trace(self):
+        """Write the recorded trace to a new file in trace_dir, unless it is None.
+
+        :return: Path of the file, or None.
+        """
+        if self.trace_dir is None:
+            return None
+        path = self.trace.flush(recorder.new_path(self.trace_dir))
+        print("trace: {} events in {}".format(len(self.trace), path))
+        return path
+
+    @timed
+    def calibrate_colours(self, ambient):
+        """Set the color ranges from the cache, or measure them on the start pad.
+
+        Cached thresholds are only trusted if the pad still reads as black.
+
+        :param ambient: Ambient light intensity, read before the hub started.
+        """
+        key = calibration.lighting_key(self.board, ambient)
+        thresholds = calibration.load(key, self.calibration_file)
+        if thresholds is None or self.hub.next('color') not in thresholds.black_range:
+            thresholds = calibration.measure(self.tank_pair, self.hub)
+            if thresholds is None:
+                return
+            calibration.save(key, thresholds, self.calibration_file)
+        else:
+            # Measured thresholds can be measured again from the trace; cached ones cannot.
+            self.trace.setting('thresholds:' + key, thresholds.black, thresholds.white, thresholds.band)
+        self.black_range = thresholds.black_range
+        self.white_range = thresholds.white_range
+
+    def load_gains(self):
+        """Use the cached turn and distance gains for this board, if any.
+        """
+        self.turn_gains = calibration.load_gains('turn/' + self.board, self.turn_gains.default,
+                                                 self.calibration_file)
+        self.distance_gains = calibration.load_gains('distance/' + self.board,
+                                                     self.distance_gains.default,
+                                                     self.calibration_file)
+        self.odometry.degrees_per_cm = self.cm_to_degrees(1)
+        self.odometry.turn_factor = self.turn_gains.gain(REFERENCE_SPEED)
+        self.follower.gains = calibration.load_pid('follow/' + self.board, self.follower.gains,
+                                                   self.calibration_file)
+        # Recorded so a replay drives with the same gains whatever is cached by then
+        for name, table in (('turn', self.turn_gains), ('distance', self.distance_gains)):
+            for speed, gain in sorted(table.points.items()):
+                self.trace.setting('gains:{}/{}'.format(name, self.board), speed, gain)
+        self.trace.setting('pid:follow/' + self.board, *self.follower.gains)
+
+    def load_map(self):
+        """Start a new map for this run, and load the one from earlier runs, if any.
+        """
+        self.map = coursemap.CourseMap()
+        self.squared_up = False
+        self.known = None
+        if self.map_file is not None:
+            self.known = coursemap.load(self.board, self.map_file)
+        if self.known is not None:
+            # Recorded so a replay drives the same route whatever is mapped by then
+            self.trace.setting('map:' + self.board, self.known.cell, self.known.runs)
+            for number, (x, y, _) in sorted(self.known.tiles.items()):
+                self.trace.setting('map-tile:' + self.board, number, x, y)
+            if self.known.tower is not None:
+                self.trace.setting('map-tower:' + self.board, *self.known.tower)
+
+    def save_map(self):
+        """Merge what this run saw into the map of earlier runs and cache it.
+
+        Nothing is kept from a run that never squared up on the first tile,
+        as its positions do not line up with the map's, or when map_file is None.
+        """
+        if self.map_file is None or not self.squared_up:
+            return
+        known = self.known if self.known is not None else coursemap.CourseMap(cell=self.map.cell)
+        known.merge(self.map)
+        coursemap.save(self.board, known, self.map_file)
+        self.known = known
+        print("map: {}".format(known))
+
+    def map_color(self):
+        """Record the latest color reading where the sensor is; read as a hub channel.
+
+        :return: Number of cells mapped so far.
+        """
+        sample = self.hub.latest('color')
+        if sample is not None:
+            x, y = self.odometry.ahead(self.sensor_dist / self.odometry.degrees_per_cm)
+            self.map.observe_color(x, y, sample[1] in self.black_range)
+        return len(self.map.cells)
+
+    def square_up(self):
+        """Square up on the tile under the color sensor with self.alignment.
+
+        The tiles are laid in a straight row, so the robot then points along
+        it whichever tile it is on, and headings are measured from the row.
+
+        :return: Degrees the robot turned by to square up, as far as the
+            odometry can tell since it last did.
+        """
+        self.alignment.align(self)
+        turned = self.pose.heading
+        self.odometry.observe(heading=0)
+        self.squared_up = True
+        return turned
+
+    def find_edge(self, speed=5):
+        """Creep onto the leading edge of the tile under or ahead of the color sensor.
+
+        :param speed: Power with which wheels turn.
+        :return: Mean motor position at the edge in degrees.
+        """
+        if self.hub.next('color') not in self.white_range:
+            self.on(speed=-speed)
+            self.hub.wait_for('color', lambda value: value in self.white_range)
+        self.on(speed=speed)
+        self.hub.wait_for('color', lambda value: value in self.black_range)
+        position = self.travelled()
+        self.off()
+        return position
 
+    def calibrate_distances(self, speeds=(20, 40, 60, 90), pitches=2):
+        """Measure the wheel degrees per cm at several speeds using the tiles.
+
+        The color sensor must be near the leading edge of a tile, facing
+        along the row, with a tile for every pitch and speed still ahead.
+
+        :param speeds: Speeds to measure at.
+        :param pitches: Tiles to drive per measurement.
+        :return: GainTable of wheel degrees per cm.
+        """
+        table = calibration.GainTable(default=self.distance_gains.default)
+        distance = pitches * 2 * self.tile_size
+        start = self.find_edge()
+        for speed in speeds:
+            # Measured at the speed the wheels can reach off this battery
+            speed = round(self.power.effective(speed), 1)
+            expected = distance * self.distance_gains.gain(speed)
+            self.planner.drive(1, 1, expected, speed=speed)
+            end = self.find_edge()
+            # A miss by a whole gap means the wrong tile was found.
+            if abs(end - start - expected) < expected / (4 * pitches):
+                table.points[speed] = (end - start) / distance
+            start = end
+        return table
+
+    def calibrate_turns(self, speeds=(20, 40, 60)):
+        """Measure the wheel degrees per robot degree at several speeds.
+
+        The robot turns a full circle at each speed and sees how far the
+        tower has moved from straight ahead, so the tower, or any lone object,
+        must be in ultrasonic range.
+
+        :param speeds: Speeds to measure at.
+        :return: GainTable of wheel degrees per robot degree.
+        """
+        table = calibration.GainTable(default=self.turn_gains.default)
+        self.search_for_tower(window=self.rescan_window)
+        for speed in speeds:
+            speed = round(self.power.effective(speed), 1)
+            start = self.wheel_difference()
+            self.planner.drive(1, -1, 360 * self.turn_gains.gain(speed), speed=speed)
+            turned = (self.wheel_difference() - start) / 2
+            here = self.robot_angle()
+            found = self.locate_tower(window=self.rescan_window)
+            if found is None:
+                # Lost it; look all the way round before the next speed.
+                self.search_for_tower()
+                continue
+            bearing, _ = found
+            table.points[speed] = turned / (360 - bearing)
+            self.turn(degrees=(here + bearing - self.robot_angle() + 180) % 360 - 180)
+        return table
+
+    def calibrate_motion(self):
+        """Measure and cache the turn and distance gains for this board.
+
+        Starts like run(), calibrates distances along the row of tiles,
+        drives towards the tower as bump_tower does and calibrates turns
+        there.
+        """
+        self.odometry.reset()
+        ambient = self.color_sensor.ambient_light_intensity
+        self.hub.start()
+        self.hub.resume('color')
+        try:
+            self.calibrate_colours(ambient)
+            self.load_gains()
+            self.initialize_start()
+            distance_gains = self.calibrate_distances()
+            self.turn(degrees=90)
+            self.move_degrees(self.tile_length * 18, speed=90)
+            turn_gains = self.calibrate_turns()
+        finally:
+            self.off()
+            self.hub.stop()
+        calibration.save_gains('distance/' + self.board, distance_gains, self.calibration_file)
+        calibration.save_gains('turn/' + self.board, turn_gains, self.calibration_file)
+        for name, table in (('turn', turn_gains), ('distance', distance_gains)):
+            print("{} gains: {}".format(name, ", ".join(
+                "{:g}% {:.3f}".format(speed, gain) for speed, gain in sorted(table.points.items()))))
+        self.turn_gains = turn_gains
+        self.distance_gains = distance_gains
+
+    @timed
     def initialize_start(self):
         """Move robot from start to first black tile.
         """
-        self.move_degrees(80)
-        self.skip_black()
-        self.skip_white()
-        self.move_degrees(self.tile_length / 2 + self.sensor_dist)
-        self.turn(degrees=90)
-        self.skip_white(speed=-20)
-        self.skip_black(speed=-20)
-        self.skip_white()
+        self.queue.move(80, speed=50)
+        self.queue.until(lambda value: value in self.white_range, speed=50)
+        self.queue.until(lambda value: value in self.black_range, speed=30)
+        self.queue.move(self.tile_length / 2 + self.sensor_dist, speed=50)
+        self.queue.spin(90, speed=40)
+        self.queue.until(lambda value: value in self.black_range, speed=-20)
+        self.queue.until(lambda value: value in self.white_range, speed=-20)
+        self.queue.until(lambda value: value in self.black_range)
+        self.queue.run()
+        self.odometry.reset(x=-self.sensor_dist / self.odometry.degrees_per_cm)
+
+    def tile_reached(self, tile_number, past=0):
+        """Correct the pose now the color sensor has reached a tile.
+
+        :param tile_number: Which tile, counting from 1.
+        :param past: Wheel degrees driven since the sensor crossed its edge.
+        """
+        self.profile.split('tile')
+        self.polling.edge(self.travelled() - past)
+        per_cm = self.odometry.degrees_per_cm
+        heading = math.radians(self.pose.heading)
+        sensor_x = (tile_number - 1) * 2 * self.tile_length / per_cm + past / per_cm * math.cos(heading)
+        self.odometry.observe(x=sensor_x - self.sensor_dist / per_cm * math.cos(heading))
+        self.map.observe_tile(tile_number, *self.odometry.ahead((self.sensor_dist - past) / per_cm))
+
+    def travelled(self):
+        """Return how far the wheels have turned on average.
+
+        :return: Mean motor position in degrees.
+        """
+        return (self.tank_pair.left_motor.position + self.tank_pair.right_motor.position) / 2
+
+    def edge_position(self):
+        """Return where the color sensor crossed the last edge it saw.
 
+        :return: Mean motor position at the edge in degrees.
+        """
+        position = self.travelled()
+        now = time.monotonic()
+        speed = (self.tank_pair.left_motor.speed + self.tank_pair.right_motor.speed) / 2
+        recent = self.hub.samples('color', self.hub.seq('color') - 8)
+        t = edge_time(recent, (self.black_range.stop + self.white_range.start) / 2)
+        if t is None:
+            return position
+        return position - speed * (now - t)
+
+    @timed
     def count_tiles(self):
-        """Move across 15 black tiles while counting
+        """Move across 15 black tiles while counting, using the count_mode strategy.
+        """
+        self.polling.reset()
+        self.hub.resume('map')
+        if self.count_mode in ('continuous', 'follow'):
+            path = self.count_mode
+        elif self.known is not None and self.known.complete():
+            # Nothing left to probe for; see count_tiles_mapped()
+            path = 'mapped'
+        else:
+            path = 'probing'
+        self.trace.setting('count:' + path)
+        try:
+            if path == 'continuous':
+                self.count_tiles_continuous()
+            elif path == 'follow':
+                self.count_tiles_following()
+            elif path == 'mapped':
+                self.count_tiles_mapped()
+            else:
+                self.count_tiles_probing()
+        finally:
+            self.hub.pause('map')
+
+    def count_tiles_continuous(self, speed=30):
+        """Move across 15 black tiles in one pass, counting color transitions.
+
+        A transition only counts once the encoders say the robot has travelled
+        far enough for it to be a real edge, so flicker is ignored. The spacing
+        across each tile feeds the drift estimator, which weaves gently and
+        corrects the heading in the gaps instead of stopping to turn. Ends in
+        the same place as count_tiles_probing.
+
+        :param speed: Power with which wheels turn.
+        :return: Number of tiles counted.
+        """
+        pitch = 2 * self.tile_length
+        tile_count = 1
+        self.audio.tone(150, 0.5)
+        tile_start = self.travelled()
+        on_black = True
+        self.drift.start(tile_start)
+        self.on(speed=speed)
+        steer_target = None
+        while tile_count < 15:
+            target = self.white_range if on_black else self.black_range
+            self.profile.tick('count_tiles')
+            timeout = 0.25 if steer_target is None else self.hub.channels['color'].period
+            sample = self.hub.wait_for('color', lambda value: value in target, timeout=timeout)
+            if steer_target is not None and self.steer_done(steer_target):
+                steer_target = None
+                self.on(speed=speed)
+            if sample is None:
+                if self.travelled() - tile_start > 3 * pitch:
+                    # Drifted off the row; stop rather than drive on forever
+                    break
+                continue
+            position = self.edge_position()
+            if on_black:
+                if position - tile_start >= self.tile_length / 2:
+                    on_black = False
+                    steer_target = self.steer_by(self.drift.white_edge(position), speed)
+            elif position - tile_start >= pitch * 3 / 4:
+                # Count any tile the sensor slipped past the side of, too
+                tile_count += max(1, int(round((position - tile_start) / pitch)))
+                tile_start = position
+                on_black = True
+                self.drift.black_edge(position)
+                self.tile_reached(tile_count, self.travelled() - position)
+                self.audio.tone(100 + (50 * tile_count), 0.5)
+        remaining = self.tile_length - (self.travelled() - tile_start)
+        if remaining > 0:
+            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=remaining)
+        self.off()
+        # Take out the last weave so the robot points along the row again
+        self.turn(-self.drift.phase * self.drift.dither, speed=10)
+        return tile_count
+
+    def count_tiles_following(self, speed=None, first=1):
+        """Move across 15 black tiles without stopping, following their side edge.
+
+        The robot squares up on the tile it starts on with self.alignment, as
+        count_tiles_probing does, and the color sensor is then steered onto
+        the edge along one side of the row and held there by the follower's
+        PID, on every color sample; see follow.py. Ends in the same place
+        along the row as count_tiles_probing, pointing the way of the row.
+
+        :param speed: Power with which the outer wheel turns; follow_speed if None.
+        :param first: Number of the tile the color sensor starts on.
+        :return: Number of tiles counted.
+        """
+        if speed is None:
+            speed = self.follow_speed
+        follower = self.follower
+        self.tile_reached(first)
+        self.audio.tone(100 + (50 * first), 0.5)
+        self.alignment.reset()
+        self.square_up()
+        # Hold the sensor where it only just reads black, so it is over every tile
+        follower.start(self.black_range.stop, self.white_range.start, self.travelled(),
+                       self.pose.heading, first)
+        # The controller wants every sample, not just the ones near an edge
+        self.hub.set_schedule('color', None)
+        try:
+            while follower.count < 15:
+                sample = self.hub.wait_for('color', lambda value: True, timeout=0.25)
+                if sample is None:
+                    continue
+                position = self.travelled()
+                steering, reached = follower.update(sample[0], sample[1], position, self.pose.heading)
+                self.steer_on(steering, speed)
+                if reached:
+                    self.tile_reached(follower.count, position - follower.tile_start)
+                    self.audio.tone(100 + (50 * follower.count), 0.5)
+                if follower.lost:
+                    # Drifted off the row; stop rather than count tiles that are not there
+                    break
+        finally:
+            self.hub.set_schedule('color', self.polling)
+        remaining = self.tile_length - (self.travelled() - follower.tile_start)
+        if remaining > 0:
+            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=remaining)
+        self.off()
+        self.turn(follower.row_heading - self.pose.heading, speed=10)
+        return follower.count
+
+    def count_tiles_mapped(self, speed=None):
+        """Move across 15 black tiles without stopping, steering from one mapped tile to the next.
+
+        With every tile in the map from earlier runs there is nothing to
+        probe for. The robot squares up on the first tile, as
+        count_tiles_probing does, then steers its color sensor for the middle
+        of the tile after next, where the map has it, and counts each tile
+        once the sensor reads black near its mapped edge. Odometry alone
+        would let the heading wander off the row by more than a tile is
+        wide, so every route_square tiles the robot stops to square up
+        again. If the sensor still passes a tile without reading black, the
+        map is no help any more: the robot backs up onto the last tile it
+        found and follows the row's edge the rest of the way, with
+        count_tiles_following, which puts the sensor back over the row. Ends
+        in the same place along the row as count_tiles_probing, pointing the
+        way of the row.
+
+        :param speed: Power with which the outer wheel turns; route_speed if None.
+        :return: Number of tiles counted.
+        """
+        if speed is None:
+            speed = self.route_speed
+        per_cm = self.odometry.degrees_per_cm
+        half = self.tile_length / 2 / per_cm
+        tile_count = 1
+        self.tile_reached(1)
+        self.audio.tone(150, 0.5)
+        self.alignment.reset()
+        # A sweep from well off the row only gets part of the way round
+        for _ in range(3):
+            if abs(self.square_up()) < self.route_tolerance:
+                break
+        tile_start = self.travelled()
+        while tile_count < 15:
+            sample = self.hub.wait_for('color', lambda value: True, timeout=0.25)
+            sensor_x, sensor_y = self.odometry.ahead(self.sensor_dist / per_cm)
+            aim_x, aim_y = self.known.tile(min(tile_count + 2, 15))
+            bearing = math.degrees(math.atan2(aim_y - sensor_y, aim_x + half - sensor_x))
+            steering = self.follower.heading_gain * (bearing - self.pose.heading)
+            self.steer_on(max(-self.follower.limit, min(self.follower.limit, steering)), speed)
+            if sample is None:
+                continue
+            edge_x, _ = self.known.tile(tile_count + 1)
+            if sample[1] in self.black_range and sensor_x >= edge_x - half:
+                position = self.edge_position()
+                tile_count += 1
+                tile_start = position
+                self.tile_reached(tile_count, self.travelled() - position)
+                self.audio.tone(100 + (50 * tile_count), 0.5)
+                if tile_count < 15 and (tile_count - 1) % self.route_square == 0:
+                    self.off()
+                    # Back onto the edge, where probing would have stopped
+                    self.move_degrees(position - self.travelled())
+                    self.square_up()
+                    tile_start = self.travelled()
+            elif sensor_x >= edge_x + half:
+                # Off the row; retrace the way back to the last tile's edge
+                self.off()
+                self.move_degrees(tile_start - self.travelled())
+                return self.count_tiles_following(first=tile_count)
+        remaining = self.tile_length - (self.travelled() - tile_start)
+        if remaining > 0:
+            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=remaining)
+        self.off()
+        self.turn(-self.pose.heading, speed=10)
+        return tile_count
+
+    def wheel_difference(self):
+        """Return how far the left wheel has turned beyond the right one.
+
+        :return: Degrees.
+        """
+        return self.tank_pair.left_motor.position - self.tank_pair.right_motor.position
+
+    def steer_by(self, degrees, speed=20, ratio=0.3):
+        """Start turning the robot by some degrees without stopping.
+
+        :param degrees: Degrees to rotate the robot, positive clockwise.
+        :param speed: Power with which wheels turn.
+        :param ratio: How much faster one wheel runs than the other.
+        :return: Wheel difference to pass to steer_done, or None if no turn.
+        """
+        if not degrees:
+            self.on(speed=speed)
+            return None
+        ratio = math.copysign(ratio, degrees)
+        self.tank_pair.on(left_speed=speed * (1 + ratio), right_speed=speed * (1 - ratio))
+        return self.wheel_difference() + 2 * self.turn_gains.gain(speed) * degrees, ratio
+
+    def steer_done(self, steer_target):
+        """Return whether a turn started by steer_by has finished.
+
+        :param steer_target: Value returned by steer_by.
+        :return: Whether the turn is complete.
+        """
+        target, ratio = steer_target
+        return (self.wheel_difference() - target) * ratio >= 0
+
+    def count_tiles_probing(self):
+        """Move across 15 black tiles while counting, squaring up on each with self.alignment
         """
         tile_count = 0
-        turn_angle = 0
-        prev_turn_angle = 0
+        self.alignment.reset()
 
         while tile_count < 14:
             tile_count += 1
-            self.sound.play_tone(100 + (50 * tile_count), 0.5)
-            self.move_degrees(135)
-            
-            self.turn(90)
-            right_is_black_1 = self.on_black()
-            self.move_degrees(40)
-            right_is_black_2 = self.on_black()
-            self.move_degrees(-40)
-            self.turn(-180)
-            left_is_black_1 = self.on_black()
-            self.move_degrees(40)
-            left_is_black_2 = self.on_black()
-            self.move_degrees(-40)
-            self.turn(90)
-
-            turn_angle = self.get_angle_from_color(left_is_black_2, left_is_black_1, right_is_black_1, right_is_black_2)
-            if prev_turn_angle > 0 and turn_angle > 0:
-                turn_angle = 3.5
-            elif prev_turn_angle < 0 and turn_angle < 0:
-                turn_angle = -3.5
-            elif turn_angle == 0:
-                self.turn(-prev_turn_angle, speed=8)
-            self.turn(turn_angle, speed=8)
-            prev_turn_angle = turn_angle
-            
-            self.skip_black()
-            self.skip_white()
+            self.tile_reached(tile_count)
+            self.audio.tone(100 + (50 * tile_count), 0.5)
+            self.square_up()
+
+            self.queue.until(lambda value: value in self.white_range, speed=40)
+            self.queue.until(lambda value: value in self.black_range, speed=30)
+            self.queue.run()
 
         tile_count += 1
-        self.sound.play_tone(100 + (50 * tile_count), 0.5)
-        self.move_degrees(self.tile_length)
+        self.tile_reached(tile_count)
+        self.audio.tone(100 + (50 * tile_count), 0.5)
+        self.move_degrees(self.tile_length, speed=50)
 
     def get_angle_from_color(self, left2, left1, right1, right2):
         """Get adjustment angle from color readings.
@@ -181,25 +792,97 @@ class Robot:
         """
         self.turn(degrees=370)
 
-    def search_for_tower(self):
+    def robot_angle(self):
+        """Return how far the robot has turned, from the wheel encoders.
+
+        :return: Robot degrees, positive clockwise, since the motors were reset.
+        """
+        return self.wheel_difference() / (2 * self.turn_gains.gain(REFERENCE_SPEED))
+
+    @timed
+    def sweep(self, degrees, speed=20):
+        """Turn on the spot while recording ultrasonic distances.
+
+        :param degrees: Degrees to rotate the robot.
+        :param speed: Power with which wheels turn.
+        :return: The Sweep, with angles relative to the starting heading.
+        """
+        sweep = Sweep()
+        start = self.robot_angle()
+        if degrees < 0:
+            degrees, speed = -degrees, -speed
+        self.hub.resume('distance')
+        self.tank_pair.on_for_degrees(left_speed=speed, right_speed=-speed,
+                                      degrees=degrees * self.turn_gains.gain(speed), block=False)
+        period = self.hub.channels['distance'].period
+        while self.tank_pair.is_running:
+            sample = self.hub.wait_for('distance', lambda value: True, timeout=2 * period)
+            if sample is not None:
+                sweep.add(self.robot_angle() - start, sample[1])
+        self.hub.pause('distance')
+        return sweep
+
+    def locate_tower(self, window=370, expected=None):
+        """Find the tower's bearing, leaving the robot where its last sweep ended.
+
+        A narrow window is centred on the current heading and doubled until
+        the whole tower is seen in it, at about the expected distance.
+
+        :param window: Degrees to sweep; 360 or more sweeps all the way round.
+        :param expected: Distance the tower should be at, if known.
+        :return: (bearing from the starting heading, distance), or None.
+        """
+        start = self.robot_angle()
+        while True:
+            if window >= 360:
+                origin = self.robot_angle()
+                target = self.sweep(370).nearest()
+                break
+            origin = start - window / 2
+            self.turn(degrees=origin - self.robot_angle())
+            target = self.sweep(window).nearest(complete=True)
+            if target is not None and (expected is None or target[1] <= 1.5 * expected + 10):
+                break
+            window *= 2
+        if target is None:
+            return None
+        angle, distance = target
+        return origin + angle - start, distance
+
+    @timed
+    def search_for_tower(self, window=370, expected=None):
         """Point robot at tower.
 
+        :param window: Degrees to sweep; 360 or more sweeps all the way round.
+        :param expected: Distance the tower should be at, if known.
         :return: Distance to tower.
         """
-        min_dist = 255
-        start_time = time.time()
-        min_time = start_time
-        turn_thread = Thread(target=self.turn_370)
-        turn_thread.start()
-        while turn_thread.is_alive():
-            cur_dist = self.ultrasonic.distance_centimeters
-            if cur_dist < min_dist:
-                min_dist = cur_dist
-                min_time = time.time()
-        end_time = time.time()
-        self.turn(degrees=-370)
-        self.turn(degrees=370*(min_time-start_time)/(end_time-start_time))
-        return min_dist
+        start = self.robot_angle()
+        found = self.locate_tower(window, expected)
+        if found is None:
+            return 255
+        bearing, distance = found
+        # Turn straight from where the sweep ended, the short way round.
+        self.turn(degrees=(start + bearing - self.robot_angle() + 180) % 360 - 180)
+        return distance
+
+    def head_for_tower(self):
+        """Drive straight towards where the map has the tower, and point at it.
+
+        Stops tower_standoff cm short of it and only sweeps rescan_window
+        degrees for it there; locate_tower widens the sweep if the tower is
+        not where it was.
+
+        :return: Distance to tower.
+        """
+        tower_x, tower_y = self.known.tower
+        x, y, heading = self.pose
+        bearing = math.degrees(math.atan2(tower_y - y, tower_x - x))
+        self.turn(degrees=(bearing - heading + 180) % 360 - 180, speed=40)
+        distance = math.hypot(tower_x - x, tower_y - y) - self.tower_standoff
+        if distance > 0:
+            self.move_degrees(self.cm_to_degrees(distance), speed=90)
+        return self.search_for_tower(window=self.rescan_window, expected=self.tower_standoff)
 
     def cm_to_degrees(self, cm):
         """Convert cm to degrees.
@@ -207,21 +890,84 @@ class Robot:
         :param cm: Amount to convert.
         :return: Amount in degrees.
         """
-        return (360/(6*math.pi))*cm
+        return self.distance_gains.gain(REFERENCE_SPEED) * cm
 
-    def bump_tower(self):
-        """Find tower and knock it off its base.
+    def approach_tower_scanning(self, distance):
+        """Close in on the tower in steps, sweeping for it again after each.
+
+        :param distance: Distance to the tower, which is straight ahead.
         """
-        self.turn(degrees=90)
-        self.move_degrees(self.tile_length * 18)
-        
         while True:
-            distance = self.search_for_tower()
             if distance / 2 <= 20:
-                self.move_degrees(self.cm_to_degrees(distance-20))
-                self.search_for_tower()
+                self.move_degrees(self.cm_to_degrees(distance-20), speed=60)
+                self.search_for_tower(window=self.rescan_window, expected=20)
                 break
-            self.move_degrees(self.cm_to_degrees(distance/2))
+            self.move_degrees(self.cm_to_degrees(distance/2), speed=60)
+            # The tower is roughly straight ahead now, so only look near it
+            distance = self.search_for_tower(window=self.rescan_window, expected=distance/2)
+
+    def approach_tower_servoing(self, distance):
+        """Close in on the tower in one motion, steering by the ultrasonic sensor.
+
+        The robot weaves across the tower on every distance sample and
+        slows down as it nears; see approach.py. Ends pointing at the tower
+        servo.stop_distance from it, as approach_tower_scanning does. If the
+        servo gives up on the tower, the robot sweeps for it and closes in
+        with approach_tower_scanning instead, if it is anywhere in range.
+
+        :param distance: Distance to the tower, which is straight ahead.
+        """
+        servo = self.servo
+        if distance >= 255:
+            # Nothing in range to steer by; step in the way the scan would
+            self.approach_tower_scanning(distance)
+            return
+        x, y, heading = self.pose
+        servo.start(heading, distance)
+        self.hub.resume('distance')
+        period = self.hub.channels['distance'].period
+        try:
+            while not servo.done and not servo.failed:
+                sample = self.hub.wait_for('distance', lambda value: True, timeout=10 * period)
+                if sample is None:
+                    # The hub has stopped, or the sensor with it
+                    servo.failed = True
+                    break
+                pose = self.pose
+                steering, speed = servo.update(sample[1], pose.heading,
+                                               math.hypot(pose.x - x, pose.y - y))
+                self.steer_on(steering, speed)
+        finally:
+            self.hub.pause('distance')
+        self.off()
+        self.turn(servo.bearing - self.pose.heading, speed=10)
+        if servo.failed:
+            # Lost the tower, or drove past where it was; look for it on the
+            # spot, and leave it be if it is nowhere in range.
+            distance = self.search_for_tower()
+            if distance < 255:
+                self.approach_tower_scanning(distance)
+
+    @timed
+    def bump_tower(self):
+        """Find tower and knock it off its base.
+        """
+        # Only the ultrasonic sensor is needed from here on
+        self.hub.pause('color')
+        if self.known is not None and self.known.tower is not None:
+            distance = self.head_for_tower()
+        else:
+            self.turn(degrees=90, speed=40)
+            self.move_degrees(self.tile_length * 18, speed=90)
+            distance = self.search_for_tower()
+        if self.approach_mode == 'servo':
+            self.approach_tower_servoing(distance)
+        else:
+            self.approach_tower_scanning(distance)
+        # Pointing at the tower now; a median takes out a bogus reading
+        distance = calibration.median([self.ultrasonic.distance_centimeters for _ in range(3)])
+        if distance < 255:
+            self.map.observe_tower(*self.odometry.ahead(distance))
 
         self.move_degrees(self.cm_to_degrees(10), speed=20)
         for i in range(40,101,10):
@@ -233,13 +979,23 @@ class Robot:
         self.on(speed=100)
         time.sleep(5)
         self.off()
-        self.sound.play_tone(400, 1)
+        self.audio.tone(400, 1)
 
 
 if __name__ == "__main__":
+    import argparse
+
     try:
+        parser = argparse.ArgumentParser(description="Run the course.")
+        parser.add_argument('mode', nargs='?', choices=['run', 'calibrate'], default='run')
+        parser.add_argument('--profile', help="save phase timings and latencies to this JSON file")
+        args = parser.parse_args()
         r = Robot()
-        r.run()
+        r.profile_file = args.profile
+        if args.mode == 'calibrate':
+            r.calibrate_motion()
+        else:
+            r.run()
     except:
         import traceback
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -0,0 +1,319 @@
+"""Background sensor sampling so the robot never busy-waits on a sensor.
+
+One thread reads every active channel at its own rate and stores the
+samples in fixed-size ring buffers. Robot code blocks on a condition such as
+"next color sample below 30" and is woken by the sampler instead of
+spinning on ``reflected_light_intensity``.
+"""
+import time
+from array import array
+from threading import Condition, Thread
+
+
+class RingBuffer:
+    """Fixed-size buffer of timestamped samples.
+
+    Samples are numbered from 0 in the order they were added; only the last
+    ``size`` of them are kept.
+
+    :param size: Number of samples to keep.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        self.values = array("d", [0.0]) * size
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t, value):
+        """Add a sample, overwriting the oldest once full.
+
+        :param t: Time of the sample.
+        :param value: Sensor reading.
+        """
+        i = self.count % self.size
+        self.times[i] = t
+        self.values[i] = value
+        self.count += 1
+
+    def __getitem__(self, seq):
+        """Return sample number seq.
+
+        :param seq: Sample number.
+        :return: (time, value).
+        """
+        if not self.count - len(self) <= seq < self.count:
+            raise IndexError("sample {} is not in the buffer".format(seq))
+        i = seq % self.size
+        return self.times[i], self.values[i]
+
+    def latest(self):
+        """Return the newest sample.
+
+        :return: (time, value), or None if empty.
+        """
+        if not self.count:
+            return None
+        return self[self.count - 1]
+
+    def since(self, seq):
+        """Return all samples from number seq onwards that are still kept.
+
+        :param seq: First sample number wanted.
+        :return: List of (time, value).
+        """
+        start = max(seq, self.count - len(self))
+        return [self[i] for i in range(start, self.count)]
+
+
+class Channel:
+    """One sensor sampled by the hub.
+
+    :param name: Name used to refer to the channel.
+    :param read: Callable returning the current reading.
+    :param rate: Samples per second.
+    :param size: Ring buffer size.
+    :param active: Whether to sample straight away.
+    :param schedule: Callable taking each reading and returning the seconds
+        until the next one, to sample at a varying rate; None samples at rate.
+    """
+    def __init__(self, name, read, rate, size=256, active=True, schedule=None):
+        self.name = name
+        self.read = read
+        self.period = 1 / rate
+        self.schedule = schedule
+        self.buffer = RingBuffer(size)
+        self.active = active
+        self.next_due = 0.0
+        self.read_time = 0.0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.wakeups = 0
+
+
+class SensorHub:
+    """Samples sensors on one background thread.
+
+    :param idle: Seconds to sleep when no channel is active.
+    :param trace: TraceRecorder that every sample is also recorded into, if any.
+    :param profiler: Profiler that read and wake-up latencies are added to, if any.
+    """
+    def __init__(self, idle=0.05, trace=None, profiler=None):
+        self.idle = idle
+        self.trace = trace
+        self.profiler = profiler
+        self.channels = {}
+        self._cond = Condition()
+        self._thread = None
+        self._running = False
+        self._start_wall = 0.0
+        self._start_cpu = 0.0
+        self._stop_wall = None
+        self._stop_cpu = None
+
+    def add(self, name, read, rate=100, size=256, active=True, schedule=None):
+        """Register a sensor.
+
+        :param name: Name used to refer to the channel.
+        :param read: Callable returning the current reading.
+        :param rate: Samples per second.
+        :param size: Ring buffer size.
+        :param active: Whether to sample straight away.
+        :param schedule: Callable taking each reading and returning the
+            seconds until the next one; None samples at rate.
+        :return: The new Channel.
+        """
+        channel = Channel(name, read, rate, size, active, schedule)
+        self.channels[name] = channel
+        return channel
+
+    def start(self):
+        """Start the sampling thread.
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+        self._start_wall = time.monotonic()
+        self._start_cpu = time.process_time()
+        self._stop_wall = self._stop_cpu = None
+        self._thread = Thread(target=self._run, name="SensorHub", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the sampling thread and wake anyone still waiting.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        self._stop_wall = time.monotonic()
+        self._stop_cpu = time.process_time()
+
+    def set_schedule(self, name, schedule):
+        """Change how a channel is paced.
+
+        :param name: Channel name.
+        :param schedule: Callable taking each reading and returning the
+            seconds until the next one; None samples at the channel's rate.
+        """
+        self.channels[name].schedule = schedule
+
+    def resume(self, name):
+        """Start sampling a channel.
+
+        :param name: Channel name.
+        """
+        self.channels[name].active = True
+
+    def pause(self, name):
+        """Stop sampling a channel; its buffer is kept.
+
+        :param name: Channel name.
+        """
+        self.channels[name].active = False
+
+    def _run(self):
+        channels = list(self.channels.values())
+        trace = self.trace
+        profiler = self.profiler
+        while self._running:
+            now = time.monotonic()
+            before = now
+            wake = now + self.idle
+            sampled = False
+            for channel in channels:
+                if not channel.active:
+                    continue
+                if channel.next_due <= now:
+                    value = channel.read()
+                    t = time.monotonic()
+                    channel.read_time += t - before
+                    if trace is not None:
+                        trace.sensor(channel.name, value, t)
+                    if profiler is not None:
+                        profiler.observe(channel.name + ' read', t - before)
+                    before = t
+                    with self._cond:
+                        channel.buffer.append(t, value)
+                    if channel.schedule is None:
+                        channel.next_due = max(channel.next_due + channel.period, now)
+                    else:
+                        channel.next_due = t + channel.schedule(value)
+                    sampled = True
+                wake = min(wake, channel.next_due)
+            if profiler is not None:
+                profiler.tick('hub')
+            if sampled:
+                with self._cond:
+                    self._cond.notify_all()
+            delay = wake - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def seq(self, name):
+        """Return the number the next sample on a channel will get.
+
+        :param name: Channel name.
+        :return: Sample number.
+        """
+        return self.channels[name].buffer.count
+
+    def latest(self, name):
+        """Return the newest sample on a channel.
+
+        :param name: Channel name.
+        :return: (time, value), or None if nothing has been sampled.
+        """
+        with self._cond:
+            return self.channels[name].buffer.latest()
+
+    def samples(self, name, since=0):
+        """Return the buffered samples on a channel.
+
+        :param name: Channel name.
+        :param since: First sample number wanted.
+        :return: List of (time, value).
+        """
+        with self._cond:
+            return self.channels[name].buffer.since(since)
+
+    def fetch(self, name, seq):
+        """Return the samples taken since seq and the number to fetch from next.
+
+        :param name: Channel name.
+        :param seq: First sample number wanted.
+        :return: (list of (time, value), next sample number).
+        """
+        with self._cond:
+            buffer = self.channels[name].buffer
+            return buffer.since(seq), buffer.count
+
+    def wait_for(self, name, predicate, timeout=None):
+        """Block until a new sample on a channel satisfies a predicate.
+
+        Only samples taken after the call are considered.
+
+        :param name: Channel name.
+        :param predicate: Callable taking a reading and returning a bool.
+        :param timeout: Seconds to wait, or None for no limit.
+        :return: (time, value) of the matching sample, or None on timeout.
+        """
+        channel = self.channels[name]
+        buffer = channel.buffer
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            seq = buffer.count
+            while self._running:
+                # Samples can be overwritten if we fall a whole buffer behind.
+                seq = max(seq, buffer.count - len(buffer))
+                while seq < buffer.count:
+                    t, value = buffer[seq]
+                    seq += 1
+                    if predicate(value):
+                        latency = time.monotonic() - t
+                        channel.wakeups += 1
+                        channel.latency_sum += latency
+                        channel.latency_max = max(channel.latency_max, latency)
+                        if self.profiler is not None:
+                            self.profiler.observe(name + ' wake', latency)
+                        return t, value
+                remaining = None
+                if end is not None:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                self._cond.wait(remaining)
+        return None
+
+    def next(self, name, timeout=None):
+        """Return the next sample taken on a channel.
+
+        :param name: Channel name.
+        :param timeout: Seconds to wait, or None for no limit.
+        :return: The reading, or None on timeout.
+        """
+        sample = self.wait_for(name, lambda value: True, timeout)
+        return None if sample is None else sample[1]
+
+    def report(self):
+        """Summarize CPU use, sample rates and wake-up latency.
+
+        :return: Multi-line report.
+        """
+        wall = (self._stop_wall or time.monotonic()) - self._start_wall
+        cpu = (self._stop_cpu or time.process_time()) - self._start_cpu
+        lines = ["sensor hub: {:.1f} s, process cpu {:.0%}".format(wall, cpu / wall if wall else 0)]
+        for channel in self.channels.values():
+            count = channel.buffer.count
+            lines.append("  {:<9} {:6d} samples  read {:5.2f} ms  "
+                         "wake latency mean {:5.2f} ms max {:5.2f} ms  edge within {:5.2f} ms"
+                         .format(channel.name, count,
+                                 1000 * channel.read_time / count if count else 0,
+                                 1000 * channel.latency_sum / channel.wakeups if channel.wakeups else 0,
+                                 1000 * channel.latency_max, 1000 * channel.period))
+        return "\n".join(lines)
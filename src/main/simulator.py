@@ -0,0 +1,1336 @@
+#!/usr/bin/env python3
+"""Headless stand-in for the ev3dev2 drivers with a simulated course.
+
+The simulator registers fake ``ev3dev2`` modules in ``sys.modules`` so any of
+the Robot classes in this repo can be constructed unchanged on a normal
+Linux box. Motors, sensors and sound all run against a virtual clock that
+only advances when every thread talking to the hardware is waiting, so a
+lap that takes minutes on the board finishes in a fraction of a second.
+
+Usage::
+
+    python3 simulator.py --laps 20
+    python3 simulator.py --variant ../test.py --seed 3
+    python3 simulator.py --volts 7.0
+
+Robot code that sleeps or waits on a condition should use ``time.sleep`` and
+``threading.Condition`` through module globals (``import time`` and
+``from threading import Condition``) so the simulator can swap in its
+virtual versions.
+"""
+import argparse
+import asyncio
+import importlib.util
+import math
+import os
+import random
+import selectors
+import sys
+import threading
+import time
+import types
+import wave
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Robot geometry, in cm. The axle track is picked so the 1.987 wheel degrees
+# per robot degree used by Robot.turn() is a true in-place turn.
+WHEEL_DIAMETER = 5.6
+AXLE_TRACK = WHEEL_DIAMETER * 1.987
+COLOR_OFFSET = 4.2
+ULTRASONIC_OFFSET = 6.0
+BODY_FRONT = 9.0
+BODY_HALF_WIDTH = 7.0
+SPOT_SIZE = 1.0
+
+# LargeMotor characteristics.
+MAX_SPEED = 1050
+MOTOR_ACCEL = 6000.0
+MOTOR_BRAKE = 20000.0
+
+# Battery characteristics. A charged battery starts at FULL_VOLTS. The
+# motors reach MAX_SPEED and MOTOR_ACCEL off RATED_VOLTS at the brick, and
+# less in proportion below it; the voltage at the brick sags under load,
+# across the internal resistance, and the open-circuit voltage falls as the
+# battery is used.
+FULL_VOLTS = 8.2
+RATED_VOLTS = 8.0
+BATTERY_RESISTANCE = 0.15
+VOLTS_PER_AMP_HOUR = 0.6
+IDLE_CURRENT = 0.15
+# Amps a motor draws at MAX_SPEED, and again at full acceleration
+MOTOR_CURRENT = 0.5
+
+# Hardest a wheel can speed up or slow down without slipping on each kind of
+# board, in wheel degrees per second squared. Past that the wheel spins or
+# skids and the encoders no longer match the ground.
+SURFACE_GRIP = {"mat": 8000.0, "wood": 5000.0, "paper": 3000.0}
+
+# Virtual cost of the things the robot code does in a tight loop, in seconds.
+SENSOR_READ_COST = 0.001
+ENCODER_READ_COST = 0.0005
+TIME_CALL_COST = 0.0001
+
+
+class SimTimeout(Exception):
+    """Raised in every robot thread once the lap exceeds its time budget."""
+
+
+class _Wait:
+    def __init__(self, deadline, condition=None, ready=None):
+        self.deadline = deadline
+        self.condition = condition
+        self.ready = ready
+        self.woken = False
+
+
+class VirtualClock:
+    """Discrete-event clock shared by all threads driving the simulation.
+
+    A thread that sleeps, blocks on a motor or reads a sensor registers a
+    wait. Once every participating thread is waiting, the clock jumps to the
+    earliest deadline and steps the world up to it. Threads that stop
+    talking to the clock (blocked in a queue or join) are treated as waiting
+    after ``idle_timeout`` real seconds.
+
+    :param max_time: Virtual seconds after which SimTimeout is raised.
+    :param idle_timeout: Real seconds before a silent thread counts as idle.
+    :param max_step: Largest physics step, in virtual seconds.
+    """
+    def __init__(self, max_time=None, idle_timeout=0.02, max_step=0.01):
+        self.max_time = max_time
+        self.idle_timeout = idle_timeout
+        self.max_step = max_step
+        self.epoch = 1.5e9
+        self.now = 0.0
+        self.busy = 0.0
+        self.expired = False
+        self.listeners = []
+        self._cv = threading.Condition()
+        self._threads = {}
+        self._last_seen = {}
+        self._waits = {}
+        self.module = _TimeModule(self)
+
+    def Condition(self, lock=None):
+        """Return a condition variable whose waits run on virtual time.
+
+        :param lock: Lock to use; a new one is created if not given.
+        :return: A VirtualCondition.
+        """
+        return VirtualCondition(self, lock)
+
+    def time(self):
+        """Return the virtual wall-clock time.
+
+        :return: Seconds since the epoch.
+        """
+        self.consume(TIME_CALL_COST)
+        return self.epoch + self.now
+
+    def monotonic(self):
+        """Return the virtual monotonic time.
+
+        :return: Seconds since the simulation started.
+        """
+        self.consume(TIME_CALL_COST)
+        return self.now
+
+    def sleep(self, seconds):
+        """Block the calling thread for a number of virtual seconds.
+
+        :param seconds: How long to sleep.
+        """
+        self.wait_until(self.now + max(seconds, 0.0))
+
+    def consume(self, seconds):
+        """Spend virtual CPU time, e.g. for a sensor read.
+
+        :param seconds: How long the operation takes.
+        """
+        self.busy += seconds
+        self.wait_until(self.now + seconds)
+
+    def wait_until(self, deadline):
+        """Block the calling thread until the clock reaches a deadline.
+
+        :param deadline: Virtual time to wait for.
+        """
+        self._wait(_Wait(deadline))
+
+    def wait_for(self, predicate, poll=0.01, timeout=None):
+        """Block until a predicate over the world state holds.
+
+        :param predicate: Callable returning True when done.
+        :param poll: Virtual seconds between checks.
+        :param timeout: Give up after this many virtual seconds.
+        :return: The last value of the predicate.
+        """
+        end = None if timeout is None else self.now + timeout
+        result = predicate()
+        while not result:
+            if end is not None and self.now >= end:
+                break
+            self.sleep(poll)
+            result = predicate()
+        return result
+
+    def _wait(self, w):
+        me = threading.current_thread()
+        with self._cv:
+            self._check_expired()
+            ident = me.ident
+            self._threads[ident] = me
+            self._waits[ident] = w
+            try:
+                while not w.woken and self.now < w.deadline:
+                    self._check_expired()
+                    if w.ready is not None and w.ready():
+                        break
+                    if len(self._threads) == 1 and w.deadline < math.inf:
+                        # Fast path: the calling thread is the only participant.
+                        self._advance(w.deadline)
+                        continue
+                    target = self._next_deadline()
+                    if target is not None:
+                        self._advance(target)
+                        self._cv.notify_all()
+                        continue
+                    self._cv.wait(self.idle_timeout)
+            finally:
+                del self._waits[ident]
+                self._last_seen[ident] = time.monotonic()
+            self._check_expired()
+
+    def _next_deadline(self):
+        # Earliest finite deadline if every participant is waiting, else None.
+        real_now = time.monotonic()
+        deadline = math.inf
+        for ident, thread in list(self._threads.items()):
+            if not thread.is_alive():
+                del self._threads[ident]
+                self._last_seen.pop(ident, None)
+                continue
+            w = self._waits.get(ident)
+            if w is not None:
+                if w.woken or w.deadline <= self.now:
+                    return None
+                deadline = min(deadline, w.deadline)
+            elif real_now - self._last_seen.get(ident, real_now) < self.idle_timeout:
+                return None
+        if deadline == math.inf:
+            return None
+        return deadline
+
+    def _advance(self, target):
+        if self.max_time is not None and target > self.max_time:
+            target = self.max_time
+            self.expired = True
+        while self.now < target:
+            dt = min(self.max_step, target - self.now)
+            for listener in self.listeners:
+                listener(dt)
+            self.now += dt
+        self._check_expired()
+
+    def _check_expired(self):
+        if self.expired:
+            raise SimTimeout("lap exceeded {:.0f} s of virtual time".format(self.max_time))
+
+    def _notify(self, condition, n):
+        with self._cv:
+            for w in self._waits.values():
+                if n <= 0:
+                    break
+                if w.condition is condition and not w.woken:
+                    w.woken = True
+                    n -= 1
+            self._cv.notify_all()
+
+
+class VirtualCondition:
+    """Drop-in for threading.Condition that waits on a VirtualClock.
+
+    Blocking on the lock also waits on the clock, so a thread that spends
+    virtual time while holding it does not stall the others in real time.
+
+    :param clock: Clock to wait on.
+    :param lock: Underlying lock; a new one is created if not given.
+    """
+    def __init__(self, clock, lock=None):
+        self._clock = clock
+        self._lock = lock if lock is not None else threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        """Take the lock, as threading.Lock.acquire with a virtual timeout.
+
+        :param blocking: Whether to wait for the lock.
+        :param timeout: Virtual seconds to wait, or -1 for no limit.
+        :return: Whether the lock was taken.
+        """
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        deadline = math.inf if timeout < 0 else self._clock.now + timeout
+        acquired = []
+
+        def ready():
+            if self._lock.acquire(False):
+                acquired.append(True)
+            return bool(acquired)
+
+        while not acquired and self._clock.now < deadline:
+            self._clock._wait(_Wait(deadline, self._lock, ready))
+        return bool(acquired)
+
+    def release(self):
+        """Release the lock and wake any thread blocked on it.
+        """
+        self._lock.release()
+        self._clock._notify(self._lock, math.inf)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def wait(self, timeout=None):
+        """Release the lock and wait for a notify or a virtual timeout.
+
+        :param timeout: Virtual seconds to wait, or None for no limit.
+        :return: Whether the wait was ended by a notify.
+        """
+        deadline = math.inf if timeout is None else self._clock.now + timeout
+        w = _Wait(deadline, self)
+        self.release()
+        try:
+            self._clock._wait(w)
+        finally:
+            self.acquire()
+        return w.woken
+
+    def wait_for(self, predicate, timeout=None):
+        """Wait until a predicate holds, as threading.Condition.wait_for.
+
+        :param predicate: Callable evaluated with the lock held.
+        :param timeout: Virtual seconds to wait, or None for no limit.
+        :return: The last value of the predicate.
+        """
+        end = None if timeout is None else self._clock.now + timeout
+        result = predicate()
+        while not result:
+            remaining = None
+            if end is not None:
+                remaining = end - self._clock.now
+                if remaining <= 0:
+                    break
+            self.wait(remaining)
+            result = predicate()
+        return result
+
+    def notify(self, n=1):
+        self._clock._notify(self, n)
+
+    def notify_all(self):
+        self._clock._notify(self, math.inf)
+
+
+class _TimeModule:
+    # Stands in for the time module inside robot code.
+    def __init__(self, clock):
+        self._clock = clock
+        self.time = clock.time
+        self.monotonic = clock.monotonic
+        self.perf_counter = clock.monotonic
+        self.sleep = clock.sleep
+
+    def process_time(self):
+        return self._clock.busy
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    # Waits for I/O without blocking; the timeout is spent on virtual time.
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or (timeout is not None and timeout <= 0):
+            return ready
+        self._clock.sleep(self._clock.max_step if timeout is None else timeout)
+        return super().select(0)
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """Asyncio event loop whose timers run on a VirtualClock.
+
+    :param clock: Clock to run on.
+    """
+    def __init__(self, clock):
+        super().__init__(_VirtualSelector(clock))
+        self._clock = clock
+
+    def time(self):
+        return self._clock.now
+
+
+class _VirtualLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    def new_event_loop(self):
+        return VirtualEventLoop(_world.clock)
+
+
+class Rect:
+    """A rotated rectangle of board surface.
+
+    :param cx: Centre x in cm.
+    :param cy: Centre y in cm.
+    :param width: Size along the rectangle's x axis in cm.
+    :param height: Size along the rectangle's y axis in cm.
+    :param angle: Rotation in degrees, counter-clockwise.
+    """
+    def __init__(self, cx, cy, width, height, angle=0.0):
+        self.cx = cx
+        self.cy = cy
+        self.half_w = width / 2
+        self.half_h = height / 2
+        self.reach = math.hypot(self.half_w, self.half_h)
+        self._cos = math.cos(math.radians(angle))
+        self._sin = math.sin(math.radians(angle))
+
+    def contains(self, x, y):
+        dx = x - self.cx
+        dy = y - self.cy
+        if abs(dx) > self.reach or abs(dy) > self.reach:
+            return False
+        u = dx * self._cos + dy * self._sin
+        v = -dx * self._sin + dy * self._cos
+        return abs(u) <= self.half_w and abs(v) <= self.half_h
+
+    def distance(self, x, y):
+        """Return the signed distance from a point to the rectangle's edge.
+
+        :param x: Point x in cm.
+        :param y: Point y in cm.
+        :return: Distance in cm, negative inside the rectangle.
+        """
+        dx = x - self.cx
+        dy = y - self.cy
+        du = abs(dx * self._cos + dy * self._sin) - self.half_w
+        dv = abs(-dx * self._sin + dy * self._cos) - self.half_h
+        if du <= 0 and dv <= 0:
+            return max(du, dv)
+        return math.hypot(max(du, 0.0), max(dv, 0.0))
+
+
+class Course:
+    """Layout of the board: start pad, row of black tiles and the tower.
+
+    Distances are in cm. The tile row runs along +x at y=0 with white gaps the
+    same size as the tiles. The robot starts south of the first tile facing
+    north with its color sensor on the start pad.
+
+    :param tiles: Number of black tiles in the row.
+    :param tile_size: Side of a tile in cm.
+    :param row_angle: Rotation of the tile row in degrees.
+    :param tile_jitter: Maximum random offset of each tile in cm.
+    :param start_heading: Error in the robot's starting heading in degrees.
+    :param tower: Tower centre (x, y) in cm.
+    :param tower_radius: Tower radius in cm.
+    :param black: Reflected light intensity of black tiles.
+    :param white: Reflected light intensity of the white background.
+    :param noise: Standard deviation of the color sensor noise.
+    :param glitch_rate: Probability of a bogus ultrasonic reading.
+    :param surface: Kind of board, a key of SURFACE_GRIP.
+    :param seed: Seed for jitter and noise.
+    """
+    def __init__(self, tiles=15, tile_size=10.0, row_angle=0.0, tile_jitter=0.0,
+                 start_heading=0.0, tower=(290.0, -230.0), tower_radius=5.0,
+                 black=8, white=62, noise=1.0, glitch_rate=0.0, surface="mat", seed=0):
+        self.rng = random.Random(seed)
+        self.tile_size = tile_size
+        self.row_angle = row_angle
+        self.black = black
+        self.white = white
+        self.noise = noise
+        self.glitch_rate = glitch_rate
+        self.surface = surface
+        self.grip = SURFACE_GRIP[surface]
+        self.tower = tower
+        self.tower_radius = tower_radius
+        self.tiles = []
+        rot_c = math.cos(math.radians(row_angle))
+        rot_s = math.sin(math.radians(row_angle))
+        for i in range(tiles):
+            x = 2 * tile_size * i + self.rng.uniform(-tile_jitter, tile_jitter)
+            y = self.rng.uniform(-tile_jitter, tile_jitter)
+            self.tiles.append(Rect(x * rot_c - y * rot_s, x * rot_s + y * rot_c,
+                                   tile_size, tile_size, row_angle))
+        pad_y = -3 * tile_size
+        self.start_pad = Rect(0.0, pad_y, 1.5 * tile_size, 1.5 * tile_size)
+        self.start_pose = (0.0, pad_y - COLOR_OFFSET, 90.0 + start_heading)
+        # Grid of cells to the tiles overlapping them, so lookups stay cheap.
+        self._cell = 2 * tile_size
+        self._grid = {}
+        for i, rect in enumerate(self.tiles + [self.start_pad]):
+            index = i if i < len(self.tiles) else -1
+            reach = rect.reach + SPOT_SIZE
+            low_x = int(math.floor((rect.cx - reach) / self._cell))
+            high_x = int(math.floor((rect.cx + reach) / self._cell))
+            low_y = int(math.floor((rect.cy - reach) / self._cell))
+            high_y = int(math.floor((rect.cy + reach) / self._cell))
+            for gx in range(low_x, high_x + 1):
+                for gy in range(low_y, high_y + 1):
+                    self._grid.setdefault((gx, gy), []).append((index, rect))
+
+    @classmethod
+    def random(cls, seed, surface="mat", black=None, white=None, noise=None):
+        """Build a course with randomized tiles, lighting and tower position.
+
+        :param seed: Seed for the layout.
+        :param surface: Kind of board, a key of SURFACE_GRIP.
+        :param black: Reflected light intensity of the tiles, instead of a random one.
+        :param white: Reflected light intensity of the background, instead of a random one.
+        :param noise: Color sensor noise, instead of a random one.
+        :return: A Course.
+        """
+        rng = random.Random(seed)
+        layout = dict(row_angle=rng.uniform(-2, 2), tile_jitter=0.5,
+                      start_heading=rng.uniform(-3, 3),
+                      tower=(rng.uniform(240, 340), rng.uniform(-260, -200)),
+                      black=rng.randint(4, 14), white=rng.randint(50, 70),
+                      noise=rng.uniform(0.5, 2.0), glitch_rate=rng.uniform(0, 0.01))
+        # Overrides are applied after every draw, so the layout stays the same.
+        for name, value in (('black', black), ('white', white), ('noise', noise)):
+            if value is not None:
+                layout[name] = value
+        return cls(surface=surface, seed=seed, **layout)
+
+    def tile_at(self, x, y):
+        """Return the index of the black tile under a point.
+
+        :param x: Point x in cm.
+        :param y: Point y in cm.
+        :return: Tile index, -1 for the start pad or None for white.
+        """
+        cell = (int(math.floor(x / self._cell)), int(math.floor(y / self._cell)))
+        for index, rect in self._grid.get(cell, ()):
+            if rect.contains(x, y):
+                return index
+        return None
+
+    def coverage(self, x, y):
+        """Return how much of the color sensor's light spot is on black.
+
+        :param x: Spot centre x in cm.
+        :param y: Spot centre y in cm.
+        :return: Fraction between 0 and 1.
+        """
+        cell = (int(math.floor(x / self._cell)), int(math.floor(y / self._cell)))
+        nearest = SPOT_SIZE
+        for index, rect in self._grid.get(cell, ()):
+            nearest = min(nearest, rect.distance(x, y))
+        return max(0.0, min(1.0, 0.5 - nearest / SPOT_SIZE))
+
+
+class _MotorState:
+    def __init__(self, port):
+        self.port = port
+        self.position = 0.0
+        self.speed = 0.0
+        self.speed_sp = 0.0
+        self.mode = "stop"
+        self.target = 0.0
+        self.stop_action = "brake"
+        # Milliseconds from standstill to MAX_SPEED while running, 0 for as hard as possible
+        self.ramp_up = 0
+        self.ramp_down = 0
+        # Share of full acceleration used in the last step
+        self.effort = 0.0
+
+    @property
+    def running(self):
+        return self.mode != "stop" or abs(self.speed) > 1e-6
+
+    def step(self, dt, accel, top=MAX_SPEED):
+        if self.mode == "forever":
+            desired = self.speed_sp
+        elif self.mode == "position":
+            desired = math.copysign(abs(self.speed_sp), self.target - self.position)
+        else:
+            desired = 0.0
+            accel = MOTOR_BRAKE if self.stop_action != "coast" else accel / 4
+        # Speed regulation holds anything up to what the battery can deliver.
+        desired = max(-top, min(top, desired))
+        if self.mode != "stop":
+            ramp = self.ramp_up if abs(desired) > abs(self.speed) else self.ramp_down
+            if ramp:
+                accel = min(accel, MAX_SPEED * 1000 / ramp)
+        delta = desired - self.speed
+        change = max(-accel * dt, min(accel * dt, delta))
+        self.effort = min(1.0, abs(change) / (MOTOR_ACCEL * dt)) if dt > 0 and desired else 0.0
+        old_speed = self.speed
+        self.speed += change
+        start = self.position
+        self.position += (old_speed + self.speed) / 2 * dt
+        if self.mode == "position" and (start - self.target) * (self.position - self.target) <= 0:
+            self.position = self.target
+            self.speed = 0.0
+            self.mode = "stop"
+        return self.position - start
+
+
+class Battery:
+    """Simulated EV3 battery, shared by the motors of a World.
+
+    It can be carried from one World to the next to run it down over
+    several laps.
+
+    :param volts: Open-circuit voltage to start at.
+    """
+    def __init__(self, volts=FULL_VOLTS):
+        self.open_volts = volts
+        self.amps = IDLE_CURRENT
+
+    @property
+    def volts(self):
+        """Voltage at the brick under the present load.
+        """
+        return self.open_volts - BATTERY_RESISTANCE * self.amps
+
+    @property
+    def share(self):
+        """Share of their full speed and acceleration the motors have.
+        """
+        return min(1.0, self.volts / RATED_VOLTS)
+
+    def step(self, dt, motors):
+        """Draw the current for dt virtual seconds of the motors running.
+
+        :param dt: Step length in seconds.
+        :param motors: The _MotorState of every motor.
+        """
+        self.amps = IDLE_CURRENT + sum(MOTOR_CURRENT * (abs(state.speed) / MAX_SPEED + state.effort)
+                                       for state in motors)
+        self.open_volts -= VOLTS_PER_AMP_HOUR * self.amps * dt / 3600
+
+
+class World:
+    """Simulated robot on a course, advanced by a VirtualClock.
+
+    :param course: Course to drive on; the default layout if not given.
+    :param max_time: Virtual seconds before the lap is abandoned.
+    :param battery: Battery to run on; a fully charged one if not given.
+    """
+    def __init__(self, course=None, max_time=600.0, battery=None):
+        self.course = course if course is not None else Course()
+        self.battery = battery if battery is not None else Battery()
+        self.clock = VirtualClock(max_time=max_time)
+        self.clock.listeners.append(self.step)
+        self.rng = self.course.rng
+        self.left_port = "outB"
+        self.right_port = "outC"
+        self.motors = {}
+        x, y, heading = self.course.start_pose
+        self.x = x
+        self.y = y
+        self.heading = math.radians(heading)
+        self.tower = list(self.course.tower)
+        self.tower_knocked_at = None
+        self.tiles_visited = set()
+        self.sound_log = []
+        self.distance_driven = 0.0
+        # Speed of each wheel over the ground, which lags the motor when it slips
+        self.ground_left = 0.0
+        self.ground_right = 0.0
+        self.slip = 0.0
+
+    def motor(self, port):
+        """Return the shared state of the motor on a port.
+
+        :param port: Output port name, e.g. 'outB'.
+        :return: The motor's state.
+        """
+        if port not in self.motors:
+            self.motors[port] = _MotorState(port)
+        return self.motors[port]
+
+    def sensor_point(self, offset):
+        """Return the point a forward-facing sensor is looking at.
+
+        :param offset: Distance of the sensor in front of the axle in cm.
+        :return: (x, y) in cm.
+        """
+        return (self.x + offset * math.cos(self.heading),
+                self.y + offset * math.sin(self.heading))
+
+    @property
+    def heading_degrees(self):
+        """Robot heading in degrees, counter-clockwise from +x.
+        """
+        return math.degrees(self.heading)
+
+    @property
+    def tower_knocked(self):
+        """Whether the tower has been pushed off its base.
+        """
+        return self.tower_knocked_at is not None
+
+    def step(self, dt):
+        """Advance motors and robot pose by dt virtual seconds.
+
+        :param dt: Step length in seconds.
+        """
+        share = self.battery.share
+        accel = MOTOR_ACCEL * share
+        top = MAX_SPEED * share
+        left = self.motor(self.left_port).step(dt, accel, top)
+        right = self.motor(self.right_port).step(dt, accel, top)
+        for port, state in self.motors.items():
+            if port not in (self.left_port, self.right_port):
+                state.step(dt, accel, top)
+        self.battery.step(dt, self.motors.values())
+        if left == right == self.ground_left == self.ground_right == 0.0:
+            return
+        grip = self.course.grip * dt
+        old_left, old_right = self.ground_left, self.ground_right
+        self.ground_left += max(-grip, min(grip, left / dt - old_left))
+        self.ground_right += max(-grip, min(grip, right / dt - old_right))
+        ground_left = (old_left + self.ground_left) / 2 * dt
+        ground_right = (old_right + self.ground_right) / 2 * dt
+        self.slip += abs(left - ground_left) + abs(right - ground_right)
+        cm_per_degree = math.pi * WHEEL_DIAMETER / 360
+        dl = ground_left * cm_per_degree
+        dr = ground_right * cm_per_degree
+        ds = (dl + dr) / 2
+        dtheta = (dr - dl) / AXLE_TRACK
+        mid = self.heading + dtheta / 2
+        self.x += ds * math.cos(mid)
+        self.y += ds * math.sin(mid)
+        self.heading += dtheta
+        self.distance_driven += abs(ds)
+        tile = self.course.tile_at(*self.sensor_point(COLOR_OFFSET))
+        if tile is not None and tile >= 0:
+            self.tiles_visited.add(tile)
+        self._push_tower()
+
+    def _push_tower(self):
+        r = self.course.tower_radius
+        dx = self.tower[0] - self.x
+        dy = self.tower[1] - self.y
+        cos_h = math.cos(self.heading)
+        sin_h = math.sin(self.heading)
+        forward = dx * cos_h + dy * sin_h
+        lateral = -dx * sin_h + dy * cos_h
+        if 0 < forward < BODY_FRONT + r and abs(lateral) < BODY_HALF_WIDTH:
+            forward = BODY_FRONT + r
+            self.tower[0] = self.x + forward * cos_h - lateral * sin_h
+            self.tower[1] = self.y + forward * sin_h + lateral * cos_h
+            base = self.course.tower
+            moved = math.hypot(self.tower[0] - base[0], self.tower[1] - base[1])
+            if moved > r and self.tower_knocked_at is None:
+                self.tower_knocked_at = self.clock.now
+
+    def reflected_light(self):
+        """Return what the color sensor reads at the current pose.
+
+        :return: Reflected light intensity, 0-100.
+        """
+        course = self.course
+        # The light spot has a size, so edges read as a blend of both colors.
+        black = course.coverage(*self.sensor_point(COLOR_OFFSET))
+        value = course.white + (course.black - course.white) * black + self.rng.gauss(0, course.noise)
+        return int(max(0, min(100, round(value))))
+
+    def ambient_light(self):
+        """Return what the color sensor reads in ambient mode.
+
+        :return: Ambient light intensity, 0-100.
+        """
+        # Brighter rooms make the white board read brighter too.
+        return int(self.course.white / 5)
+
+    def battery_volts(self):
+        """Return what the brick measures the battery voltage as.
+
+        :return: Volts, to the millivolt.
+        """
+        return round(self.battery.volts, 3)
+
+    def battery_amps(self):
+        """Return what the brick measures the battery current as.
+
+        :return: Amps, to the milliamp.
+        """
+        return round(self.battery.amps, 3)
+
+    def ultrasonic_distance(self, beam=15.0):
+        """Return what the ultrasonic sensor reads at the current pose.
+
+        :param beam: Half-angle of the sensor's cone in degrees.
+        :return: Distance in cm, 255.0 if nothing is in range.
+        """
+        if self.rng.random() < self.course.glitch_rate:
+            return round(self.rng.uniform(3, 255), 1)
+        sx, sy = self.sensor_point(ULTRASONIC_OFFSET)
+        dx = self.tower[0] - sx
+        dy = self.tower[1] - sy
+        bearing = math.degrees(math.atan2(dy, dx) - self.heading)
+        bearing = (bearing + 180) % 360 - 180
+        if abs(bearing) > beam:
+            return 255.0
+        dist = math.hypot(dx, dy) - self.course.tower_radius
+        return round(max(0.0, min(255.0, dist)), 1)
+
+
+_world = None
+_patched = set()
+
+
+def _active():
+    # World the fake drivers attach to; robot modules get the virtual clock.
+    if _world is None:
+        raise RuntimeError("simulator.install() has not been called")
+    patch_modules()
+    return _world
+
+
+def patch_modules():
+    """Point ``time`` and ``Condition`` in every repo module at the sim clock.
+    """
+    clock = _world.clock
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if not path or not os.path.abspath(path).startswith(SRC_DIR + os.sep):
+            continue
+        if os.path.abspath(path) == os.path.abspath(__file__):
+            continue
+        namespace = vars(module)
+        if namespace.get("time") is time or isinstance(namespace.get("time"), _TimeModule):
+            module.time = clock.module
+        cond = namespace.get("Condition")
+        if cond is threading.Condition or isinstance(getattr(cond, "__self__", None), VirtualClock):
+            module.Condition = clock.Condition
+
+
+def _speed_native(speed, max_speed=MAX_SPEED):
+    if hasattr(speed, "to_native_units"):
+        return speed.to_native_units(None)
+    if not -100 <= speed <= 100:
+        raise ValueError("{} is an invalid percentage, must be between -100 and 100 (inclusive)"
+                         .format(speed))
+    return speed / 100 * max_speed
+
+
+class SpeedPercent:
+    def __init__(self, percent):
+        if not -100 <= percent <= 100:
+            raise ValueError("{} is an invalid percentage".format(percent))
+        self.percent = percent
+
+    def to_native_units(self, motor=None):
+        return self.percent / 100 * MAX_SPEED
+
+
+class SpeedDPS:
+    def __init__(self, degrees_per_second):
+        self.degrees_per_second = degrees_per_second
+
+    def to_native_units(self, motor=None):
+        return self.degrees_per_second
+
+
+class LargeMotor:
+    """Simulated ev3dev2.motor.LargeMotor.
+    """
+    max_speed = MAX_SPEED
+    count_per_rot = 360
+
+    def __init__(self, address=None, **kwargs):
+        self._world = _active()
+        self.address = address or "outA"
+        self._state = self._world.motor(self.address)
+
+    @property
+    def position(self):
+        self._world.clock.consume(ENCODER_READ_COST)
+        return int(round(self._state.position))
+
+    @position.setter
+    def position(self, value):
+        self._state.position = float(value)
+
+    @property
+    def speed(self):
+        self._world.clock.consume(ENCODER_READ_COST)
+        return int(round(self._state.speed))
+
+    @property
+    def is_running(self):
+        return self._state.running
+
+    @property
+    def state(self):
+        return ["running"] if self._state.running else []
+
+    @property
+    def ramp_up_sp(self):
+        return self._state.ramp_up
+
+    @ramp_up_sp.setter
+    def ramp_up_sp(self, value):
+        self._state.ramp_up = int(value)
+
+    @property
+    def ramp_down_sp(self):
+        return self._state.ramp_down
+
+    @ramp_down_sp.setter
+    def ramp_down_sp(self, value):
+        self._state.ramp_down = int(value)
+
+    @property
+    def stop_action(self):
+        return self._state.stop_action
+
+    @stop_action.setter
+    def stop_action(self, value):
+        self._state.stop_action = value
+
+    def reset(self):
+        self._state.mode = "stop"
+        self._state.speed = 0.0
+        self._state.position = 0.0
+
+    def run_forever(self, speed_sp):
+        self._state.speed_sp = speed_sp
+        self._state.mode = "forever"
+
+    def run_to_rel_pos(self, position_sp, speed_sp):
+        self._state.target = self._state.position + position_sp
+        self._state.speed_sp = abs(speed_sp)
+        self._state.mode = "position"
+
+    def stop(self, stop_action=None):
+        if stop_action is not None:
+            self._state.stop_action = stop_action
+        self._state.mode = "stop"
+
+    def on(self, speed, brake=True, block=False):
+        self.run_forever(_speed_native(speed))
+
+    def off(self, brake=True):
+        self.stop("brake" if brake else "coast")
+
+    def on_for_degrees(self, speed, degrees, brake=True, block=True):
+        native = _speed_native(speed)
+        if native < 0:
+            degrees = -degrees
+        self._state.stop_action = "brake" if brake else "coast"
+        self.run_to_rel_pos(int(round(degrees)), native)
+        if block:
+            self.wait_until_not_moving()
+
+    def on_for_rotations(self, speed, rotations, brake=True, block=True):
+        self.on_for_degrees(speed, rotations * 360, brake, block)
+
+    def on_for_seconds(self, speed, seconds, brake=True, block=True):
+        self.on(speed)
+        if block:
+            self._world.clock.sleep(seconds)
+            self.off(brake)
+
+    def wait_until_not_moving(self, timeout=None):
+        return self._world.clock.wait_for(lambda: not self._state.running, timeout=timeout)
+
+
+class MediumMotor(LargeMotor):
+    max_speed = 1560
+
+
+class MoveTank:
+    """Simulated ev3dev2.motor.MoveTank.
+    """
+    def __init__(self, left_motor_port, right_motor_port, desc=None, motor_class=LargeMotor):
+        self._world = _active()
+        self.left_motor = motor_class(left_motor_port)
+        self.right_motor = motor_class(right_motor_port)
+        self._world.left_port = left_motor_port
+        self._world.right_port = right_motor_port
+
+    @property
+    def is_running(self):
+        return self.left_motor.is_running or self.right_motor.is_running
+
+    def on_for_degrees(self, left_speed, right_speed, degrees, brake=True, block=True):
+        left_native = _speed_native(left_speed)
+        right_native = _speed_native(right_speed)
+        if degrees == 0 or (left_native == 0 and right_native == 0):
+            left_degrees = right_degrees = degrees
+        elif abs(left_native) > abs(right_native):
+            left_degrees = degrees
+            right_degrees = abs(right_native / left_native) * degrees
+        else:
+            left_degrees = abs(left_native / right_native) * degrees
+            right_degrees = degrees
+        for motor, speed, deg in ((self.left_motor, left_native, left_degrees),
+                                  (self.right_motor, right_native, right_degrees)):
+            motor.stop_action = "brake" if brake else "coast"
+            motor.run_to_rel_pos(int(round(deg if speed >= 0 else -deg)), speed)
+        if block:
+            self.wait_until_not_moving()
+
+    def on_for_rotations(self, left_speed, right_speed, rotations, brake=True, block=True):
+        self.on_for_degrees(left_speed, right_speed, rotations * 360, brake, block)
+
+    def on_for_seconds(self, left_speed, right_speed, seconds, brake=True, block=True):
+        self.on(left_speed, right_speed)
+        if block:
+            self._world.clock.sleep(seconds)
+            self.off(brake=brake)
+
+    def on(self, left_speed, right_speed):
+        self.left_motor.run_forever(_speed_native(left_speed))
+        self.right_motor.run_forever(_speed_native(right_speed))
+
+    def off(self, motors=None, brake=True):
+        for motor in motors or (self.left_motor, self.right_motor):
+            motor.off(brake)
+
+    def wait_until_not_moving(self, timeout=None):
+        return self._world.clock.wait_for(lambda: not self.is_running, timeout=timeout)
+
+
+class MoveSteering(MoveTank):
+    """Simulated ev3dev2.motor.MoveSteering.
+    """
+    def get_speed_steering(self, steering, speed):
+        if not -100 <= steering <= 100:
+            raise ValueError("{} is an invalid steering, must be between -100 and 100 (inclusive)"
+                             .format(steering))
+        left_speed = _speed_native(speed)
+        right_speed = left_speed
+        speed_factor = (50 - abs(float(steering))) / 50
+        if steering >= 0:
+            right_speed *= speed_factor
+        else:
+            left_speed *= speed_factor
+        return left_speed, right_speed
+
+    def on_for_degrees(self, steering, speed, degrees, brake=True, block=True):
+        left, right = self.get_speed_steering(steering, speed)
+        MoveTank.on_for_degrees(self, SpeedDPS(left), SpeedDPS(right), degrees, brake, block)
+
+    def on_for_rotations(self, steering, speed, rotations, brake=True, block=True):
+        self.on_for_degrees(steering, speed, rotations * 360, brake, block)
+
+    def on_for_seconds(self, steering, speed, seconds, brake=True, block=True):
+        left, right = self.get_speed_steering(steering, speed)
+        MoveTank.on_for_seconds(self, SpeedDPS(left), SpeedDPS(right), seconds, brake, block)
+
+    def on(self, steering, speed):
+        left, right = self.get_speed_steering(steering, speed)
+        MoveTank.on(self, SpeedDPS(left), SpeedDPS(right))
+
+
+class ColorSensor:
+    """Simulated ev3dev2.sensor.lego.ColorSensor.
+    """
+    COLOR_BLACK = 1
+    COLOR_WHITE = 6
+
+    def __init__(self, address=None, **kwargs):
+        self._world = _active()
+        self.address = address
+        self.mode = "COL-REFLECT"
+
+    @property
+    def reflected_light_intensity(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return self._world.reflected_light()
+
+    @property
+    def ambient_light_intensity(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return self._world.ambient_light()
+
+    @property
+    def color(self):
+        value = self.reflected_light_intensity
+        return self.COLOR_BLACK if value < 30 else self.COLOR_WHITE
+
+
+class UltrasonicSensor:
+    """Simulated ev3dev2.sensor.lego.UltrasonicSensor.
+    """
+    def __init__(self, address=None, **kwargs):
+        self._world = _active()
+        self.address = address
+
+    @property
+    def distance_centimeters(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return self._world.ultrasonic_distance()
+
+    distance_centimeters_continuous = distance_centimeters
+
+    @property
+    def distance_inches(self):
+        return self.distance_centimeters / 2.54
+
+    @property
+    def other_sensor_present(self):
+        return False
+
+
+class TouchSensor:
+    """Simulated ev3dev2.sensor.lego.TouchSensor; nobody ever presses it.
+    """
+    def __init__(self, address=None, **kwargs):
+        self._world = _active()
+
+    @property
+    def is_pressed(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return False
+
+    def wait_for_pressed(self, timeout_ms=None, sleep_ms=10):
+        timeout = None if timeout_ms is None else timeout_ms / 1000
+        return self._world.clock.wait_for(lambda: self.is_pressed, sleep_ms / 1000, timeout)
+
+
+class Button:
+    """Simulated ev3dev2.button.Button; no button is ever held.
+    """
+    def __init__(self):
+        self._world = _active()
+
+    def any(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return False
+
+
+class PowerSupply:
+    """Simulated ev3dev2.power.PowerSupply reading the world's battery.
+    """
+    max_voltage = 9000000
+    min_voltage = 5000000
+    technology = "Li-ion"
+    type = "Battery"
+
+    def __init__(self, address=None, name_pattern=None, name_exact=False, **kwargs):
+        self._world = _active()
+
+    @property
+    def measured_volts(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return self._world.battery_volts()
+
+    @property
+    def measured_amps(self):
+        self._world.clock.consume(SENSOR_READ_COST)
+        return self._world.battery_amps()
+
+    @property
+    def measured_voltage(self):
+        return int(self.measured_volts * 1e6)
+
+    @property
+    def measured_current(self):
+        return int(self.measured_amps * 1e6)
+
+
+class Sound:
+    """Simulated ev3dev2.sound.Sound that logs what would be played.
+    """
+    PLAY_WAIT_FOR_COMPLETE = 0
+    PLAY_NO_WAIT_FOR_COMPLETE = 1
+    PLAY_LOOP = 2
+
+    def __init__(self):
+        self._world = _active()
+
+    def _play(self, kind, arg, duration, play_type):
+        world = self._world
+        world.sound_log.append((world.clock.now, kind, arg))
+        if play_type == self.PLAY_WAIT_FOR_COMPLETE:
+            world.clock.sleep(duration)
+
+    def beep(self, args="", play_type=PLAY_WAIT_FOR_COMPLETE):
+        self._play("beep", args, 0.2, play_type)
+
+    def play_tone(self, frequency, duration, delay=0.0, volume=100,
+                  play_type=PLAY_WAIT_FOR_COMPLETE):
+        self._play("tone", frequency, duration + delay, play_type)
+
+    def speak(self, text, espeak_opts="-a 200 -s 130", volume=100,
+              play_type=PLAY_WAIT_FOR_COMPLETE):
+        # espeak takes a moment to synthesize before it starts talking.
+        self._play("speak", text, 0.4 + 0.075 * len(text), play_type)
+
+    def play_file(self, wav_file, volume=100, play_type=PLAY_WAIT_FOR_COMPLETE):
+        with wave.open(wav_file) as w:
+            duration = w.getnframes() / w.getframerate()
+        self._play("file", os.path.basename(wav_file), duration, play_type)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install(world):
+    """Make ``import ev3dev2`` load the simulated drivers for a world.
+
+    Devices constructed after this call attach to ``world``, and new asyncio
+    event loops run on its clock. Call it again with a fresh World before
+    each lap.
+
+    :param world: The World the drivers should act on.
+    :return: The world.
+    """
+    global _world
+    _world = world
+    if "ev3dev2" not in sys.modules or not getattr(sys.modules["ev3dev2"], "SIMULATED", False):
+        motor = _module("ev3dev2.motor", LargeMotor=LargeMotor, MediumMotor=MediumMotor,
+                        MoveTank=MoveTank, MoveSteering=MoveSteering,
+                        SpeedPercent=SpeedPercent, SpeedDPS=SpeedDPS,
+                        OUTPUT_A="outA", OUTPUT_B="outB", OUTPUT_C="outC", OUTPUT_D="outD")
+        lego = _module("ev3dev2.sensor.lego", ColorSensor=ColorSensor,
+                       UltrasonicSensor=UltrasonicSensor, TouchSensor=TouchSensor)
+        sensor = _module("ev3dev2.sensor", lego=lego, INPUT_1="in1", INPUT_2="in2",
+                         INPUT_3="in3", INPUT_4="in4")
+        sound = _module("ev3dev2.sound", Sound=Sound)
+        button = _module("ev3dev2.button", Button=Button)
+        power = _module("ev3dev2.power", PowerSupply=PowerSupply)
+        root = _module("ev3dev2", SIMULATED=True, motor=motor, sensor=sensor,
+                       sound=sound, button=button, power=power, __all__=[])
+        root.__path__ = []
+        sys.modules.update({"ev3dev2": root, "ev3dev2.motor": motor, "ev3dev2.sensor": sensor,
+                            "ev3dev2.sensor.lego": lego, "ev3dev2.sound": sound,
+                            "ev3dev2.button": button, "ev3dev2.power": power})
+    asyncio.set_event_loop_policy(_VirtualLoopPolicy())
+    patch_modules()
+    return world
+
+
+def load_variant(path):
+    """Import one of the robot scripts by file path under the simulator.
+
+    :param path: Path to the script, e.g. 'src/test.py'.
+    :return: The imported module.
+    """
+    path = os.path.abspath(path)
+    name = "variant_" + "".join(c if c.isalnum() else "_" for c in
+                                os.path.splitext(os.path.basename(path))[0])
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    sys.path.insert(0, os.path.dirname(path))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(os.path.dirname(path))
+    return module
+
+
+class Lap:
+    """Outcome of one simulated run of a Robot.
+
+    :param world: World the lap was driven in.
+    :param real_time: Wall-clock seconds the simulation took.
+    :param error: Exception that ended the lap early, if any.
+    """
+    def __init__(self, world, real_time, error=None):
+        self.world = world
+        self.lap_time = world.clock.now
+        self.real_time = real_time
+        self.error = error
+        self.tiles_visited = len(world.tiles_visited)
+        self.tower_knocked = world.tower_knocked
+        self.cpu_load = world.clock.busy / world.clock.now if world.clock.now else 0.0
+        self.slip = world.slip
+        # Gap between the front of the robot and the tower at the end
+        gap = math.hypot(world.tower[0] - world.x, world.tower[1] - world.y)
+        self.tower_distance = max(0.0, gap - world.course.tower_radius - BODY_FRONT)
+
+    def __str__(self):
+        return "lap {:7.2f} s  real {:6.3f} s  tiles {:2d}  tower {}  cpu {:4.0%}  slip {:5.0f}{}".format(
+            self.lap_time, self.real_time, self.tiles_visited,
+            "knocked" if self.tower_knocked else "standing", self.cpu_load, self.slip,
+            "  ({})".format(type(self.error).__name__) if self.error else "")
+
+
+def run_lap(robot_class, course=None, max_time=600.0, method="run", world=None, configure=None):
+    """Construct a Robot in a fresh world and time one call of its run method.
+
+    :param robot_class: Robot class to construct.
+    :param course: Course to drive; the default layout if not given.
+    :param max_time: Virtual seconds before the lap is abandoned.
+    :param method: Name of the method to call.
+    :param world: World to use instead of a new one for the course.
+    :param configure: Callable given the Robot before the method is called.
+    :return: A Lap.
+    """
+    world = install(world if world is not None else World(course, max_time=max_time))
+    start = time.perf_counter()
+    error = None
+    try:
+        robot = robot_class()
+        if configure is not None:
+            configure(robot)
+        getattr(robot, method)()
+    except Exception as e:
+        error = e
+    finally:
+        # Let any thread the robot left behind see the timeout and exit.
+        world.clock.expired = True
+        with world.clock._cv:
+            world.clock._cv.notify_all()
+    return Lap(world, time.perf_counter() - start, error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time Robot.run() on a simulated course.")
+    parser.add_argument("--variant", default=os.path.join(os.path.dirname(__file__), "runRobot.py"),
+                        help="robot script to run")
+    parser.add_argument("--robot", default="Robot", help="name of the robot class in the script")
+    parser.add_argument("--laps", type=int, default=10, help="number of laps")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="randomize the course from this seed")
+    parser.add_argument("--max-time", type=float, default=600.0,
+                        help="virtual seconds before a lap is abandoned")
+    parser.add_argument("--surface", choices=sorted(SURFACE_GRIP), default="mat",
+                        help="kind of board the course is laid on")
+    parser.add_argument("--volts", type=float, default=FULL_VOLTS,
+                        help="open-circuit battery voltage at the start of each lap")
+    args = parser.parse_args()
+
+    install(World())
+    robot_class = getattr(load_variant(args.variant), args.robot)
+    laps = []
+    start = time.perf_counter()
+    for i in range(args.laps):
+        if args.seed is None:
+            course = Course(surface=args.surface)
+        else:
+            course = Course.random(args.seed + i, args.surface)
+        lap = run_lap(robot_class, world=World(course, args.max_time, Battery(args.volts)))
+        laps.append(lap)
+        print("{:3d}: {}".format(i + 1, lap))
+    elapsed = time.perf_counter() - start
+    virtual = sum(lap.lap_time for lap in laps)
+    print("{} laps, {:.1f} s simulated in {:.2f} s ({:.0f}x real time, {:.0f} laps/min)".format(
+        len(laps), virtual, elapsed, virtual / elapsed, 60 * len(laps) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Ultrasonic sweeps recorded as the robot turns on the spot.
+
+A sweep keeps (angle, distance) pairs in two compact arrays. Single-sample
+glitches are removed with a running median, and the tower shows up as a
+valley: a run of close readings with far ones, or the ends of the sweep, on
+either side. The bearing of the tower is the middle of that run, since the
+sensor sees it across the whole width of its beam.
+"""
+from array import array
+
+
+def median_filter(values, window=5):
+    """Return the running median of a sequence.
+
+    The window shrinks at the ends so the result is as long as the input.
+
+    :param values: Readings.
+    :param window: Odd number of samples to take the median over.
+    :return: Filtered readings as an array of floats.
+    """
+    half = window // 2
+    result = array("f")
+    for i in range(len(values)):
+        around = sorted(values[max(0, i - half):i + half + 1])
+        result.append(around[len(around) // 2])
+    return result
+
+
+class Sweep:
+    """Distances read by the ultrasonic sensor during one turn.
+
+    Angles are in robot degrees from where the sweep started, positive
+    clockwise as in Robot.turn().
+    """
+    def __init__(self):
+        self.angles = array("f")
+        self.distances = array("f")
+
+    def __len__(self):
+        return len(self.angles)
+
+    def add(self, angle, distance):
+        """Record a reading.
+
+        :param angle: Robot angle when the reading was taken.
+        :param distance: Distance in cm.
+        """
+        self.angles.append(angle)
+        self.distances.append(distance)
+
+    def valleys(self, window=5, tolerance=3.0):
+        """Find the runs of readings that are nearer than their neighbours.
+
+        :param window: Median filter window.
+        :param tolerance: How far above its lowest reading a run extends, in cm.
+        :return: List of (angle, distance, width) for each valley, where angle
+            is the middle of the run and width is the angle it spans.
+        """
+        filtered = median_filter(self.distances, window)
+        found = []
+        i = 0
+        count = len(filtered)
+        while i < count:
+            # Walk down to the bottom of the next dip.
+            while i + 1 < count and filtered[i + 1] <= filtered[i]:
+                i += 1
+            lowest = filtered[i]
+            first = i
+            while first > 0 and filtered[first - 1] <= lowest + tolerance:
+                first -= 1
+            last = i
+            while last + 1 < count and filtered[last + 1] <= lowest + tolerance:
+                last += 1
+            if not found or found[-1][1] < first:
+                found.append((first, last, lowest))
+            i = last + 1
+            # Climb out of the valley before looking for the next one.
+            while i < count and filtered[i] >= filtered[i - 1]:
+                i += 1
+        return [((self.angles[first] + self.angles[last]) / 2, lowest,
+                 abs(self.angles[last] - self.angles[first]))
+                for first, last, lowest in found]
+
+    def nearest(self, window=5, tolerance=3.0, out_of_range=255.0, complete=False):
+        """Return the nearest valley, preferring ones not cut off by the ends.
+
+        :param window: Median filter window.
+        :param tolerance: How far above its lowest reading a valley extends, in cm.
+        :param out_of_range: Reading the sensor gives when it sees nothing.
+        :param complete: Ignore valleys cut off by the ends altogether.
+        :return: (angle, distance), or None if nothing was in range.
+        """
+        if not len(self):
+            return None
+        start, end = self.angles[0], self.angles[-1]
+        best = None
+        for angle, distance, width in self.valleys(window, tolerance):
+            if distance >= out_of_range:
+                continue
+            edge = min(abs(angle - start), abs(end - angle)) <= width / 2
+            if edge and complete:
+                continue
+            key = (edge, distance)
+            if best is None or key < best[0]:
+                best = key, angle, distance
+        if best is None:
+            return None
+        return best[1], best[2]
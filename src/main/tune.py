@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Pick the edge-following PID gains offline, against courses lit like recorded laps.
+
+The light and dark levels and the sensor noise are read off the color
+samples in each trace recorded by recorder.py, and randomized courses are
+built with them in the simulator. runRobot then drives a full lap on each
+course in 'follow' count mode for every combination of gains in the grid,
+and the combinations are ranked by how long counting took, how closely the
+sensor held the edge, and how many tiles it passed beside or miscounted.
+
+With --save, the best gains are cached in calibration.json for the board,
+where Robot.load_gains() picks them up.
+
+Usage::
+
+    python3 tune.py traces/*.trace
+    python3 tune.py --kp 0.4,0.8,1.2 --kd 0,0.02 --speed 70 traces/lap.trace
+    python3 tune.py --save --board wood traces/*.trace
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+# By name, so the simulator does not swap it for the virtual clock
+from time import perf_counter
+
+import calibration
+import recorder
+import simulator
+
+# Seconds a tile passed beside, or a wrong count, is worth in the score
+MISS_PENALTY = 5.0
+
+# Seconds a unit of mean tracking error is worth in the score
+TRACKING_WEIGHT = 0.1
+
+
+def levels(trace, name='color'):
+    """Estimate the tile and background readings and the noise from a trace.
+
+    The readings are split halfway between their 5th and 95th percentiles,
+    and each side's median is its level. The noise is taken from the
+    differences between successive readings, which are mostly both on the
+    same color: their median, scaled to the standard deviation of one reading.
+
+    :param trace: TraceRecorder, e.g. from recorder.load().
+    :param name: Name of the color sensor channel.
+    :return: (black, white, noise), or None if the trace has no color readings.
+    """
+    readings = [value for _, kind, channel, value, _, _ in trace.events()
+                if kind == recorder.SENSOR and channel == name]
+    if len(readings) < 2:
+        return None
+    values = sorted(readings)
+    split = (values[len(values) // 20] + values[-1 - len(values) // 20]) / 2
+    black = calibration.median([v for v in values if v < split] or values)
+    white = calibration.median([v for v in values if v >= split] or values)
+    steps = [abs(b - a) for a, b in zip(readings, readings[1:])]
+    # The median of |a - b| for two normal readings is 0.954 of one's deviation
+    return black, white, calibration.median(steps) / 0.954
+
+
+class Score:
+    """Laps driven with one set of gains.
+
+    :param gains: (kp, ki, kd).
+    :param laps: List of (simulator.Lap, tiles counted, seconds counting,
+        mean tracking error), one per course.
+    """
+    def __init__(self, gains, laps):
+        self.gains = gains
+        self.laps = laps
+
+    @property
+    def missed(self):
+        """Tiles passed beside or miscounted, over all laps; a lap that failed misses all.
+        """
+        missed = 0
+        for lap, counted, _, _ in self.laps:
+            tiles = len(lap.world.course.tiles)
+            if lap.error is not None:
+                missed += tiles
+            else:
+                missed += (tiles - lap.tiles_visited) + abs(tiles - counted)
+        return missed
+
+    @property
+    def count_time(self):
+        """Mean seconds spent counting tiles.
+        """
+        times = [seconds for _, _, seconds, _ in self.laps if seconds is not None]
+        return sum(times) / len(times) if times else None
+
+    @property
+    def tracking_error(self):
+        """Mean of the laps' mean tracking errors.
+        """
+        return sum(error for _, _, _, error in self.laps) / len(self.laps)
+
+    @property
+    def value(self):
+        """Seconds counting, plus penalties; lower is better.
+        """
+        if self.count_time is None:
+            return float('inf')
+        return (self.count_time + TRACKING_WEIGHT * self.tracking_error
+                + MISS_PENALTY * self.missed / len(self.laps))
+
+
+def evaluate(robot_class, gains, courses, speed=None, max_time=300.0):
+    """Drive a lap in follow mode on each course with some gains.
+
+    :param robot_class: runRobot's Robot class, from simulator.load_variant().
+    :param gains: (kp, ki, kd).
+    :param courses: Callable returning a fresh list of simulator.Course, as
+        courses keep their own noise generator.
+    :param speed: Follow speed, or None for the Robot's own.
+    :param max_time: Virtual seconds before a lap is abandoned.
+    :return: A Score.
+    """
+    laps = []
+    for course in courses():
+        robots = []
+        with tempfile.TemporaryDirectory() as scratch:
+
+            def configure(robot):
+                robot.trace_dir = None
+                robot.map_file = None
+                # Thresholds come from each course, not from laps on other ones
+                # or from the brick's own cache.
+                robot.calibration_file = os.path.join(scratch, 'calibration.json')
+                robot.count_mode = 'follow'
+                if speed is not None:
+                    robot.follow_speed = speed
+                robots.append(robot)
+                load_gains = robot.load_gains
+
+                def load():
+                    # Any gains cached for the board would replace the ones under test.
+                    load_gains()
+                    robot.follower.gains = gains
+                robot.load_gains = load
+
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                lap = simulator.run_lap(robot_class, course, max_time, configure=configure)
+        robot = robots[0] if robots else None
+        if robot is None:
+            laps.append((lap, 0, None, 0.0))
+            continue
+        counting = robot.profile.phases.get('count_tiles')
+        laps.append((lap, robot.follower.count, counting[0] if counting else None,
+                     robot.follower.tracking_error))
+    return Score(tuple(gains), laps)
+
+
+def _floats(text):
+    return [float(x) for x in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grid-search the edge-following PID gains.")
+    parser.add_argument("traces", nargs="*",
+                        help="trace files whose color levels the courses copy; random levels if none")
+    parser.add_argument("--kp", type=_floats, default=[0.4, 0.8, 1.2], help="comma-separated kp values")
+    parser.add_argument("--ki", type=_floats, default=[0.0, 0.5], help="comma-separated ki values")
+    parser.add_argument("--kd", type=_floats, default=[0.0, 0.02, 0.05], help="comma-separated kd values")
+    parser.add_argument("--speed", type=int, default=None, help="follow speed; the Robot's own if not given")
+    parser.add_argument("--laps", type=int, default=3, help="courses per trace")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first course")
+    parser.add_argument("--surface", choices=sorted(simulator.SURFACE_GRIP), default="mat",
+                        help="kind of board the courses are laid on")
+    parser.add_argument("--max-time", type=float, default=300.0,
+                        help="virtual seconds before a lap is abandoned")
+    parser.add_argument("--board", default="default", help="board the gains are saved for")
+    parser.add_argument("--calibration", default=calibration.CACHE, help="calibration file to save to")
+    parser.add_argument("--save", action="store_true", help="cache the best gains for the board")
+    args = parser.parse_args()
+
+    lighting = []
+    for path in args.traces:
+        found = levels(recorder.load(path))
+        if found is None:
+            print("{}: no color readings, skipped".format(path))
+            continue
+        print("{}: black {:.0f}, white {:.0f}, noise {:.1f}".format(path, *found))
+        lighting.append(found)
+    if args.traces and not lighting:
+        return 1
+    lighting = lighting or [(None, None, None)]
+    seeds = range(args.seed, args.seed + args.laps)
+
+    def courses():
+        return [simulator.Course.random(seed, args.surface, black, white, noise)
+                for black, white, noise in lighting for seed in seeds]
+
+    simulator.install(simulator.World())
+    robot_class = simulator.load_variant(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      "runRobot.py")).Robot
+    start = perf_counter()
+    scores = []
+    print("{:>6} {:>6} {:>6} {:>9} {:>8} {:>7} {:>7}".format(
+        "kp", "ki", "kd", "count s", "track", "missed", "score"))
+    for gains in itertools.product(args.kp, args.ki, args.kd):
+        score = evaluate(robot_class, gains, courses, args.speed, args.max_time)
+        scores.append(score)
+        print("{:>6g} {:>6g} {:>6g} {:>9} {:>8.1f} {:>7} {:>7.2f}".format(
+            gains[0], gains[1], gains[2],
+            "-" if score.count_time is None else "{:.2f}".format(score.count_time),
+            score.tracking_error, score.missed, score.value))
+    best = min(scores, key=lambda score: score.value)
+    print("{} gains x {} courses in {:.1f} s; best kp {:g}, ki {:g}, kd {:g}".format(
+        len(scores), len(courses()), perf_counter() - start, *best.gains))
+    if args.save:
+        calibration.save_pid('follow/' + args.board, best.gains, args.calibration)
+        print("saved to {} as follow/{}".format(args.calibration, args.board))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
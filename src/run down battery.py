@@ -1,169 +1,146 @@
 #!/usr/bin/env python3
-import math
+"""Run the battery down lap by lap, logging lap time against voltage.
+
+Each round the robot drives a full lap of the course with main/runRobot.py,
+then runs its motors at drain_speed for drain_time on its stand, wheels
+off the ground, to use up the battery faster than laps alone would. Before
+every lap and every drain, it beeps and waits for a button press: put it on
+the start pad, or on the stand, and press any button.
+
+One row per lap is appended to the log: the voltage at rest just before the
+lap, the lowest the robot measured during it and the mean current, and how
+long it took. The test stops once the voltage at rest is below the floor.
+With --uncompensated, the robot drives without the speed and acceleration
+caps from main/power.py, to show what they save.
+
+Usage::
+
+    python3 "run down battery.py"
+    python3 "run down battery.py" --drain 600 --floor 6.9 --log drain.csv
+    python3 "run down battery.py" --uncompensated --log uncompensated.csv
+"""
+import argparse
+import csv
+import os
+import sys
 import time
-from threading import Thread
 
-from ev3dev2 import *
 from ev3dev2.button import Button
 from ev3dev2.motor import MoveTank, OUTPUT_B, OUTPUT_C
-from ev3dev2.sensor.lego import ColorSensor, TouchSensor, UltrasonicSensor
+from ev3dev2.power import PowerSupply
 from ev3dev2.sound import Sound
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main"))
 
-class Robot:
-    def __init__(self):
-        self.tank_pair = MoveTank(OUTPUT_B, OUTPUT_C)
-        self.color_sensor = ColorSensor()
-        self.ultrasonic = UltrasonicSensor()
-        self.sound = Sound()
-        self.tile_length = 200
-        # Ranges for color intensities
-        self.black_range = range(0, 30)
-        self.white_range = range(30, 100)
-        self.sensor_dist = 86
-
-    def move_degrees(self, degrees, speed=20):
-        if degrees >= 0:
-            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=speed, degrees=degrees)
-        else:
-            self.tank_pair.on_for_degrees(left_speed=-speed, right_speed=-speed, degrees=-degrees)
-
-    def steer_on(self, steering, speed=20):
-        if steering >= 0:
-            self.tank_pair.on(left_speed=speed, right_speed=0)
-        else:
-            self.tank_pair.on(left_speed=0, right_speed=speed)
-
-    def on(self, speed=20):
-        self.tank_pair.on(left_speed=speed, right_speed=speed)
-
-    def off(self):
-        self.tank_pair.off()
-
-    def on_white(self):
-        return self.color_sensor.reflected_light_intensity in self.white_range
-
-    def on_black(self):
-        return self.color_sensor.reflected_light_intensity in self.black_range
-
-    def skip_white(self, speed=20):
-        self.on(speed=speed)
-        while self.on_white():
-            pass
-        self.off()
+import runRobot
 
-    def skip_black(self, speed=20):
-        self.on(speed=speed)
-        while self.on_black():
-            pass
-        self.off()
+FIELDS = ["lap", "rest volts", "lowest volts", "mean amps", "lap s", "error"]
 
-    def turn(self, degrees, speed=20):
-        if degrees >= 0:
-            self.tank_pair.on_for_degrees(left_speed=speed, right_speed=-speed, degrees=degrees * 1.987)
-        else:
-            self.tank_pair.on_for_degrees(left_speed=-speed, right_speed=speed, degrees=-degrees * 1.987)
 
-    def run(self):
-        self.on(speed=80)
-        while True:
-            pass
+class DrainTest:
+    """Alternates laps with running the motors until the battery is down to the floor.
 
-    def initialize_start(self):
-        self.move_degrees(80)
-        self.skip_black()
-        self.skip_white()
-        self.move_degrees(self.tile_length / 2 + self.sensor_dist)
-        self.turn(degrees=90)
-        self.skip_black(speed=-20)
-        self.skip_white()
-
-    def count_tiles(self):
-        tile_count = 0
-        turn_angle = 0
-        prev_turn_angle = 0
-        robot_angle = 0
-
-        while tile_count < 14:
-            tile_count += 1
-            self.sound.play_tone(100 + (50 * tile_count), 0.5)
-            self.move_degrees(120)
-
-            self.turn(90)
-            self.move_degrees(40)
-            right_is_white = self.on_white()
-            self.move_degrees(-40)
-            self.turn(-180)
-            self.move_degrees(40)
-            left_is_white = self.on_white()
-            self.move_degrees(-40)
-            self.turn(90)
-
-            if left_is_white and not (right_is_white):
-                turn_angle = 7
-            elif not (left_is_white) and right_is_white:
-                turn_angle = -7
-            else:
-                turn_angle = 0
-                self.turn(-prev_turn_angle)
-            if abs(robot_angle + turn_angle) >= 14:
-                turn_angle /= 2
-            self.turn(turn_angle)
-            robot_angle += turn_angle
-            prev_turn_angle = turn_angle
-
-            self.skip_black()
-            self.skip_white()
-
-        tile_count += 1
-        self.sound.play_tone(100 + (50 * tile_count), 0.5)
-        self.move_degrees(-self.tile_length * 0.5)
-
-    def cm_to_degrees(self, cm):
-        return (360 / (6 * math.pi)) * cm
-
-    def turn_360(self):
-        self.turn(degrees=360)
-
-    # point robot towards tower; return distance in cm
-    def search_for_tower(self):
-        min_dist = 255
-        start_time = time.time()
-        min_time = start_time
-        turn_thread = Thread(target=self.turn_360)
-        turn_thread.start()
-        while turn_thread.is_alive():
-            cur_dist = self.ultrasonic.distance_centimeters
-            if cur_dist < min_dist:
-                min_dist = cur_dist
-                min_time = time.time()
-        end_time = time.time()
-        self.turn(degrees=-360)
-        self.turn(degrees=360 * (min_time - start_time) / (end_time - start_time))
-        return min_dist
-
-    def bump_tower(self):
-        self.turn(degrees=90)
-        self.move_degrees(self.tile_length * 18)
+    :param log_path: CSV file to append a row to for each lap.
+    :param drain_speed: Speed the motors run at between laps.
+    :param drain_time: Seconds the motors run for between laps.
+    :param floor: Voltage at rest to stop at.
+    :param compensate: Whether the robot caps its speeds for the battery.
+    """
+    def __init__(self, log_path, drain_speed=80, drain_time=300, floor=7.0, compensate=True):
+        self.log_path = log_path
+        self.drain_speed = drain_speed
+        self.drain_time = drain_time
+        self.floor = floor
+        self.compensate = compensate
+        self.supply = PowerSupply()
+        self.button = Button()
+        self.sound = Sound()
 
-        while True:
-            distance = self.search_for_tower()
-            if distance / 2 <= 20:
-                self.move_degrees(self.cm_to_degrees(distance - 20))
-                self.search_for_tower()
-                break
-            self.move_degrees(self.cm_to_degrees(distance / 2))
+    def wait_for_button(self, prompt):
+        """Beep and wait for any button to be pressed.
+
+        :param prompt: What to do before pressing it.
+        """
+        print(prompt)
+        self.sound.beep()
+        while not self.button.any():
+            time.sleep(0.05)
+        # Give the hand time to get clear
+        time.sleep(1)
+
+    def lap(self, number):
+        """Drive one lap of the course.
+
+        :param number: Lap number, counting from 1.
+        :return: Row for the log, keyed by FIELDS.
+        """
+        self.wait_for_button("lap {}: put the robot on the start pad and press a button".format(number))
+        rest_volts = self.supply.measured_volts
+        robot = runRobot.Robot()
+        if not self.compensate:
+            robot.power.reference = None
+        error = ""
+        start = time.monotonic()
+        try:
+            robot.run()
+        except Exception as e:
+            error = type(e).__name__
+        lap_time = time.monotonic() - start
+        power = robot.power
+        return {
+            "lap": number,
+            "rest volts": "{:.3f}".format(rest_volts),
+            "lowest volts": "" if power.min_volts is None else "{:.3f}".format(power.min_volts),
+            "mean amps": "{:.3f}".format(power.amp_sum / power.amp_count) if power.amp_count else "",
+            "lap s": "{:.2f}".format(lap_time),
+            "error": error,
+        }
+
+    def drain(self):
+        """Run the motors at drain_speed for drain_time.
+        """
+        self.wait_for_button("put the robot on its stand and press a button")
+        tank = MoveTank(OUTPUT_B, OUTPUT_C)
+        tank.on(self.drain_speed, self.drain_speed)
+        try:
+            time.sleep(self.drain_time)
+        finally:
+            tank.off()
 
-        self.on(speed=100)
-        time.sleep(5)
-        self.off()
-        self.sound.speak("Mission Completed")
+    def run(self):
+        """Drive laps and drain in between until the battery is down to the floor.
+        """
+        new = not os.path.exists(self.log_path)
+        with open(self.log_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            if new:
+                writer.writeheader()
+            number = 0
+            while True:
+                number += 1
+                row = self.lap(number)
+                writer.writerow(row)
+                f.flush()
+                print("lap {lap}: {lap s} s at {rest volts} V".format(**row))
+                if float(row["rest volts"]) < self.floor:
+                    break
+                self.drain()
+        self.sound.speak("Battery test completed")
 
 
 if __name__ == "__main__":
     try:
-        r = Robot()
-        r.run()
+        parser = argparse.ArgumentParser(description="Log lap time against battery voltage.")
+        parser.add_argument("--log", default="drain.csv", help="CSV file to append the laps to")
+        parser.add_argument("--speed", type=int, default=80, help="speed to drain at between laps")
+        parser.add_argument("--drain", type=float, default=300,
+                            help="seconds to drain for between laps")
+        parser.add_argument("--floor", type=float, default=7.0,
+                            help="voltage at rest to stop the test at")
+        parser.add_argument("--uncompensated", action="store_true",
+                            help="drive without capping speeds for the battery")
+        args = parser.parse_args()
+        DrainTest(args.log, args.speed, args.drain, args.floor, not args.uncompensated).run()
 
     except:
         import traceback